@@ -4,9 +4,14 @@
 # see https://acme.sh
 # export bindrestapi_key="abc123"
 # export bindrestapi_url="https://dyndns1.example.org"
+# Optional, the most seconds to wait for every nameserver to serve the record
+# export bindrestapi_wait=120
+#
+# The api only answers once every authoritative nameserver of the zone serves
+# the record, so acme.sh does not need to wait as well: pass --dnssleep 0.
 
 # Testing notes - command used to test:
-# ./acme.sh --insecure --issue --staging --debug 2 --domain test.example.org --dns dns_bindrestapi | tee debug_run.log
+# ./acme.sh --insecure --issue --staging --debug 2 --domain test.example.org --dns dns_bindrestapi --dnssleep 0 | tee debug_run.log
 # Usage: add _acme-challenge.host.example.org "xxzzyy"
 
 dns_bindrestapi_add() {
@@ -27,13 +32,20 @@ dns_bindrestapi_add() {
     return 1
   fi
 
-  _info "Adding record $fulldomain"
+  bindrestapi_wait="${bindrestapi_wait:-120}"
+  _saveaccountconf_mutable bindrestapi_wait "$bindrestapi_wait"
+
+  _info "Adding record $fulldomain and waiting for the nameservers"
   export _H1="X-Api-Key: $bindrestapi_key"
   export _H2="Content-Type: application/json"
-  data="{\"response\":\"$txtvalue\",\"rrtype\":\"TXT\",\"ttl\":30}"
+  data="{\"value\":\"$txtvalue\",\"wait\":true,\"timeout\":$bindrestapi_wait}"
   _debug "data: $data"
-  response="$(_post "$data" "$bindrestapi_url/dns/record/$fulldomain")"
+  response="$(_post "$data" "$bindrestapi_url/dns/acme/$fulldomain")"
   _debug "got response: $response"
+  if ! _contains "$response" '"propagated":true'; then
+    _err "The record did not reach every nameserver: $response"
+    return 1
+  fi
 }
 
 dns_bindrestapi_rm() {
@@ -57,8 +69,8 @@ dns_bindrestapi_rm() {
   _info "deleting record $fulldomain"
   export _H1="X-Api-Key: $bindrestapi_key"
   export _H2="Content-Type: application/json"
-  data="{\"response\":\"$txtvalue\",\"rrtype\":\"TXT\",\"ttl\":30}"
+  data="{\"value\":\"$txtvalue\",\"wait\":false}"
   _debug "data: $data"
-  response="$(_post "$data" "$bindrestapi_url/dns/record/$fulldomain" "" "DELETE")"
+  response="$(_post "$data" "$bindrestapi_url/dns/acme/$fulldomain" "" "DELETE")"
   _debug "got response: $response"
 }
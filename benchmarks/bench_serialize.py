@@ -0,0 +1,76 @@
+""" Compare the cost and size of each zone export format with the dict
+get_zone used to build and FastAPI used to encode
+
+run with: python -m benchmarks.bench_serialize [record count]
+"""
+import sys
+import json
+import timeit
+from collections import defaultdict
+import dns.zone
+from fastapi.encoders import jsonable_encoder
+from bind_rest_api.api import serialize
+from bind_rest_api.api.zonebody import compress
+from bind_rest_api.api.zonecache import zone_serial
+from .standin import make_zone
+
+
+def legacy_zone_json(zone):
+    """the previous get_zone loop, a dict per record from iterate_rdatas"""
+    result = {}
+    records = defaultdict(list)
+    for (name, ttl, rdata) in zone.iterate_rdatas():
+        if rdata.rdtype.name == "SOA":
+            result["SOA"] = {"ttl": ttl}
+            for field_name in serialize.SOA_FIELDS:
+                if field_name in ("rname", "mname"):
+                    result["SOA"][field_name] = str(getattr(rdata, field_name))
+                else:
+                    result["SOA"][field_name] = getattr(rdata, field_name)
+        else:
+            records[str(name)].append(
+                {"response": str(rdata), "rrtype": rdata.rdtype.name, "ttl": ttl}
+            )
+    result["records"] = records
+    return result
+
+
+def legacy_body(zone):
+    """the previous response body, walked by jsonable_encoder then encoded
+    as JSONResponse does
+    """
+    return json.dumps(
+        jsonable_encoder(legacy_zone_json(zone)),
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+def main(count=100000):
+    """time and measure each way of rendering a zone of count records"""
+    # parsed again so names are relative, as in the zone cache
+    zone = dns.zone.from_text(
+        make_zone("example.org.", count).to_text(), origin="example.org."
+    )
+    serial = zone_serial(zone)
+    renderers = [
+        ("legacy json", lambda: legacy_body(zone)),
+        ("json", lambda: serialize.render_zone(zone, serial, "json")),
+        ("columnar", lambda: serialize.render_zone(zone, serial, "columnar")),
+        ("text", lambda: serialize.render_zone(zone, serial, "text")),
+    ]
+    backend = "orjson" if serialize.orjson is not None else "json"
+    print(f"{count} records, json encoded with {backend}")
+    print(f"  {'format':<12}{'ms':>10}{'bytes':>12}{'gzip bytes':>12}")
+    assert legacy_body(zone) == serialize.render_zone(zone, serial, "json")
+    for (name, render) in renderers:
+        number = 3
+        seconds = timeit.timeit(render, number=number) / number
+        body = render()
+        size = len(compress(body, "gzip"))
+        print(f"  {name:<12}{seconds * 1000:>10.1f}{len(body):>12}{size:>12}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
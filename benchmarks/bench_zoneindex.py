@@ -0,0 +1,33 @@
+""" Compare allowed zone lookup cost with many zones
+
+run with: python -m benchmarks.bench_zoneindex [zone count]
+"""
+import sys
+import timeit
+from bind_rest_api.api.zoneindex import ZoneIndex
+
+
+def linear_find(zones, domain):
+    """the previous lookup: first zone the domain ends with"""
+    for zone in zones:
+        if domain.endswith(zone):
+            return zone
+    return None
+
+
+def main(count=10000):
+    """time both lookups for a name in the last zone and an unknown name"""
+    zones = [f"customer{i}.example.org." for i in range(count)]
+    index = ZoneIndex(zones)
+    number = 1000
+    print(f"{count} zones, microseconds per lookup")
+    for domain in (f"host.customer{count - 1}.example.org.", "host.example.net."):
+        linear = timeit.timeit(lambda: linear_find(zones, domain), number=number)
+        trie = timeit.timeit(lambda: index.find(domain), number=number)
+        print(f"  {domain}")
+        print(f"    linear scan: {linear / number * 1e6:10.2f}")
+        print(f"    label trie:  {trie / number * 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,375 @@
+""" Load test every api endpoint against the BIND stand-in
+
+The stand-in and the api, started with bindapi serve, each run in their own
+process.  Each scenario drives one endpoint from a number of concurrent
+keep-alive connections for a fixed time, and the results are printed as
+json, so runs can be saved and compared with --baseline.
+
+run with: python -m benchmarks.loadgen [--concurrency 32] [--records 1000]
+    [--duration 10] [--workers 1] [--output run.json] [--baseline old.json]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+
+ZONE = "example.org."
+TSIG_NAME = "bench"
+TSIG_SECRET = "YmVuY2htYXJrLXRzaWctc2VjcmV0"
+API_KEY = "benchmark-api-key"
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection, enough of a client for the api"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        """send a request and return (status, body)"""
+        if self.writer is None:
+            (self.reader, self.writer) = await asyncio.open_connection(
+                self.host, self.port
+            )
+        data = b"" if body is None else json.dumps(body).encode()
+        self.writer.write(
+            (
+                f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"X-Api-Key: {API_KEY}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n"
+            ).encode()
+            + data
+        )
+        try:
+            return await self._response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    async def _response(self):
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).strip()
+            if not line:
+                break
+            (name, value) = line.decode("latin-1").split(":", maxsplit=1)
+            headers[name.lower()] = value.strip().lower()
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                body += await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection") == "close":
+            self.close()
+        return (status, body)
+
+    def close(self):
+        """close the socket, the next request reconnects"""
+        if self.writer is not None:
+            self.writer.close()
+        (self.reader, self.writer) = (None, None)
+
+
+def record(i):
+    """the body of a record change"""
+    return {"response": f"10.200.{i >> 8 & 255}.{i & 255}", "rrtype": "A", "ttl": 300}
+
+
+def batch(i):
+    """ten changes to the zone"""
+    return [
+        {"action": "add", "domain": f"batch{i}-{j}.{ZONE}", "record": record(j)}
+        for j in range(10)
+    ]
+
+
+def scenarios(records):
+    """(name, request factory) for each endpoint, named after its handler"""
+    return [
+        ("get_zone", lambda i: ("GET", f"/dns/zone/{ZONE}", None)),
+        ("get_zone_ndjson", lambda i: ("GET", f"/dns/zone/{ZONE}?format=ndjson", None)),
+        (
+            "get_record",
+            lambda i: (
+                "GET",
+                f"/dns/record/host{i % records}.{ZONE}?record_types=A",
+                None,
+            ),
+        ),
+        ("create_record", lambda i: ("POST", f"/dns/record/load{i}.{ZONE}", record(i))),
+        (
+            "replace_record",
+            lambda i: ("PUT", f"/dns/record/host{i % records}.{ZONE}", record(i)),
+        ),
+        (
+            "delete_single_record",
+            lambda i: ("DELETE", f"/dns/record/load{i}.{ZONE}", record(i)),
+        ),
+        (
+            "delete_record_type",
+            lambda i: ("DELETE", f"/dns/allrecords/load{i}.{ZONE}?recordtypes=A", None),
+        ),
+        ("batch_update", lambda i: ("POST", "/dns/batch", batch(i))),
+        ("get_metrics", lambda i: ("GET", "/metrics", None)),
+    ]
+
+
+def percentile(ordered, fraction):
+    """nearest rank percentile of an ordered list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_kb(pid):
+    """the summed peak resident memory of a process and its descendants, read
+    from /proc, or None where that is not available
+    """
+    parents = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as stat:
+                        # the command may contain spaces, the ppid follows it
+                        parents[int(entry)] = int(
+                            stat.read().rsplit(")", 1)[1].split()[1]
+                        )
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    family = {pid}
+    while True:
+        children = {p for (p, ppid) in parents.items() if ppid in family} - family
+        if not children:
+            break
+        family |= children
+    total = 0
+    for member in family:
+        try:
+            with open(f"/proc/{member}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+async def run_scenario(host, port, factory, concurrency, duration):
+    """drive one endpoint and return its latencies and error count"""
+    counter = itertools.count()
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        connection = Connection(host, port)
+        while time.perf_counter() < deadline:
+            (method, path, body) = factory(next(counter))
+            start = time.perf_counter()
+            try:
+                (status, _) = await connection.request(method, path, body)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                errors[0] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[0] += 1
+        connection.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return (latencies, errors[0], time.perf_counter() - started)
+
+
+def free_port():
+    """a TCP port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_api(host, port, timeout=30):
+    """wait until the api answers"""
+    deadline = time.monotonic() + timeout
+    while True:
+        connection = Connection(host, port)
+        try:
+            (status, _) = await connection.request("GET", "/metrics")
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            if time.monotonic() > deadline:
+                raise
+        finally:
+            connection.close()
+        await asyncio.sleep(0.1)
+
+
+def start_servers(args, workdir):
+    """start the stand-in and the api, returning their (processes, api port)"""
+    dns_port = free_port()
+    standin = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.standin",
+            "--port",
+            str(dns_port),
+            "--records",
+            str(args.records),
+            "--zone",
+            ZONE,
+            "--key",
+            f"{TSIG_NAME}:{TSIG_SECRET}",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    # it prints a line once it is listening
+    standin.stdout.readline()
+    key_file = os.path.join(workdir, "apikeys.pass")
+    with open(key_file, "w") as keys:
+        keys.write(f"bench,{API_KEY}\n")
+    api_port = free_port()
+    env = dict(
+        os.environ,
+        BIND_SERVER="127.0.0.1",
+        BIND_PORT=str(dns_port),
+        TSIG_USERNAME=TSIG_NAME,
+        TSIG_PASSWORD=TSIG_SECRET,
+        BIND_ALLOWED_ZONES=ZONE.rstrip("."),
+        API_KEY_FILE=key_file,
+        LOGGING_APPLICATION_NAME="bindapi-bench",
+        LOGGING_DIR=workdir,
+    )
+    api = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "bind_rest_api.cli",
+            "--port",
+            str(api_port),
+            "--workers",
+            str(args.workers),
+            "serve",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return ((standin, api), api_port)
+
+
+def compare(results, baseline):
+    """print the change from a baseline run to stderr"""
+    print(f"{'scenario':<22}{'req/s':>18}{'p99 ms':>20}", file=sys.stderr)
+    for (name, result) in results["results"].items():
+        old = baseline["results"].get(name)
+        if not old or not old["requests_per_second"] or not old["p99_ms"]:
+            continue
+        rps = result["requests_per_second"] / old["requests_per_second"] - 1
+        p99 = (result["p99_ms"] or 0) / old["p99_ms"] - 1
+        print(
+            f"{name:<22}{result['requests_per_second']:>10.1f} {rps:>+7.1%}"
+            f"{result['p99_ms'] or 0:>12.2f} {p99:>+7.1%}",
+            file=sys.stderr,
+        )
+
+
+async def benchmark(args, api_pid, api_port):
+    """run the chosen scenarios one after the other"""
+    host = "127.0.0.1"
+    await wait_for_api(host, api_port)
+    results = {}
+    for (name, factory) in scenarios(args.records):
+        if args.scenario and name not in args.scenario:
+            continue
+        (latencies, errors, elapsed) = await run_scenario(
+            host, api_port, factory, args.concurrency, args.duration
+        )
+        latencies.sort()
+        results[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "requests_per_second": round(len(latencies) / elapsed, 1),
+            "p50_ms": (
+                round(percentile(latencies, 0.50) * 1000, 3) if latencies else None
+            ),
+            "p99_ms": (
+                round(percentile(latencies, 0.99) * 1000, 3) if latencies else None
+            ),
+            # the api's high water mark so far, so it only ever grows
+            "peak_rss_kb": peak_rss_kb(api_pid),
+        }
+        print(f"{name}: {results[name]}", file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    """run the benchmark and print or save the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--concurrency", "-c", type=int, default=32)
+    parser.add_argument(
+        "--duration", "-d", type=float, default=10, help="seconds per scenario"
+    )
+    parser.add_argument("--records", "-r", type=int, default=1000, help="zone size")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="api workers")
+    parser.add_argument(
+        "--scenario", "-s", action="append", help="only run this scenario"
+    )
+    parser.add_argument("--output", "-o", help="write the json results here")
+    parser.add_argument("--baseline", "-b", help="json results to compare with")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bindapi-bench-") as workdir:
+        (processes, api_port) = start_servers(args, workdir)
+        try:
+            results = asyncio.run(benchmark(args, processes[1].pid, api_port))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+    output = {
+        "config": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "records": args.records,
+            "workers": args.workers,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(output, json.load(baseline))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,386 @@
+""" A small authoritative DNS server standing in for BIND
+
+Answers queries over UDP and TCP, applies TSIG signed UPDATEs and serves
+AXFR, and IXFR from a journal of the updates it has applied, so the api
+can be load tested without a BIND server.  Everything is held in memory.
+
+run with: python -m benchmarks.standin [--port 5300] [--records 1000]
+"""
+import sys
+import struct
+import asyncio
+import argparse
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsig
+import dns.tsigkeyring
+import dns.zone
+
+# rdatas put in one AXFR/IXFR message, well below the 64k message limit
+XFR_CHUNK = 200
+
+
+def make_zone(origin, records=0):
+    """build a zone with an SOA, an NS and *records* A records"""
+    # names are kept absolute, as they arrive in UPDATEs
+    zone = dns.zone.Zone(origin, relativize=False)
+
+    def add(name, ttl, rdtype, text):
+        name = dns.name.from_text(name, zone.origin)
+        rdata = dns.rdata.from_text(
+            "IN", rdtype, text, origin=zone.origin, relativize=False
+        )
+        zone.find_rdataset(name, rdtype, create=True).add(rdata, ttl)
+
+    add("@", 3600, "SOA", "ns1 hostmaster 1 3600 600 86400 300")
+    add("@", 3600, "NS", "ns1")
+    add("ns1", 3600, "A", "127.0.0.1")
+    for i in range(records):
+        add(f"host{i}", 300, "A", f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}")
+    return zone
+
+
+class StandIn:
+    """In-memory authoritative server for a set of zones
+
+    UPDATEs must be signed with a key in *keyring*, prerequisites are
+    checked as RFC 2136 describes, and every UPDATE that changes a zone
+    bumps its SOA serial and is journaled for IXFR.
+    """
+
+    def __init__(self, keyring, zones=()):
+        self.keyring = keyring
+        self.zones = {}
+        # origin -> [(old soa, deleted, new soa, added)], oldest first
+        self.journals = {}
+        self.counts = {"query": 0, "update": 0, "axfr": 0, "ixfr": 0}
+        for zone in zones:
+            self.add_zone(zone)
+
+    def add_zone(self, zone):
+        """serve a dns.zone.Zone"""
+        self.zones[zone.origin] = zone
+        self.journals[zone.origin] = []
+
+    def find_zone(self, name):
+        """the zone name is in, or None"""
+        while True:
+            if name in self.zones:
+                return self.zones[name]
+            if name == dns.name.root:
+                return None
+            name = name.parent()
+
+    def handle(self, wire, tcp=True):
+        """return the response messages for one request"""
+        try:
+            request = dns.message.from_wire(wire, keyring=self.keyring)
+        except (dns.tsig.BadSignature, dns.tsig.PeerError, dns.message.UnknownTSIGKey):
+            return [self._error(wire, dns.rcode.NOTAUTH)]
+        except dns.exception.DNSException:
+            return [self._error(wire, dns.rcode.FORMERR)]
+        if request.opcode() == dns.opcode.UPDATE:
+            self.counts["update"] += 1
+            return [self.update(request)]
+        if request.opcode() != dns.opcode.QUERY or len(request.question) != 1:
+            return [self._error(wire, dns.rcode.NOTIMP)]
+        question = request.question[0]
+        zone = self.find_zone(question.name)
+        if zone is None:
+            return [self._error(wire, dns.rcode.REFUSED)]
+        if question.rdtype == dns.rdatatype.AXFR and tcp:
+            self.counts["axfr"] += 1
+            return self._xfr(request, self._axfr_records(zone))
+        if question.rdtype == dns.rdatatype.IXFR and tcp:
+            self.counts["ixfr"] += 1
+            return self._xfr(request, self._ixfr_records(request, zone))
+        self.counts["query"] += 1
+        return [self.query(request, zone)]
+
+    @staticmethod
+    def _error(wire, rcode):
+        (query_id, flags) = struct.unpack("!HH", wire[:4])
+        response = dns.message.Message(query_id)
+        response.flags = dns.flags.QR | (flags & dns.flags.RD)
+        response.set_opcode(dns.opcode.from_flags(flags))
+        response.set_rcode(rcode)
+        return response
+
+    @staticmethod
+    def _soa_rrset(zone, negative=False):
+        soa = zone.find_rdataset(zone.origin, "SOA")
+        ttl = min(soa.ttl, soa[0].minimum) if negative else soa.ttl
+        return dns.rrset.from_rdata(zone.origin, ttl, soa[0])
+
+    def query(self, request, zone):
+        """answer an ordinary query from zone"""
+        question = request.question[0]
+        response = dns.message.make_response(request)
+        response.flags |= dns.flags.AA
+        node = zone.get_node(question.name)
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(self._soa_rrset(zone, negative=True))
+            return response
+        for rdtype in (question.rdtype, dns.rdatatype.CNAME):
+            rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype)
+            if rdataset is not None:
+                rrset = response.find_rrset(
+                    response.answer,
+                    question.name,
+                    dns.rdataclass.IN,
+                    rdtype,
+                    create=True,
+                )
+                rrset.update(rdataset)
+                return response
+        response.authority.append(self._soa_rrset(zone, negative=True))
+        return response
+
+    def _axfr_records(self, zone):
+        soa = self._soa_rrset(zone)
+        records = [(soa.name, soa.ttl, soa[0])]
+        for (name, ttl, rdata) in zone.iterate_rdatas():
+            if rdata.rdtype != dns.rdatatype.SOA:
+                records.append((name, ttl, rdata))
+        records.append(records[0])
+        return records
+
+    def _ixfr_records(self, request, zone):
+        soa = self._soa_rrset(zone)
+        current = (soa.name, soa.ttl, soa[0])
+        try:
+            serial = request.authority[0][0].serial
+        except (IndexError, AttributeError):
+            return self._axfr_records(zone)
+        if serial == soa[0].serial:
+            return [current]
+        journal = self.journals[zone.origin]
+        starts = [old.serial for (old, _, _, _) in journal]
+        if serial not in starts:
+            # the journal does not reach back that far, send the whole zone
+            return self._axfr_records(zone)
+        records = [current]
+        for (old, deleted, new, added) in journal[starts.index(serial) :]:
+            records.append((zone.origin, soa.ttl, old))
+            records.extend(deleted)
+            records.append((zone.origin, soa.ttl, new))
+            records.extend(added)
+        records.append(current)
+        return records
+
+    @staticmethod
+    def _xfr(request, records):
+        responses = []
+        for start in range(0, len(records), XFR_CHUNK):
+            response = dns.message.make_response(request)
+            response.flags |= dns.flags.AA
+            if start:
+                # only the first message repeats the question
+                response.question = []
+            for (name, ttl, rdata) in records[start : start + XFR_CHUNK]:
+                response.answer.append(dns.rrset.from_rdata(name, ttl, rdata))
+            responses.append(response)
+        return responses
+
+    def update(self, request):
+        """apply a dynamic update and return the response"""
+        response = dns.message.make_response(request)
+        if request.keyring is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+        zone = self.zones.get(request.zone[0].name) if request.zone else None
+        if zone is None:
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return response
+        rcode = self._check_prerequisites(zone, request.prerequisite)
+        if rcode != dns.rcode.NOERROR:
+            response.set_rcode(rcode)
+            return response
+        (deleted, added) = ([], [])
+        for rrset in request.update:
+            self._apply(zone, rrset, deleted, added)
+        if deleted or added:
+            soa = zone.find_rdataset(zone.origin, "SOA")
+            old = soa[0]
+            new = old.replace(serial=(old.serial + 1) % 2**32)
+            soa.clear()
+            soa.add(new)
+            self.journals[zone.origin].append((old, deleted, new, added))
+        return response
+
+    @staticmethod
+    def _check_prerequisites(zone, prerequisites):
+        required = {}
+        for rrset in prerequisites:
+            node = zone.get_node(rrset.name)
+            if rrset.deleting == dns.rdataclass.ANY:
+                if rrset.rdtype == dns.rdatatype.ANY:
+                    if node is None:
+                        return dns.rcode.NXDOMAIN
+                elif (
+                    node is None
+                    or node.get_rdataset(dns.rdataclass.IN, rrset.rdtype) is None
+                ):
+                    return dns.rcode.NXRRSET
+            elif rrset.deleting == dns.rdataclass.NONE:
+                if rrset.rdtype == dns.rdatatype.ANY:
+                    if node is not None:
+                        return dns.rcode.YXDOMAIN
+                elif (
+                    node is not None
+                    and node.get_rdataset(dns.rdataclass.IN, rrset.rdtype) is not None
+                ):
+                    return dns.rcode.YXRRSET
+            else:
+                required.setdefault((rrset.name, rrset.rdtype), set()).update(rrset)
+        for ((name, rdtype), rdatas) in required.items():
+            node = zone.get_node(name)
+            rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype) if node else None
+            if rdataset is None or set(rdataset) != rdatas:
+                return dns.rcode.NXRRSET
+        return dns.rcode.NOERROR
+
+    @staticmethod
+    def _apply(zone, rrset, deleted, added):
+        name = rrset.name
+        if rrset.rdtype == dns.rdatatype.SOA:
+            # the serial is managed here
+            return
+        node = zone.get_node(name)
+        if rrset.deleting is None:
+            rdataset = zone.find_rdataset(name, rrset.rdtype, create=True)
+            if len(rdataset) and rdataset.ttl != rrset.ttl:
+                # a ttl change replaces every record of the type
+                deleted.extend((name, rdataset.ttl, r) for r in rdataset)
+                added.extend((name, rrset.ttl, r) for r in rdataset)
+            new = [r for r in rrset if r not in rdataset]
+            rdataset.ttl = rrset.ttl
+            for rdata in new:
+                rdataset.add(rdata)
+            added.extend((name, rrset.ttl, r) for r in new)
+            return
+        if node is None:
+            return
+        if rrset.deleting == dns.rdataclass.ANY:
+            rdtypes = [rrset.rdtype]
+            if rrset.rdtype == dns.rdatatype.ANY:
+                rdtypes = [r.rdtype for r in node.rdatasets]
+                if name == zone.origin:
+                    rdtypes = [
+                        r
+                        for r in rdtypes
+                        if r not in (dns.rdatatype.SOA, dns.rdatatype.NS)
+                    ]
+            for rdtype in rdtypes:
+                rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype)
+                if rdataset is not None:
+                    deleted.extend((name, rdataset.ttl, r) for r in rdataset)
+                    node.delete_rdataset(dns.rdataclass.IN, rdtype)
+        else:
+            rdataset = node.get_rdataset(dns.rdataclass.IN, rrset.rdtype)
+            if rdataset is None:
+                return
+            for rdata in rrset:
+                if rdata in rdataset:
+                    rdataset.discard(rdata)
+                    deleted.append((name, rdataset.ttl, rdata))
+            if not rdataset:
+                node.delete_rdataset(dns.rdataclass.IN, rrset.rdtype)
+        if not node.rdatasets:
+            zone.delete_node(name)
+
+    async def _serve_tcp(self, reader, writer):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                for response in self.handle(await reader.readexactly(length)):
+                    wire = response.to_wire()
+                    writer.write(struct.pack("!H", len(wire)) + wire)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """listen for TCP and UDP on host and port, returning the port"""
+        self.server = await asyncio.start_server(self._serve_tcp, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        loop = asyncio.get_event_loop()
+        (self.transport, _) = await loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self), local_addr=(host, port)
+        )
+        return port
+
+    def close(self):
+        """stop listening"""
+        self.server.close()
+        self.transport.close()
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, standin):
+        self.standin = standin
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        (response,) = self.standin.handle(data, tcp=False)
+        max_size = response.payload if response.edns >= 0 else 512
+        try:
+            wire = response.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            response.flags |= dns.flags.TC
+            response.answer = []
+            response.authority = []
+            response.additional = []
+            wire = response.to_wire()
+        self.transport.sendto(wire, addr)
+
+
+def main(argv=None):
+    """run a stand-in server until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5300)
+    parser.add_argument(
+        "--zone", action="append", help="zone to serve, may be repeated"
+    )
+    parser.add_argument(
+        "--records", type=int, default=1000, help="A records in each zone"
+    )
+    parser.add_argument(
+        "--key",
+        default="local-ddns:YWJjMTIz",
+        help="TSIG key name:base64 secret that UPDATEs must be signed with",
+    )
+    args = parser.parse_args(argv)
+    (key_name, secret) = args.key.split(":", maxsplit=1)
+    standin = StandIn(
+        dns.tsigkeyring.from_text({key_name: secret}),
+        (make_zone(z, args.records) for z in args.zone or ["example.org."]),
+    )
+
+    async def serve():
+        port = await standin.start(args.host, args.port)
+        print(f"serving {len(standin.zones)} zones on {args.host}:{port}", flush=True)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+""" The cache of record lookup answers, kept coherent across workers """
+import dns.resolver
+
+
+class AnswerCache(dns.resolver.LRUCache):
+    """An LRUCache whose answers for a zone go stale with any write to it
+
+    Each answer is stamped with its zone and the zone's write count from
+    *generations* as the lookup missed, so an answer fetched while a write
+    was in flight is not kept past it.  Reading an answer after the count
+    moved on, through this worker or any other, is a miss.
+    """
+
+    def __init__(self, max_size, zones, generations):
+        super().__init__(max_size)
+        self.zones = zones
+        self.generations = generations
+        self._missed = {}
+
+    def get(self, key):
+        value = super().get(key)
+        stamp = getattr(value, "zone_generation", None)
+        if stamp is not None and self.generations.get(stamp[0]) != stamp[1]:
+            self.flush(key)
+            value = None
+        if value is None:
+            zone = self.zones.find(key[0].to_text())
+            if zone is not None:
+                if len(self._missed) >= self.max_size:
+                    # lookups that failed never put an answer
+                    self._missed.clear()
+                self._missed[key] = (zone, self.generations.get(zone))
+        return value
+
+    def put(self, key, value):
+        stamp = self._missed.pop(key, None)
+        if stamp is None:
+            zone = self.zones.find(key[0].to_text())
+            if zone is not None:
+                stamp = (zone, self.generations.get(zone))
+        value.zone_generation = stamp
+        super().put(key, value)
@@ -1,63 +1,52 @@
 """ REST api to handle BIND updates via TSIG and Dynamic DNS Updates """
-import os
+import json
+import math
+import time
+import asyncio
 import functools
+import contextlib
 import traceback
-import pathlib
-import logging
-from typing import List
+from typing import Dict, List
 from enum import Enum
 from collections import defaultdict, namedtuple
-import dns.tsigkeyring
+import dns.exception
+import dns.message
 import dns.resolver
 import dns.update
-import dns.query
-import dns.zone
-import dns.asyncquery
-import dns.asyncresolver
 import dns.name
-from fastapi import FastAPI, HTTPException, Security, Depends, Query, Path
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+from fastapi import (
+    APIRouter,
+    FastAPI,
+    HTTPException,
+    Security,
+    Depends,
+    Query,
+    Path,
+    Request,
+)
+from fastapi.responses import Response
 from fastapi.security.api_key import APIKey, APIKeyHeader
 from pydantic import BaseModel, Field
+from .backend import Backend
+from .changefeed import ChangesExpired
 from .constants import VERSION
-
-
-# Set up some variables
-DNS_SERVER = os.environ["BIND_SERVER"]
-LOGGING_APPLICATION_NAME = os.environ["LOGGING_APPLICATION_NAME"]
-LOGGING_DIR = os.environ.get("LOGGING_DIR", "./logs")
-TSIG = dns.tsigkeyring.from_text(
-    {os.environ["TSIG_USERNAME"]: os.environ["TSIG_PASSWORD"]}
-)
-VALID_ZONES = [i + "." for i in os.environ["BIND_ALLOWED_ZONES"].split(",")]
-API_KEYS = {
-    x.split(",", maxsplit=1)[1]: x.split(",", maxsplit=1)[0]
-    for x in filter(
-        lambda x: x != "" and x[0] != "#",
-        pathlib.Path(os.environ["API_KEY_FILE"]).read_text().split("\n"),
-    )
-}
-
-
-# Set up logging
-formatter = logging.Formatter(
-    f"%(asctime)s == {LOGGING_APPLICATION_NAME} == %(message)s",
-    datefmt="%Y-%m-%dT%H:%M%z",
-)
-auditlogger = logging.getLogger("bind-api.audit")
-auditlogger.setLevel(logging.INFO)
-handler1 = logging.handlers.TimedRotatingFileHandler(
-    f"{LOGGING_DIR}/dns-api-audit.log", when="D", interval=7
-)
-handler1.setFormatter(formatter)
-auditlogger.addHandler(handler1)
-logger = logging.getLogger("bind-api")
-logger.setLevel(logging.DEBUG)
-handler2 = logging.handlers.RotatingFileHandler(
-    f"{LOGGING_DIR}/dns-api-debug.log", maxBytes=(1024 * 1024 * 100), backupCount=10
-)
-handler2.setFormatter(formatter)
-logger.addHandler(handler2)
-logger.debug("starting up")
+from .idempotency import IdempotentRoute
+from .keystore import KeyEntry
+from .logs import auditlogger, logger, setup_logging, stop_logging
+from . import metrics
+from .ratelimit import Overloaded
+from .serialize import MEDIA_TYPES, dumps, render_snapshot, render_zone
+from .servers import server_label
+from .settings import Settings
+from .timing import PROFILE_HEADER, TimingMiddleware, span, start_profile
+from .zonecache import zone_serial
+from .zonebody import choose_encoding, etag, etag_matches
+from .zonequery import CursorError, CursorExpired
+from .zonestream import ClosingStreamingResponse, iterate_axfr
+from .zonesync import build_update, current_rrsets, desired_rrsets, diff_rrsets
 
 
 class RecordType(str, Enum):
@@ -72,6 +61,15 @@ class RecordType(str, Enum):
     SOA = "SOA"
 
 
+class ZoneFormat(str, Enum):
+    """define zone output formats"""
+
+    json = "json"
+    ndjson = "ndjson"
+    columnar = "columnar"
+    text = "text"
+
+
 # Record
 class Record(BaseModel):
     """DNS Record"""
@@ -81,12 +79,109 @@ class Record(BaseModel):
     ttl: int = Field(3600, example=3600)
 
 
+class Preconditions(BaseModel):
+    """Conditions BIND checks in the same UPDATE as a change, which is only
+    made if all of them hold
+    """
+
+    exists: bool = Field(
+        None, description="the name must (true) or must not (false) exist"
+    )
+    rrset: List[str] = Field(
+        None,
+        example=["10.9.1.134"],
+        description="the name's records of this type must be exactly these, "
+        "or with [] there must be none",
+    )
+    serial: int = Field(None, description="the zone's SOA serial must be this")
+
+
+# A record change with optional preconditions
+class RecordChange(Record):
+    """DNS Record change"""
+
+    preconditions: Preconditions = None
+
+
+class BatchAction(str, Enum):
+    """define batch operation actions"""
+
+    add = "add"
+    replace = "replace"
+    delete = "delete"
+
+
+# One record change in a batch
+class BatchOperation(BaseModel):
+    """A single record change within a batch update"""
+
+    action: BatchAction
+    domain: str = Field(..., example="server.example.org.")
+    record: Record
+
+
+# Verbs used in the audit log for each batch action
+AUDIT_VERBS = {
+    BatchAction.add: "CREATE",
+    BatchAction.replace: "REPLACE",
+    BatchAction.delete: "DELETE",
+}
+
 HelperResponse = namedtuple("HelperResponse", "domain action zone")
+# the (domain, operation) pairs of a batch by zone, and the (zone, index) of
+# each operation in the order they were sent
+Batch = namedtuple("Batch", "zones order")
+# the SOA serial and record of a zone version, and a callable returning its
+# (name, ttl, rdata) records
+ZoneVersion = namedtuple("ZoneVersion", "serial soa records")
+
+
+# An ACME DNS-01 challenge value
+class AcmeChallenge(BaseModel):
+    """ACME DNS-01 challenge"""
+
+    value: str = Field(
+        ...,
+        example="gfj9Xq-Rg85nM_Dd5bUFjnjd1vOZkd0qzZ4r7kzJ5Cc",
+        regex="^[A-Za-z0-9_=-]+$",
+    )
+    wait: bool = Field(
+        True, description="answer once every nameserver of the zone serves the change"
+    )
+    timeout: float = Field(
+        120, gt=0, le=600, description="seconds to wait for the nameservers"
+    )
+
+
+# The records a zone sync should leave in place
+class ZoneRecords(BaseModel):
+    """Records keyed by name, relative to the zone, as get_zone returns them"""
+
+    records: Dict[str, List[Record]] = Field(
+        ...,
+        example={"www": [{"response": "10.9.1.135", "rrtype": "A", "ttl": 3600}]},
+    )
+
+
+# Largest page of records a zone query returns, and the default page size
+MAX_PAGE_SIZE = 10000
+PAGE_SIZE = 1000
+
+# Longest a change feed request waits, and the gap between SSE keepalives
+MAX_CHANGE_WAIT = 300
+KEEPALIVE_INTERVAL = 15
+
+# The first label of ACME DNS-01 challenge names, and the TTL of the records
+ACME_LABEL = b"_acme-challenge"
+ACME_TTL = 30
+
+# Record types a zone sync manages, the SOA is left to BIND
+SYNC_TYPES = frozenset(
+    dns.rdatatype.from_text(rrtype) for rrtype in RecordType if rrtype != "SOA"
+)
+# UPDATEs tried before giving up on a zone that keeps changing
+SYNC_ATTEMPTS = 3
 
-# Some wrappers
-asyncresolver = dns.asyncresolver.Resolver()
-asyncresolver.nameservers = [DNS_SERVER]
-tcpquery = functools.partial(dns.asyncquery.tcp, where=DNS_SERVER)
 # Used to properly fix unqualified domains
 
 
@@ -97,75 +192,363 @@ def qualify(domain):
     return domain
 
 
-# Set up app
-app = FastAPI(title="bind-rest-api", version=VERSION)
+router = APIRouter(route_class=IdempotentRoute)
+
+
+# UPDATE rcodes for a prerequisite that did not hold
+PREREQUISITE_RCODES = frozenset(
+    [dns.rcode.YXDOMAIN, dns.rcode.NXDOMAIN, dns.rcode.YXRRSET, dns.rcode.NXRRSET]
+)
+
+# handlers whose requests count against a key's transfer limit
+XFR_HANDLERS = frozenset(["get_zone"])
+
+
+def request_kind(request):
+    """the rate limit a request counts against, xfr, read or write"""
+    endpoint = request.scope.get("endpoint")
+    if endpoint is not None and endpoint.__name__ in XFR_HANDLERS:
+        return "xfr"
+    return "read" if request.method in ("GET", "HEAD") else "write"
+
+
+def too_many_requests(kind, error, detail):
+    """the 429 for an Overloaded request, telling the client when to retry"""
+    metrics.RATE_LIMITED.labels(kind).inc()
+    return HTTPException(
+        429, detail, headers={"Retry-After": str(math.ceil(error.retry_after))}
+    )
 
 
-async def check_api_key(
+def get_backend(request: Request) -> Backend:
+    """the Backend of the app handling the request"""
+    return request.app.state.backend
+
+
+async def authenticate(
+    request: Request,
     api_key_header: str = Security(APIKeyHeader(name="X-Api-Key")),
-) -> str:
-    """Set up API Key authorization"""
+    backend: Backend = Depends(get_backend),
+) -> KeyEntry:
+    """Set up API Key authorization, check the secret may use the zone of
+    the domain or zone in the path, and admit the request under the key's
+    rate limit, returning the KeyEntry of the secret
+
+    A request with the X-Profile header from a key in PROFILE_API_KEYS is
+    profiled from here on.
+    """
+    with span("auth"):
+        key = backend.keys.lookup(api_key_header)
+        if key is None:
+            metrics.AUTH_FAILURES.labels("invalid").inc()
+            raise HTTPException(401, "invalid api key")
+        domain = request.path_params.get("domain", request.path_params.get("zone_name"))
+        if domain is not None:
+            zone = backend.zones.find(qualify(domain))
+            if zone is not None and not key.permits(zone):
+                metrics.AUTH_FAILURES.labels("zone").inc()
+                raise HTTPException(403, "zone not permitted for this api key")
+        kind = request_kind(request)
+        try:
+            await backend.limiter.admit(key.name, kind, key.limits.get(kind))
+        except Overloaded as error:
+            logger.debug("api key %s is over its %s rate limit", key.name, kind)
+            raise too_many_requests(
+                kind, error, f"{kind} rate limit exceeded for this api key"
+            ) from error
+    if PROFILE_HEADER in request.headers:
+        if key.name not in backend.settings.profile_keys:
+            logger.debug("api key %s may not profile requests", key.name)
+        elif not start_profile():
+            logger.debug("not profiling, another profile is running")
+    return key
+
+
+async def check_api_key(key: KeyEntry = Depends(authenticate)) -> str:
+    """the name of the api key a request was authenticated with"""
+    return key.name
+
+
+def record_json(name, ttl, rdata):
+    """the json form of a zone record"""
+    return {
+        "name": str(name),
+        "response": str(rdata),
+        "rrtype": rdata.rdtype.name,
+        "ttl": ttl,
+    }
+
+
+async def stream_zone(records):
+    """render (name, ttl, rdata) tuples as newline delimited json"""
     try:
-        return API_KEYS[api_key_header]
-    except KeyError as error:
-        raise HTTPException(401, "invalid api key") from error
+        async for (name, ttl, rdata) in records:
+            yield dumps(record_json(name, ttl, rdata)) + b"\n"
+    finally:
+        await records.aclose()
+
 
+async def current_zone(backend, zone_name, check=False):
+    """the current ZoneVersion of a zone, from the snapshot the workers
+    share if there is one, else the zone cache, asking the server for the
+    serial first with check
+    """
+    if backend.snapshots is not None:
+        if check:
+            backend.snapshots.invalidate(zone_name)
+        snapshot = await backend.snapshots.get(zone_name)
+        return ZoneVersion(snapshot.serial, snapshot.soa(), snapshot.iterate_rdatas)
+    if check:
+        backend.zonecache.invalidate(zone_name)
+    zone = await backend.zonecache.get(zone_name)
+    return ZoneVersion(
+        zone_serial(zone),
+        zone.find_rdataset(dns.name.empty, dns.rdatatype.SOA)[0],
+        zone.iterate_rdatas,
+    )
 
-@app.get("/dns/zone/{zone_name}")
-def get_zone(
+
+@router.get("/dns/zone/{zone_name}")
+async def get_zone(
+    request: Request,
     zone_name: str = Path(..., example="example.org."),
+    output_format: ZoneFormat = Query(ZoneFormat.json, alias="format"),
+    rrtype: RecordType = Query(None),
+    suffix: str = Query(None, example="k8s.example.org."),
+    prefix: str = Query(None, example="_acme"),
+    rdata: str = Query(None, example="v=spf1"),
+    limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = Query(None),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
-    """Get the json representation of a whole dns zone using
-    axfr
+    """Get the json representation of a whole dns zone, served from the
+    zone cache, or the snapshot the workers share, kept current using ixfr
+
+    With format=ndjson the zone is instead streamed straight from an axfr,
+    one json record per line, without holding the zone in memory.
+    format=columnar gives parallel arrays of name, rrtype, ttl and response,
+    and format=text an RFC 1035 master file
+
+    Given any of rrtype, suffix (names at and below), prefix (of the name
+    relative to the zone), rdata (prefix of the record data), limit or
+    cursor, a page of matching records is returned instead, along with the
+    cursor for the next page
     """
     logger.debug("api key %s requested zone %s", api_key_name, zone_name)
 
     zone_name = qualify(zone_name)
 
-    if zone_name not in VALID_ZONES:
+    zone_name = backend.zones.get(zone_name)
+    if zone_name is None:
         raise HTTPException(400, "zone file not permitted")
 
-    zone = dns.zone.from_xfr(dns.query.xfr(DNS_SERVER, zone_name))
+    filters = (rrtype, suffix, prefix, rdata, limit, cursor)
+    if any(value is not None for value in filters):
+        if output_format != ZoneFormat.json:
+            raise HTTPException(400, "zone queries are only available as json")
+        return await query_zone(backend, zone_name, *filters)
 
-    result = {}
-    records = defaultdict(list)
-    for (name, ttl, rdata) in zone.iterate_rdatas():
-        if rdata.rdtype.name == "SOA":
-            result["SOA"] = {
-                "ttl": ttl,
-            }
-            for field_name in (
-                "expire",
-                "minimum",
-                "refresh",
-                "retry",
-                "rname",
-                "mname",
-                "serial",
-            ):
-                if field_name in ("rname", "mname"):
-                    result["SOA"][field_name] = str(getattr(rdata, field_name))
-                else:
-                    result["SOA"][field_name] = getattr(rdata, field_name)
-        else:
-            records[str(name)].append(
-                {
-                    "response": str(rdata),
-                    "rrtype": rdata.rdtype.name,
-                    "ttl": ttl,
-                }
-            )
-    result["records"] = records
+    if output_format == ZoneFormat.ndjson:
+        source = backend.monitor.choose(zone_name)
+        metrics.READS.labels(server_label(source), "stream").inc()
+        try:
+            await backend.transfers.acquire(wait=False)
+        except Overloaded as error:
+            raise too_many_requests(
+                "xfr", error, "too many zone transfers running"
+            ) from error
+        records = iterate_axfr(source.host, zone_name, port=source.port)
+        try:
+            # fail before the response starts if the transfer is refused
+            with span("xfr"):
+                first = await records.__anext__()
+        except Exception as error:
+            backend.transfers.release()
+            logger.debug(traceback.format_exc())
+            raise HTTPException(500, "DNS transfer failed - check logs") from error
+
+        async def all_records():
+            try:
+                yield first
+                async for record in records:
+                    yield record
+            finally:
+                try:
+                    # closes the transfer's socket
+                    await records.aclose()
+                finally:
+                    backend.transfers.release()
+
+        logger.debug(
+            "api key %s requested zone %s - streaming zone", api_key_name, zone_name
+        )
+        return ClosingStreamingResponse(
+            stream_zone(all_records()), media_type="application/x-ndjson"
+        )
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # one SOA query, rather than a transfer, tells if the client is current
+        try:
+            serial = await backend.zonecache.soa_serial(zone_name)
+        except Exception as error:
+            logger.debug(traceback.format_exc())
+            raise HTTPException(500, "DNS query failed - check logs") from error
+        if etag_matches(if_none_match, serial):
+            return Response(status_code=304, headers={"ETag": etag(serial)})
+
+    if backend.snapshots is not None:
+        snapshot = await backend.snapshots.get(zone_name)
+        serial = snapshot.serial
+        render = functools.partial(render_snapshot, snapshot, output_format.value)
+    else:
+        zone = await backend.zonecache.get(zone_name)
+        serial = zone_serial(zone)
+        render = functools.partial(render_zone, zone, serial, output_format.value)
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    with span("serialize"):
+        content = backend.zonebodies.get(
+            zone_name, serial, render, encoding, key=output_format.value
+        )
+    headers = {"ETag": etag(serial), "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
     logger.debug("api key %s requested zone %s - sending zone", api_key_name, zone_name)
-    return result
+    return Response(
+        content, media_type=MEDIA_TYPES[output_format.value], headers=headers
+    )
+
+
+async def query_zone(backend, zone_name, rrtype, suffix, prefix, rdata, limit, cursor):
+    """return one page of the records of a zone matching the filters"""
+    origin = dns.name.from_text(zone_name)
+    if suffix is not None:
+        try:
+            suffix = dns.name.from_text(suffix, origin)
+        except dns.exception.DNSException as error:
+            raise HTTPException(400, f"invalid suffix: {error}") from error
+        if not suffix.is_subdomain(origin):
+            raise HTTPException(400, "suffix is not in the zone")
+        suffix = suffix.relativize(origin)
+    try:
+        if cursor is None:
+            version = await current_zone(backend, zone_name)
+            view = backend.zoneviews.get(zone_name, version.serial, version.records)
+        else:
+            # later pages come from the zone version the first page did
+            view = backend.zoneviews.find(zone_name, cursor)
+        (records, next_cursor) = view.page(
+            limit or PAGE_SIZE,
+            cursor,
+            rdtype=None if rrtype is None else dns.rdatatype.from_text(rrtype.value),
+            suffix=suffix,
+            prefix=prefix,
+            rdata=rdata,
+        )
+    except CursorExpired as error:
+        raise HTTPException(410, str(error)) from error
+    except CursorError as error:
+        raise HTTPException(400, str(error)) from error
+    return {
+        "serial": view.serial,
+        "records": [record_json(*record) for record in records],
+        "next": next_cursor,
+    }
+
 
+def delta_json(delta):
+    """the json form of the changes between two serials"""
+    return {
+        "from": delta.start,
+        "serial": delta.serial,
+        "delete": [record_json(*record) for record in delta.deletes],
+        "add": [record_json(*record) for record in delta.adds],
+    }
+
+
+async def change_events(watcher, since):
+    """render the changes to a zone as server-sent events until the client
+    goes away, each event id being the serial the change led to
+    """
+    try:
+        while True:
+            changes = await watcher.wait(since, KEEPALIVE_INTERVAL)
+            if not changes:
+                yield ": keepalive\n\n"
+            for delta in changes:
+                yield (
+                    f"id: {delta.serial}\nevent: change\n"
+                    f"data: {json.dumps(delta_json(delta))}\n\n"
+                )
+                since = delta.serial
+    except ChangesExpired as error:
+        yield f"event: expired\ndata: {json.dumps(str(error))}\n\n"
+    finally:
+        watcher.release()
+
+
+@router.get("/dns/zone/{zone_name}/changes")
+async def get_zone_changes(
+    request: Request,
+    zone_name: str = Path(..., example="example.org."),
+    since: int = Query(None, ge=0, example=2024010101),
+    timeout: float = Query(30, gt=0, le=MAX_CHANGE_WAIT),
+    api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
+):
+    """Get the records deleted and added since the zone had serial since
 
-@app.get("/dns/record/{domain}")
+    With no changes yet the request waits up to timeout seconds for one,
+    then returns an empty list.  Without since the current serial is
+    returned straight away.  Asking with Accept: text/event-stream streams
+    the changes as server-sent events instead, resuming from since or the
+    Last-Event-ID header.  Serials whose changes are no longer kept get a
+    410, and the zone has to be read again.
+    """
+    zone_name = backend.zones.get(qualify(zone_name))
+    if zone_name is None:
+        raise HTTPException(400, "zone file not permitted")
+    logger.debug("api key %s watching zone %s", api_key_name, zone_name)
+
+    watcher = backend.changes.watcher(zone_name)
+    try:
+        await watcher.acquire()
+    except Exception as error:
+        logger.debug(traceback.format_exc())
+        raise HTTPException(500, "DNS transfer failed - check logs") from error
+
+    if "text/event-stream" in request.headers.get("accept", ""):
+        last_event = request.headers.get("last-event-id")
+        if since is None and last_event is not None and last_event.isdigit():
+            since = int(last_event)
+        # closing the events when the client goes away unsubscribes it
+        return ClosingStreamingResponse(
+            change_events(watcher, watcher.serial if since is None else since),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    try:
+        changes = [] if since is None else await watcher.wait(since, timeout)
+    except ChangesExpired as error:
+        raise HTTPException(410, str(error)) from error
+    finally:
+        watcher.release()
+    if changes:
+        since = changes[-1].serial
+    return {
+        "serial": watcher.serial if since is None else since,
+        "changes": [delta_json(delta) for delta in changes],
+    }
+
+
+@router.get("/dns/record/{domain}")
 async def get_record(
     domain: str = Path(..., example="server.example.org."),
     record_types: List[RecordType] = Query(list(RecordType)),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
     """return record from BIND server"""
     domain = qualify(domain)
@@ -176,187 +559,611 @@ async def get_record(
         record_types,
     )
 
-    if not domain.endswith(tuple(VALID_ZONES)):
+    zone = backend.zones.find(domain)
+    if zone is None:
         raise HTTPException(400, "domain not permitted")
+    source = backend.monitor.choose(zone)
+    resolver = backend.resolvers[source]
+    logger.debug("resolving %s with %s", domain, server_label(source))
 
-    records = defaultdict(list)
-    for record_type in record_types:
+    async def resolve(record_type):
+        metrics.READS.labels(server_label(source), "resolve").inc()
         try:
-            answers = await asyncresolver.resolve(domain, record_type)
+            with metrics.RESOLVE_DURATION.labels(record_type.value).time():
+                answers = await resolver.resolve(domain, record_type)
         except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            continue
-        records[record_type] = [str(x) for x in answers.rrset]
+            return None
+        return [str(x) for x in answers.rrset]
+
+    records = defaultdict(list)
+    with span("bind"):
+        answers = await asyncio.gather(*(resolve(x) for x in record_types))
+    for (record_type, answer) in zip(record_types, answers):
+        if answer is not None:
+            records[record_type] = answer
 
     return records
 
 
-async def dns_update_helper(domain: str = Path(..., example="server.example.org.")):
+def audit(action, domain, zone, rrtype, rdata, ttl, api_key_name, start, failed=False):
+    """write one audit record for a change made, or attempted, by an api key
+
+    The text audit log gets one line per change, and with AUDIT_LOG_FORMAT
+    json the same fields are written as a json object.
+    """
+    latency_ms = round((time.perf_counter() - start) * 1000, 3)
+    log = auditlogger.error if failed else auditlogger.info
+    log(
+        "%s%s %s %s %s %s for key %s",
+        "FAILED:" if failed else "",
+        action,
+        domain,
+        rrtype,
+        "-" if ttl is None else ttl,
+        "-" if rdata is None else rdata,
+        api_key_name,
+        extra={
+            "audit": {
+                "action": action,
+                "key": api_key_name,
+                "zone": zone,
+                "name": domain,
+                "rrtype": rrtype,
+                "rdata": rdata,
+                "ttl": ttl,
+                "result": "failed" if failed else "ok",
+                "latency_ms": latency_ms,
+            }
+        },
+    )
+
+
+@contextlib.contextmanager
+def audited(action, helper, rrtype, rdata, ttl, api_key_name):
+    """audit the change made in the with block, as failed if it raises"""
+    start = time.perf_counter()
+    args = (action, helper.domain, helper.zone, rrtype, rdata, ttl, api_key_name)
+    try:
+        yield
+    except:
+        audit(*args, start, failed=True)
+        raise
+    audit(*args, start)
+
+
+async def send_update(backend, zone, action, coalesce=True):
+    """send an update to BIND, merged with other updates to the same zone
+    when write coalescing is enabled
+
+    Updates with prerequisites of their own should pass coalesce=False, so
+    a failed prerequisite doesn't fail the update they would be merged into
+    and have every change in it sent again on its own.
+    """
+    rcode = "error"
+    try:
+        with metrics.UPDATE_DURATION.time():
+            if backend.coalescer is None or not coalesce:
+                response = await backend.tcpquery(action)
+            else:
+                response = await backend.coalescer.submit(zone, action)
+        rcode = dns.rcode.to_text(response.rcode())
+    finally:
+        metrics.UPDATES.labels(rcode).inc()
+    return response
+
+
+async def add_preconditions(backend, helper, record):
+    """add the preconditions of a record change to its update as
+    prerequisites
+    """
+    conditions = record.preconditions
+    name = dns.name.from_text(helper.domain)
+    if conditions.exists is True:
+        helper.action.present(name)
+    elif conditions.exists is False:
+        helper.action.absent(name)
+    if conditions.rrset:
+        helper.action.present(name, record.rrtype.value, *conditions.rrset)
+    elif conditions.rrset is not None:
+        helper.action.absent(name, record.rrtype.value)
+    if conditions.serial is not None:
+        # an SOA prerequisite has to match the whole record
+        soa = await backend.zonecache.soa(helper.zone)
+        helper.action.present(
+            dns.name.from_text(helper.zone), soa.replace(serial=conditions.serial)
+        )
+
+
+async def current_value(backend, helper, rrtype):
+    """what failed preconditions are checked against: whether the name
+    exists, its records of rrtype and the zone's SOA serial, or None if
+    they cannot be read
+    """
+    name = dns.name.from_text(helper.domain)
+    rdtype = dns.rdatatype.from_text(rrtype)
+    try:
+        # ask the primary, which checked the preconditions
+        response = await backend.tcpquery(dns.message.make_query(name, rdtype))
+        serial = await backend.zonecache.soa_serial(helper.zone)
+    except Exception:  # pylint: disable=broad-except
+        logger.debug(traceback.format_exc())
+        return None
+    rrset = response.get_rrset(response.answer, name, dns.rdataclass.IN, rdtype)
+    return {
+        "exists": response.rcode() != dns.rcode.NXDOMAIN,
+        "rrset": [str(rdata) for rdata in rrset or ()],
+        "serial": serial,
+    }
+
+
+async def send_record_change(backend, helper, record):
+    """send the update for a single record change, with the record's
+    preconditions checked atomically as its prerequisites
+
+    Raises a 412 with the current value if a precondition did not hold.
+    """
+    conditional = record.preconditions is not None
+    try:
+        if conditional:
+            await add_preconditions(backend, helper, record)
+        # prerequisites must not fail, or be failed by, merged changes
+        response = await send_update(
+            backend, helper.zone, helper.action, coalesce=not conditional
+        )
+    except Exception as error:
+        logger.debug(traceback.format_exc())
+        raise HTTPException(500, "DNS transaction failed - check logs") from error
+    if conditional and response.rcode() in PREREQUISITE_RCODES:
+        raise HTTPException(
+            412,
+            {
+                "message": "precondition failed: "
+                + dns.rcode.to_text(response.rcode()),
+                "current": await current_value(backend, helper, record.rrtype.value),
+            },
+        )
+
+
+async def dns_update_helper(
+    domain: str = Path(..., example="server.example.org."),
+    backend: Backend = Depends(get_backend),
+):
     """validate a zone and update if allowed, raise exception if not"""
-    domain = qualify(domain)
+    with span("helper"):
+        domain = qualify(domain)
 
-    for valid_zone in VALID_ZONES:
-        if domain.endswith(valid_zone):
-            action = dns.update.Update(valid_zone, keyring=TSIG)
-            return HelperResponse(domain=domain, action=action, zone=valid_zone)
-    raise HTTPException(400, "domain zone not permitted")
+        valid_zone = backend.zones.find(domain)
+        if valid_zone is None:
+            raise HTTPException(400, "domain zone not permitted")
+        action = dns.update.Update(valid_zone, keyring=backend.tsig)
+        return HelperResponse(domain=domain, action=action, zone=valid_zone)
 
 
-@app.post("/dns/record/{domain}")
+@router.post("/dns/record/{domain}")
 async def create_record(
-    record: Record,
+    record: RecordChange,
     helper: HelperResponse = Depends(dns_update_helper),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
     """create a new domain entry"""
-    try:
+    with audited(
+        "CREATE", helper, record.rrtype.value, record.response, record.ttl, api_key_name
+    ):
         helper.action.add(
             dns.name.from_text(helper.domain),
             record.ttl,
             record.rrtype,
             record.response,
         )
-        try:
-            await tcpquery(helper.action)
-        except Exception as error:
-            logger.debug(traceback.format_exc())
-            raise HTTPException(500, "DNS transaction failed - check logs") from error
-
-        auditlogger.info(
-            "CREATE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
-        )
-    except:
-        auditlogger.error(
-            "FAILED:CREATE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
-        )
-        raise
+        await send_record_change(backend, helper, record)
+        backend.changed(helper.zone)
 
 
-@app.put("/dns/record/{domain}")
+@router.put("/dns/record/{domain}")
 async def replace_record(
-    record: Record,
+    record: RecordChange,
     helper: HelperResponse = Depends(dns_update_helper),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
     """update an existing record"""
-    try:
+    with audited(
+        "REPLACE",
+        helper,
+        record.rrtype.value,
+        record.response,
+        record.ttl,
+        api_key_name,
+    ):
         helper.action.replace(
             dns.name.from_text(helper.domain),
             record.ttl,
             record.rrtype,
             record.response,
         )
-        try:
-            await tcpquery(helper.action)
-        except Exception as error:
-            logger.debug(traceback.format_exc())
-            raise HTTPException(500, "DNS transaction failed - check logs") from error
-        auditlogger.info(
-            "REPLACE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
-        )
-    except:
-        auditlogger.info(
-            "FAILED:REPLACE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
-        )
-        raise
+        await send_record_change(backend, helper, record)
+        backend.changed(helper.zone)
 
 
-@app.delete("/dns/record/{domain}")
+@router.delete("/dns/record/{domain}")
 async def delete_single_record(
-    record: Record,
+    record: RecordChange,
     helper: HelperResponse = Depends(dns_update_helper),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
     """delete a dns record"""
-    try:
+    with audited(
+        "DELETE", helper, record.rrtype.value, record.response, None, api_key_name
+    ):
         helper.action.delete(
             dns.name.from_text(helper.domain), record.rrtype, record.response
         )
+        await send_record_change(backend, helper, record)
+        backend.changed(helper.zone)
+
+
+async def change_acme_challenge(action, challenge, helper, api_key_name, backend):
+    """add or delete an ACME challenge TXT record and, if asked to, wait
+    for every nameserver of the zone to serve the change
+    """
+    name = dns.name.from_text(helper.domain)
+    if name.labels[0].lower() != ACME_LABEL:
+        raise HTTPException(400, "not an _acme-challenge name")
+    value = f'"{challenge.value}"'
+    ttl = ACME_TTL if action == "CREATE" else None
+    with audited(action, helper, "TXT", value, ttl, api_key_name):
+        if action == "CREATE":
+            helper.action.add(name, ACME_TTL, "TXT", value)
+        else:
+            helper.action.delete(name, "TXT", value)
         try:
-            await tcpquery(helper.action)
+            response = await send_update(backend, helper.zone, helper.action)
         except Exception as error:
             logger.debug(traceback.format_exc())
             raise HTTPException(500, "DNS transaction failed - check logs") from error
-        auditlogger.info(
-            "DELETE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
-        )
-    except:
-        auditlogger.info(
-            "FAILED:DELETE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            record.rrtype,
-            api_key_name,
-            helper.domain,
-            record,
-            api_key_name,
+        if response.rcode() != dns.rcode.NOERROR:
+            raise HTTPException(
+                500, f"DNS update refused: {dns.rcode.to_text(response.rcode())}"
+            )
+        backend.changed(helper.zone)
+    result = {"name": helper.domain, "zone": helper.zone}
+    if not challenge.wait:
+        return result
+    try:
+        serial = await backend.zonecache.soa_serial(helper.zone)
+        (propagated, serials) = await backend.propagation.wait(
+            helper.zone, serial, challenge.timeout
         )
-        raise
+    except dns.exception.DNSException as error:
+        logger.debug(traceback.format_exc())
+        raise HTTPException(500, "DNS query failed - check logs") from error
+    result.update(
+        serial=serial,
+        propagated=propagated,
+        nameservers=[
+            {"name": server.name, "address": server.address, "serial": found}
+            for (server, found) in serials.items()
+        ],
+    )
+    if not propagated:
+        logger.debug("%s did not reach every nameserver: %s", helper.domain, result)
+        raise HTTPException(504, result)
+    return result
 
 
-@app.delete("/dns/allrecords/{domain}")
+@router.post("/dns/acme/{domain}")
+async def add_acme_challenge(
+    challenge: AcmeChallenge,
+    helper: HelperResponse = Depends(dns_update_helper),
+    api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
+):
+    """add an ACME DNS-01 challenge TXT record, by default answering only
+    once every authoritative nameserver of the zone serves it
+    """
+    return await change_acme_challenge(
+        "CREATE", challenge, helper, api_key_name, backend
+    )
+
+
+@router.delete("/dns/acme/{domain}")
+async def remove_acme_challenge(
+    challenge: AcmeChallenge,
+    helper: HelperResponse = Depends(dns_update_helper),
+    api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
+):
+    """delete an ACME DNS-01 challenge TXT record"""
+    return await change_acme_challenge(
+        "DELETE", challenge, helper, api_key_name, backend
+    )
+
+
+@router.delete("/dns/allrecords/{domain}")
 async def delete_record_type(
     recordtypes: List[RecordType] = Query(list(RecordType)),
     helper: HelperResponse = Depends(dns_update_helper),
     api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
 ):
     """delete all of record type"""
-    try:
+    with audited("DELETE", helper, ",".join(recordtypes), None, None, api_key_name):
         for rtype in recordtypes:
             logger.debug("deleteing %s type %s", helper.domain, rtype)
             helper.action.delete(dns.name.from_text(helper.domain), rtype)
-            try:
-                await tcpquery(helper.action)
-            except Exception as error:
-                logger.debug(traceback.format_exc())
-                raise HTTPException(
-                    500, "DNS transaction failed - check logs"
-                ) from error
-        auditlogger.info(
-            "DELETE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            ",".join(recordtypes),
-            api_key_name,
-            helper.domain,
-            recordtypes,
+        try:
+            await send_update(backend, helper.zone, helper.action)
+        except Exception as error:
+            logger.debug(traceback.format_exc())
+            raise HTTPException(500, "DNS transaction failed - check logs") from error
+        backend.changed(helper.zone)
+
+
+def apply_operation(action, domain, operation):
+    """add a batch operation to a dns.update.Update"""
+    record = operation.record
+    name = dns.name.from_text(domain)
+    if operation.action == BatchAction.delete:
+        action.delete(name, record.rrtype, record.response)
+    elif operation.action == BatchAction.replace:
+        action.replace(name, record.ttl, record.rrtype, record.response)
+    else:
+        action.add(name, record.ttl, record.rrtype, record.response)
+
+
+async def send_zone_batch(backend, zone, operations, api_key_name):
+    """send the operations for one zone as a single update, returning the
+    per-operation results
+    """
+    start = time.perf_counter()
+    rcode = None
+    try:
+        action = dns.update.Update(zone, keyring=backend.tsig)
+        for (domain, operation) in operations:
+            apply_operation(action, domain, operation)
+        response = await send_update(backend, zone, action)
+        rcode = dns.rcode.to_text(response.rcode())
+    except Exception:  # pylint: disable=broad-except
+        logger.debug(traceback.format_exc())
+    success = rcode == "NOERROR"
+    if success:
+        backend.changed(zone)
+
+    results = []
+    for (domain, operation) in operations:
+        record = operation.record
+        audit(
+            AUDIT_VERBS[operation.action],
+            domain,
+            zone,
+            record.rrtype.value,
+            record.response,
+            record.ttl if operation.action != BatchAction.delete else None,
             api_key_name,
+            start,
+            failed=not success,
         )
-    except:
-        auditlogger.info(
-            "FAILED:DELETE %s %s %s -> %s record %s for key %s",
-            helper.domain,
-            ",".join(recordtypes),
-            api_key_name,
-            helper.domain,
-            recordtypes,
+        results.append(
+            {
+                "action": operation.action,
+                "domain": domain,
+                "zone": zone,
+                "status": "ok" if success else "failed",
+                "rcode": rcode,
+            }
+        )
+    return results
+
+
+async def batch_zones(
+    operations: List[BatchOperation],
+    key: KeyEntry = Depends(authenticate),
+    backend: Backend = Depends(get_backend),
+) -> Batch:
+    """group the operations of a batch by zone, checking the secret sent
+    may change each of the zones
+    """
+    zones = defaultdict(list)
+    order = []
+    for operation in operations:
+        domain = qualify(operation.domain)
+        zone = backend.zones.find(domain)
+        if zone is None:
+            raise HTTPException(400, f"domain zone not permitted: {domain}")
+        if not key.permits(zone):
+            metrics.AUTH_FAILURES.labels("zone").inc()
+            raise HTTPException(403, f"zone not permitted for this api key: {zone}")
+        zones[zone].append((domain, operation))
+        order.append((zone, len(zones[zone]) - 1))
+    logger.debug(
+        "api key %s sent batch of %d operations for zones %s",
+        key.name,
+        len(operations),
+        list(zones),
+    )
+    return Batch(zones, order)
+
+
+@router.post("/dns/batch")
+async def batch_update(
+    batch: Batch = Depends(batch_zones),
+    api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
+):
+    """apply many record changes at once, sending one atomic update per zone"""
+    zone_results = dict(
+        zip(
+            batch.zones,
+            await asyncio.gather(
+                *(
+                    send_zone_batch(backend, zone, zone_operations, api_key_name)
+                    for (zone, zone_operations) in batch.zones.items()
+                )
+            ),
+        )
+    )
+    return {"results": [zone_results[zone][index] for (zone, index) in batch.order]}
+
+
+def describe_change(change):
+    """a zone sync change in the form get_zone uses for records"""
+    return {
+        "action": change.action,
+        "name": str(change.name),
+        "response": str(change.rdata),
+        "rrtype": dns.rdatatype.to_text(change.rdtype),
+        "ttl": change.ttl,
+    }
+
+
+def audit_changes(origin, changes, api_key_name, start, failed=False):
+    """audit each change made, or attempted, by a zone sync"""
+    for change in changes:
+        audit(
+            "CREATE" if change.action == "add" else "DELETE",
+            change.name.derelativize(origin).to_text(),
+            origin.to_text(),
+            dns.rdatatype.to_text(change.rdtype),
+            change.rdata.to_text(origin=origin, relativize=False),
+            change.ttl if change.action == "add" else None,
             api_key_name,
+            start,
+            failed=failed,
         )
-        raise
+
+
+@router.put("/dns/zone/{zone_name}/records")
+async def sync_zone(
+    desired: ZoneRecords,
+    zone_name: str = Path(..., example="example.org."),
+    subtree: str = Query(None, example="k8s.example.org."),
+    dry_run: bool = Query(False),
+    api_key_name: APIKey = Depends(check_api_key),
+    backend: Backend = Depends(get_backend),
+):
+    """Make a zone, or the names at and below subtree, hold exactly the
+    given records, returning the changes
+
+    The changes are worked out against the current zone and sent as one
+    update that only applies if the zone serial has not moved on, and are
+    worked out again if it has.  The SOA and the zone's own NS records are
+    never changed.  With dry_run the changes are returned but not made.
+    """
+    zone_name = backend.zones.get(qualify(zone_name))
+    if zone_name is None:
+        raise HTTPException(400, "zone file not permitted")
+    origin = dns.name.from_text(zone_name)
+    try:
+        scope = None
+        if subtree is not None:
+            scope = dns.name.from_text(subtree, origin)
+            if not scope.is_subdomain(origin):
+                raise ValueError(f"{scope} is not in zone {origin}")
+            scope = scope.relativize(origin)
+        wanted = desired_rrsets(origin, desired.records, SYNC_TYPES, scope)
+    except (ValueError, dns.exception.DNSException) as error:
+        raise HTTPException(400, str(error)) from error
+
+    for attempt in range(1, SYNC_ATTEMPTS + 1):
+        start = time.perf_counter()
+        try:
+            # check the serial with BIND rather than trust a cached zone
+            version = await current_zone(backend, zone_name, check=True)
+        except Exception as error:
+            logger.debug(traceback.format_exc())
+            raise HTTPException(500, "DNS transfer failed - check logs") from error
+        changes = diff_rrsets(
+            current_rrsets(version.records(), SYNC_TYPES, scope), wanted
+        )
+        result = {
+            "zone": zone_name,
+            "serial": version.serial,
+            "dry_run": dry_run,
+            "applied": False,
+            "changes": [describe_change(change) for change in changes],
+        }
+        if dry_run or not changes:
+            return result
+        update = build_update(origin, version.soa, changes, backend.tsig)
+        try:
+            response = await send_update(backend, zone_name, update, coalesce=False)
+        except Exception as error:
+            logger.debug(traceback.format_exc())
+            audit_changes(origin, changes, api_key_name, start, failed=True)
+            raise HTTPException(500, "DNS transaction failed - check logs") from error
+        if response.rcode() == dns.rcode.NXRRSET:
+            logger.debug(
+                "zone %s moved on from serial %s during sync attempt %d",
+                zone_name,
+                result["serial"],
+                attempt,
+            )
+            continue
+        if response.rcode() != dns.rcode.NOERROR:
+            audit_changes(origin, changes, api_key_name, start, failed=True)
+            raise HTTPException(
+                500, f"DNS update refused: {dns.rcode.to_text(response.rcode())}"
+            )
+        audit_changes(origin, changes, api_key_name, start)
+        backend.changed(zone_name)
+        result["applied"] = True
+        return result
+    raise HTTPException(409, "zone kept changing during the sync, try again")
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics for every worker"""
+    (body, content_type) = metrics.render()
+    return Response(body, media_type=content_type)
+
+
+def create_app(settings: Settings = None) -> FastAPI:
+    """Build the api app, reading Settings from the environment if none are
+    given
+
+    Logging, the api keys and the connections to BIND are set up by the
+    app lifespan, when a server starts the app, and torn down again when
+    it stops.
+    """
+    if settings is None:
+        settings = Settings()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        listener = setup_logging(
+            settings.logging_dir,
+            settings.logging_application_name,
+            settings.audit_log_format,
+        )
+        logger.debug("starting up")
+        app.state.backend = Backend(settings)
+        await app.state.backend.start()
+        try:
+            yield
+        finally:
+            await app.state.backend.close()
+            metrics.worker_stopped()
+            logger.debug("shutting down")
+            stop_logging(listener)
+
+    app = FastAPI(title="bind-rest-api", version=VERSION)
+    app.router.lifespan_context = lifespan
+    app.add_middleware(metrics.MetricsMiddleware)
+    if settings.server_timing:
+        app.add_middleware(TimingMiddleware, profile_dir=settings.logging_dir)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name):
+    """build api.app from the environment the first time it is used, for
+    servers given bind_rest_api.api.api:app
+    """
+    if name == "app":
+        global app  # pylint: disable=global-variable-undefined
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
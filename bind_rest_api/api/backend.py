@@ -0,0 +1,161 @@
+""" The connections to BIND and the caches shared by the api handlers """
+import os
+import dns.asyncresolver
+import dns.tsigkeyring
+from .answercache import AnswerCache
+from .changefeed import ChangeFeed
+from .coalesce import WriteCoalescer
+from .idempotency import IdempotencyStore, SharedIdempotencyStore
+from .keystore import KeyStore
+from .pool import ConnectionPool
+from .propagation import PropagationChecker
+from .ratelimit import RateLimiter, TransferSlots
+from .servers import ServerMonitor
+from .shared import ZoneGenerations
+from .zonecache import ZoneCache
+from .zonebody import BODIES_DIR, ZoneBodies
+from .zoneindex import ZoneIndex
+from .zonequery import ZoneViews
+from .zonesnapshot import SharedZones
+
+
+class Backend:
+    """Everything the handlers need to talk to BIND, built from Settings
+
+    One is created by the app lifespan in each worker, so the key file is
+    read and connections to BIND are made when the app starts rather than
+    when the module is imported.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        # writes go to the primary, reads to a current secondary when there is one
+        (self.primary, *secondaries) = settings.servers
+        (self.server, self.port) = self.primary
+        self.tsig = dns.tsigkeyring.from_text(
+            {settings.tsig_username: settings.tsig_password}
+        )
+        self.zones = ZoneIndex(settings.allowed_zones)
+        # writes through any worker, counted per zone
+        self.generations = ZoneGenerations(
+            settings.allowed_zones, settings.worker_state_dir
+        )
+        self.keys = KeyStore(
+            settings.api_key_file, interval=settings.api_key_reload_interval
+        )
+        self.monitor = ServerMonitor(
+            self.primary,
+            secondaries,
+            settings.allowed_zones,
+            interval=settings.bind_check_interval,
+            generations=self.generations,
+            directory=settings.worker_state_dir,
+        )
+        cache = None
+        if settings.answer_cache_size:
+            # honours record TTLs and caches NXDOMAIN/NoAnswer using the SOA minimum
+            cache = AnswerCache(
+                settings.answer_cache_size, self.zones, self.generations
+            )
+        # one resolver per server, all sharing the answer cache
+        self.resolvers = {}
+        for server in settings.servers:
+            resolver = dns.asyncresolver.Resolver(configure=False)
+            resolver.nameservers = [server.host]
+            resolver.port = server.port
+            resolver.cache = cache
+            self.resolvers[server] = resolver
+        self.resolver = self.resolvers[self.primary]
+        self.propagation = PropagationChecker(self.resolver)
+        self.pool = ConnectionPool(
+            self.server,
+            port=self.port,
+            size=settings.bind_pool_size,
+            idle_timeout=settings.bind_pool_idle_timeout,
+        )
+        self.tcpquery = self.pool.query
+        # the limits hold across all the workers sharing worker_state_dir
+        self.limiter = RateLimiter(
+            settings.rate_limits,
+            max_wait=settings.rate_limit_wait,
+            directory=settings.worker_state_dir,
+        )
+        self.transfers = TransferSlots(
+            settings.max_concurrent_xfr,
+            max_wait=settings.rate_limit_wait,
+            directory=settings.worker_state_dir,
+        )
+        self.zonecache = ZoneCache(
+            self.server,
+            port=self.port,
+            max_age=settings.zone_cache_max_age,
+            query=self.pool.query,
+            select=self.monitor.choose,
+            slots=self.transfers,
+        )
+        self.snapshots = None
+        self.zonebodies = ZoneBodies()
+        if settings.zone_snapshot_dir:
+            # one worker transfers the zones and the others map its snapshots
+            self.snapshots = SharedZones(
+                settings.zone_snapshot_dir,
+                self.zonecache,
+                max_age=settings.zone_cache_max_age,
+            )
+            self.zonebodies = ZoneBodies(
+                os.path.join(settings.zone_snapshot_dir, BODIES_DIR)
+            )
+        self.zoneviews = ZoneViews()
+        self.changes = ChangeFeed(
+            self.snapshots or self.zonecache,
+            interval=settings.change_poll_interval,
+            keep=settings.change_journal_size,
+        )
+        self.idempotency = None
+        if settings.idempotency_max_keys and settings.worker_state_dir:
+            # a retry may reach a different worker than the first attempt
+            self.idempotency = SharedIdempotencyStore(
+                settings.worker_state_dir,
+                settings.idempotency_max_keys,
+                ttl=settings.idempotency_ttl,
+            )
+        elif settings.idempotency_max_keys:
+            self.idempotency = IdempotencyStore(
+                settings.idempotency_max_keys, ttl=settings.idempotency_ttl
+            )
+        self.coalescer = None
+        if settings.write_coalesce_window:
+            self.coalescer = WriteCoalescer(
+                self.pool.query,
+                self.tsig,
+                window=settings.write_coalesce_window,
+                max_batch=settings.write_coalesce_max,
+            )
+
+    def changed(self, zone_name):
+        """note a write to a zone, so reads through every worker see it"""
+        self.generations.bump(zone_name)
+        self.zonecache.invalidate(zone_name)
+        if self.snapshots is not None:
+            self.snapshots.invalidate(zone_name)
+
+    async def start(self):
+        """start managing the pooled connections to BIND and checking the
+        secondaries
+        """
+        await self.pool.start()
+        await self.monitor.start()
+
+    async def close(self):
+        """stop watching zones and servers, hand over publishing snapshots
+        and close the pooled connections to BIND
+        """
+        await self.changes.close()
+        if self.snapshots is not None:
+            await self.snapshots.close()
+        await self.monitor.close()
+        await self.pool.close()
+        self.limiter.close()
+        if self.idempotency is not None:
+            self.idempotency.close()
+        self.generations.close()
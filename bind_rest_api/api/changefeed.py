@@ -0,0 +1,197 @@
+""" Feeds of the changes made to zones, worked out by one watcher per zone """
+import asyncio
+import logging
+from collections import deque, namedtuple
+import dns.exception
+from .metrics import CHANGE_SUBSCRIBERS
+from .timing import background_task
+from .zonequery import name_key
+
+logger = logging.getLogger("bind-api")
+
+# the (name, ttl, rdata) records deleted and added going from serial start
+Delta = namedtuple("Delta", "start serial deletes adds")
+
+
+class ChangesExpired(Exception):
+    """the changes since a serial are no longer kept"""
+
+
+def record_order(record):
+    """sort key for (name, ttl, rdata) records"""
+    (name, _, rdata) = record
+    return (name_key(name), rdata.rdtype, rdata.to_text())
+
+
+class ZoneWatcher:
+    """Follows the SOA serial of one zone for all of its subscribers
+
+    While anyone is subscribed the watcher checks the serial every
+    *interval* seconds through the zone cache, which brings the cached
+    zone forward with IXFR when it moved and hands the watcher the records
+    the transfer deleted and added.  With snapshots shared by the workers,
+    *zonecache* is the SharedZones instead, and the changes come from
+    comparing the new snapshot with the last one.  These are journalled, keeping the
+    last *keep* deltas, so a change costs the size of the change rather
+    than of the zone.  However many clients subscribe, BIND only sees the
+    one SOA query per interval and one IXFR per change.
+
+    The first check after the last subscriber leaves stops the watcher,
+    drops its journal and calls *on_idle*, so a long-polling client that
+    comes straight back for more keeps its place.
+    """
+
+    def __init__(self, zone_name, zonecache, interval=1.0, keep=100, on_idle=None):
+        self.zone_name = zone_name
+        self.zonecache = zonecache
+        self.interval = interval
+        self.on_idle = on_idle
+        self.serial = None
+        self.journal = deque(maxlen=keep)
+        self.subscribers = 0
+        self._listening = False
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def _transferred(self, start, serial, deletes, adds):
+        """journal the records a transfer of the zone deleted and added"""
+        self.journal.append(
+            Delta(
+                start,
+                serial,
+                sorted(deletes, key=record_order),
+                sorted(adds, key=record_order),
+            )
+        )
+        logger.debug("zone %s changed from %s to %s", self.zone_name, start, serial)
+        self._moved(serial)
+
+    def _moved(self, serial):
+        self.serial = serial
+        (changed, self._changed) = (self._changed, asyncio.Event())
+        changed.set()
+
+    async def poll(self):
+        """check the serial of the zone and journal any change"""
+        if not self._listening:
+            self.zonecache.listen(self.zone_name, self._transferred)
+            self._listening = True
+        self.zonecache.invalidate(self.zone_name)
+        serial = await self.zonecache.current_serial(self.zone_name)
+        if serial != self.serial:
+            # the first poll, which has nothing to compare with
+            self._moved(serial)
+
+    def changes_since(self, since):
+        """the deltas after serial since, oldest first
+
+        Raises ChangesExpired if since is neither the current serial nor
+        the start of a journalled delta.
+        """
+        if since == self.serial:
+            return []
+        for (position, delta) in enumerate(self.journal):
+            if delta.start == since:
+                return list(self.journal)[position:]
+        raise ChangesExpired(f"changes to {self.zone_name} since {since} are not kept")
+
+    async def wait(self, since, timeout):
+        """the deltas after serial since, waiting up to timeout seconds for
+        the zone to change if there are none yet
+        """
+        try:
+            changes = self.changes_since(since)
+        except ChangesExpired:
+            # the client may have seen a serial the last poll had not
+            await self.poll()
+            changes = self.changes_since(since)
+        if changes:
+            return changes
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return self.changes_since(since)
+
+    async def acquire(self):
+        """subscribe, reading the zone first if it is not being watched"""
+        if self._task is None:
+            try:
+                await self.poll()
+            except BaseException:
+                if self._task is None and not self.subscribers:
+                    self._stop()
+                raise
+        self.subscribers += 1
+        CHANGE_SUBSCRIBERS.inc()
+        if self._task is None:
+            self._task = background_task(self._watch())
+
+    def release(self):
+        """unsubscribe, the watcher stops after its last subscriber leaves"""
+        self.subscribers -= 1
+        CHANGE_SUBSCRIBERS.dec()
+
+    async def _watch(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                if not self.subscribers:
+                    break
+                try:
+                    await self.poll()
+                except (dns.exception.DNSException, EOFError, OSError) as error:
+                    logger.debug("watching zone %s failed: %s", self.zone_name, error)
+        finally:
+            self._task = None
+            if not self.subscribers:
+                self._stop()
+
+    def _stop(self):
+        """stop following the zone and forget its changes"""
+        if self._listening:
+            self.zonecache.unlisten(self.zone_name, self._transferred)
+            self._listening = False
+        self.serial = None
+        self.journal.clear()
+        if self.on_idle is not None:
+            self.on_idle(self)
+
+    async def close(self):
+        """stop watching"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class ChangeFeed:
+    """The zone watchers of one process, created on first subscription and
+    dropped once the last subscriber has left
+    """
+
+    def __init__(self, zonecache, interval=1.0, keep=100):
+        self.zonecache = zonecache
+        self.interval = interval
+        self.keep = keep
+        self._watchers = {}
+
+    def watcher(self, zone_name):
+        """the watcher of a zone"""
+        if zone_name not in self._watchers:
+            self._watchers[zone_name] = ZoneWatcher(
+                zone_name,
+                self.zonecache,
+                interval=self.interval,
+                keep=self.keep,
+                on_idle=self._idle,
+            )
+        return self._watchers[zone_name]
+
+    def _idle(self, watcher):
+        if self._watchers.get(watcher.zone_name) is watcher:
+            del self._watchers[watcher.zone_name]
+
+    async def close(self):
+        """stop all the watchers"""
+        for watcher in list(self._watchers.values()):
+            await watcher.close()
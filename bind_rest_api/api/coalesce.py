@@ -0,0 +1,99 @@
+""" Merge concurrent updates to the same zone into one DNS UPDATE """
+import asyncio
+import logging
+from collections import Counter
+import dns.rcode
+import dns.update
+from .metrics import UPDATE_BATCH_SIZE
+from .timing import background_task
+
+
+logger = logging.getLogger("bind-api")
+
+
+class WriteCoalescer:
+    """Collects updates per zone and sends them together
+
+    Updates submitted for a zone within *window* seconds of the first one,
+    or until *max_batch* have been collected, are merged into a single
+    dns.update.Update.  Every caller gets the response (or the exception)
+    for the merged message, so each can still audit its own change.
+
+    BIND applies all of an UPDATE or none of it, so one change with a bad
+    record or a failed prerequisite fails the merged message.  When it does,
+    each change is sent again on its own and each caller gets the response
+    to its own change.
+    """
+
+    def __init__(self, send, keyring, window=0.01, max_batch=50):
+        self.send = send
+        self.keyring = keyring
+        self.window = window
+        self.max_batch = max_batch
+        # number of merged messages sent, keyed by how many updates they held
+        self.batch_sizes = Counter()
+        self._pending = {}
+        self._timers = {}
+        # the sends running, so they are not garbage collected mid-flight
+        self._tasks = set()
+
+    async def submit(self, zone, action):
+        """queue the update section of action and wait for the response"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(zone, [])
+        pending.append((action, future))
+        if len(pending) >= self.max_batch:
+            self._flush(zone)
+        elif len(pending) == 1:
+            self._timers[zone] = loop.call_later(self.window, self._flush, zone)
+        return await future
+
+    def _flush(self, zone):
+        timer = self._timers.pop(zone, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(zone, [])
+        if batch:
+            task = background_task(self._send(zone, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, zone, batch):
+        merged = dns.update.Update(zone, keyring=self.keyring)
+        for (action, _) in batch:
+            merged.prerequisite.extend(action.prerequisite)
+            merged.update.extend(action.update)
+        self.batch_sizes[len(batch)] += 1
+        UPDATE_BATCH_SIZE.observe(len(batch))
+        logger.debug("sending %d coalesced updates for zone %s", len(batch), zone)
+        try:
+            response = await self.send(merged)
+        except Exception as error:  # pylint: disable=broad-except
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        if response.rcode() != dns.rcode.NOERROR and len(batch) > 1:
+            logger.debug(
+                "coalesced update for zone %s failed with %s, sending each alone",
+                zone,
+                dns.rcode.to_text(response.rcode()),
+            )
+            await asyncio.gather(
+                *(self._send_alone(action, future) for (action, future) in batch)
+            )
+            return
+        for (_, future) in batch:
+            if not future.done():
+                future.set_result(response)
+
+    async def _send_alone(self, action, future):
+        try:
+            response = await self.send(action)
+        except Exception as error:  # pylint: disable=broad-except
+            if not future.done():
+                future.set_exception(error)
+            return
+        if not future.done():
+            future.set_result(response)
@@ -0,0 +1,310 @@
+""" Idempotency keys for the write endpoints, so retried writes are applied once
+
+A client that sends a write with an Idempotency-Key header and retries it
+with the same key gets the outcome of the first attempt back, without the
+write reaching BIND or the audit log again.  A retry that arrives while the
+first attempt is still running waits for it rather than racing it.
+
+The stored outcome is looked up once the request's dependencies have run,
+so a retry is authenticated, checked against the zones its api key may
+change and counted against its rate limit like the first attempt was.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import functools
+import contextvars
+from collections import OrderedDict, namedtuple
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from .keystore import hash_secret
+from .metrics import IDEMPOTENT_REPLAYS, process_alive
+from .shared import open_database, transaction
+from .timing import TimedRoute
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = "idempotent-replayed"
+WRITE_METHODS = frozenset(["POST", "PUT", "DELETE", "PATCH"])
+# seconds between checks on a first attempt running in another worker
+POLL_INTERVAL = 0.05
+# how many outcomes SharedIdempotencyStore adds between trims to max_keys
+TRIM_EVERY = 100
+
+# the first attempt's return value, or the status, detail and headers of
+# the HTTPException it raised, and a digest of its request
+Outcome = namedtuple("Outcome", "digest expires value error")
+
+# the idempotency key and digest of the write request being handled, and
+# whether its outcome was replayed
+_attempt = contextvars.ContextVar("idempotent_attempt", default=None)
+
+
+class Attempt:
+    """A write request sent with an idempotency key"""
+
+    def __init__(self, store, key, digest):
+        self.store = store
+        self.key = key
+        self.digest = digest
+        self.replayed = False
+
+
+class KeyReused(Exception):
+    """an idempotency key sent again with a different request"""
+
+
+def request_digest(request, body):
+    """a digest of the method, path, query and body of a request"""
+    digest = hashlib.sha256()
+    for part in (request.method, request.url.path, request.url.query):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def storable(status):
+    """is an outcome final, rather than something a retry might change"""
+    return status < 500 and status != 429
+
+
+def error_outcome(error):
+    """the stored form of an HTTPException"""
+    return [error.status_code, jsonable_encoder(error.detail), error.headers]
+
+
+def replay(outcome):
+    """the return value of a stored outcome, or raise its HTTPException"""
+    IDEMPOTENT_REPLAYS.inc()
+    if outcome.error is not None:
+        (status, detail, headers) = outcome.error
+        raise HTTPException(
+            status, detail, dict(headers or {}, **{REPLAYED_HEADER: "true"})
+        )
+    return outcome.value
+
+
+class IdempotencyStore:
+    """The outcomes of writes sent with an idempotency key, kept in memory
+
+    Outcomes are kept for *ttl* seconds, and only the latest *max_keys*.
+    Server errors and 429s are not kept, so a retry of those runs the
+    write again.  This is for a single worker; workers sharing a directory
+    use SharedIdempotencyStore.
+    """
+
+    def __init__(self, max_keys=10000, ttl=3600.0):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._outcomes = OrderedDict()
+        self._running = {}
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        # outcomes are kept in the order they expire
+        while self._outcomes:
+            (oldest, outcome) = next(iter(self._outcomes.items()))
+            if outcome.expires > now:
+                break
+            del self._outcomes[oldest]
+        return self._outcomes.get(key)
+
+    def _keep(self, key, outcome):
+        self._outcomes[key] = outcome
+        while len(self._outcomes) > self.max_keys:
+            self._outcomes.popitem(last=False)
+
+    async def run(self, key, digest, call):
+        """return (replayed, value), value being what call() returns, or
+        what the first call made with key returned, waiting for that call
+        if it is still running
+
+        Raises KeyReused if the first call with key was for another request.
+        """
+        while True:
+            outcome = self._lookup(key)
+            if outcome is not None:
+                if outcome.digest != digest:
+                    raise KeyReused("idempotency key was used for a different request")
+                return (True, replay(outcome))
+            running = self._running.get(key)
+            if running is None:
+                break
+            await running.wait()
+        running = self._running[key] = asyncio.Event()
+        expires = time.monotonic() + self.ttl
+        try:
+            try:
+                value = await call()
+            except HTTPException as error:
+                if storable(error.status_code):
+                    self._keep(
+                        key, Outcome(digest, expires, None, error_outcome(error))
+                    )
+                raise
+            self._keep(key, Outcome(digest, expires, value, None))
+            return (False, value)
+        finally:
+            del self._running[key]
+            running.set()
+
+    def close(self):
+        """nothing to release for outcomes kept in memory"""
+
+
+class SharedIdempotencyStore:
+    """The outcomes of writes sent with an idempotency key, shared by every
+    worker through the database in *directory*
+
+    The first attempt claims its key with a row naming its process.  A
+    retry handled by any worker checks the row every POLL_INTERVAL seconds
+    until the outcome is written, and takes the key over if the process
+    that claimed it has exited.  Outcomes expire after *ttl* seconds like
+    IdempotencyStore's, and the oldest beyond *max_keys* are dropped every
+    TRIM_EVERY writes.
+    """
+
+    def __init__(self, directory, max_keys=10000, ttl=3600.0):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._claims = 0
+        self._database = open_database(directory)
+        self._database.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes (key TEXT PRIMARY KEY,"
+            " digest TEXT, owner INTEGER, expires REAL, outcome TEXT)"
+        )
+        self._database.execute(
+            "CREATE INDEX IF NOT EXISTS outcomes_expires ON outcomes (expires)"
+        )
+
+    def _claim(self, key, digest):
+        """the stored (digest, outcome) of key, or None if this process
+        claimed the key to run the request
+        """
+        now = time.time()
+        with transaction(self._database) as database:
+            database.execute("DELETE FROM outcomes WHERE expires <= ?", (now,))
+            row = database.execute(
+                "SELECT digest, owner, outcome FROM outcomes WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and (row[2] is not None or process_alive(row[1])):
+                return (row[0], row[2])
+            database.execute(
+                "INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, NULL)",
+                (key, digest, os.getpid(), now + self.ttl),
+            )
+            self._claims += 1
+            if self._claims % TRIM_EVERY == 0:
+                database.execute(
+                    "DELETE FROM outcomes WHERE key IN (SELECT key FROM outcomes"
+                    " ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                    (self.max_keys,),
+                )
+        return None
+
+    def _finish(self, key, outcome):
+        """store the outcome of a claimed key, or drop the claim if the
+        outcome is None
+        """
+        if outcome is None:
+            self._database.execute("DELETE FROM outcomes WHERE key = ?", (key,))
+        else:
+            self._database.execute(
+                "UPDATE outcomes SET outcome = ? WHERE key = ?",
+                (json.dumps(outcome), key),
+            )
+
+    async def run(self, key, digest, call):
+        """as IdempotencyStore.run"""
+        key = json.dumps(key)
+        while True:
+            stored = self._claim(key, digest)
+            if stored is None:
+                break
+            (stored_digest, outcome) = stored
+            if stored_digest != digest:
+                raise KeyReused("idempotency key was used for a different request")
+            if outcome is not None:
+                (value, error) = json.loads(outcome)
+                return (True, replay(Outcome(digest, None, value, error)))
+            await asyncio.sleep(POLL_INTERVAL)
+        outcome = None
+        try:
+            value = await call()
+            outcome = [value, None]
+        except HTTPException as error:
+            if storable(error.status_code):
+                outcome = [None, error_outcome(error)]
+            raise
+        finally:
+            self._finish(key, outcome)
+        return (False, value)
+
+    def close(self):
+        """close the database"""
+        self._database.close()
+
+
+def idempotent_endpoint(call):
+    """wrap an endpoint so a request sent with an idempotency key runs it
+    only if no earlier attempt has, returning that attempt's outcome if
+    one has
+    """
+
+    @functools.wraps(call)
+    async def endpoint(**values):
+        attempt = _attempt.get()
+        if attempt is None:
+            return await call(**values)
+
+        async def first_attempt():
+            return jsonable_encoder(await call(**values))
+
+        try:
+            (attempt.replayed, value) = await attempt.store.run(
+                attempt.key, attempt.digest, first_attempt
+            )
+        except KeyReused as error:
+            raise HTTPException(422, str(error)) from error
+        return value
+
+    return endpoint
+
+
+class IdempotentRoute(TimedRoute):
+    """A route whose write requests honour the Idempotency-Key header
+
+    Requests are told apart by the api key sent with them as well as the
+    idempotency key.  The handler notes the request's key and digest, and
+    the endpoint, once the dependencies have passed, runs or replays it.
+    """
+
+    def get_route_handler(self):
+        if not self.methods & WRITE_METHODS:
+            return super().get_route_handler()
+        self.dependant.call = idempotent_endpoint(self.dependant.call)
+        handler = super().get_route_handler()
+
+        async def idempotent_handler(request):
+            backend = request.app.state.backend
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            secret = request.headers.get("x-api-key")
+            if backend.idempotency is None or idempotency_key is None or not secret:
+                return await handler(request)
+            attempt = Attempt(
+                backend.idempotency,
+                (hash_secret(secret), idempotency_key),
+                request_digest(request, await request.body()),
+            )
+            token = _attempt.set(attempt)
+            try:
+                response = await handler(request)
+            finally:
+                _attempt.reset(token)
+            if attempt.replayed:
+                response.headers[REPLAYED_HEADER] = "true"
+            return response
+
+        return idempotent_handler
@@ -0,0 +1,119 @@
+""" API key store that reloads the key file when it changes """
+import os
+import time
+import hashlib
+import logging
+from collections import namedtuple
+from .ratelimit import KINDS, parse_limit
+
+
+logger = logging.getLogger("bind-api")
+
+
+class KeyEntry(namedtuple("KeyEntry", "name zones limits")):
+    """The name, zone scope and rate limits of one secret
+
+    Secrets sharing a name, as during a rotation, each keep their own
+    scope, so a request is checked against the secret it was sent with.
+    """
+
+    __slots__ = ()
+
+    def permits(self, zone):
+        """may this secret use records in zone"""
+        return self.zones is None or zone.lower() in self.zones
+
+
+# options that may follow the secret on a key file line
+KEY_OPTIONS = ("zones",) + KINDS
+
+
+def hash_secret(secret):
+    """return the hex sha256 digest used to index a secret"""
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def _qualify_zone(zone):
+    zone = zone.strip().lower()
+    return zone if zone.endswith(".") else f"{zone}."
+
+
+def parse_key_line(line):
+    """parse a key file line into (digest, KeyEntry)
+
+    Lines are keyname,keypass optionally followed by ,option=value fields.
+    zones=example.org;example.com limits the key to those zones, and
+    read=, write= and xfr= set its rate limits as rate or rate:burst.  A keypass
+    of sha256:<hex digest> stores only the hash of the secret.  If the
+    fields after the keypass are not all known options they are treated as
+    part of the keypass, so older keypasses containing commas still work.
+    """
+    (name, rest) = line.split(",", maxsplit=1)
+    (secret, *fields) = rest.split(",")
+    options = dict(field.split("=", maxsplit=1) for field in fields if "=" in field)
+    if len(options) != len(fields) or not set(options) <= set(KEY_OPTIONS):
+        (secret, options) = (rest, {})
+    zones = None
+    if "zones" in options:
+        zones = frozenset(_qualify_zone(z) for z in options["zones"].split(";"))
+    if secret.startswith("sha256:"):
+        digest = secret[len("sha256:") :].lower()
+    else:
+        digest = hash_secret(secret)
+    limits = {kind: parse_limit(options[kind]) for kind in KINDS if kind in options}
+    return (digest, KeyEntry(name=name, zones=zones, limits=limits))
+
+
+class KeyStore:
+    """API keys indexed by the sha256 digest of their secret
+
+    A presented key is hashed and looked up in a dict, so only digests are
+    held in memory and the lookup costs the same however many keys there
+    are.  As the dict compares digests of the presented key and never the
+    secret itself, its timing reveals nothing about stored secrets.
+
+    The key file is checked for a new mtime at most every *interval*
+    seconds and, if it changed, parsed into a fresh index that replaces the
+    old one in a single assignment.  A file that fails to load leaves the
+    current keys in place.
+    """
+
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self._mtime = None
+        self._checked = time.monotonic()
+        self._keys = {}
+        self.reload()
+
+    def reload(self):
+        """read the key file and swap in the new index"""
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as key_file:
+            lines = [x.strip() for x in key_file.read().split("\n")]
+        index = {}
+        for line in filter(lambda x: x != "" and x[0] != "#", lines):
+            (digest, entry) = parse_key_line(line)
+            index[digest] = entry
+        self._keys = index
+        self._mtime = mtime
+        logger.debug("loaded %d api keys from %s", len(index), self.path)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return
+        self._checked = now
+        try:
+            if os.stat(self.path).st_mtime_ns != self._mtime:
+                self.reload()
+        except (OSError, ValueError) as error:
+            logger.error("could not reload api keys from %s: %s", self.path, error)
+
+    def lookup(self, secret):
+        """return the KeyEntry for a presented secret, or None"""
+        self._maybe_reload()
+        return self._keys.get(hash_secret(secret))
+
+    def __len__(self):
+        return len(self._keys)
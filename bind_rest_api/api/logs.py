@@ -0,0 +1,80 @@
+""" Logging through a queue so handlers never block the event loop """
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+auditlogger = logging.getLogger("bind-api.audit")
+logger = logging.getLogger("bind-api")
+
+
+class JsonAuditFormatter(logging.Formatter):
+    """Format audit records as one compact json object per line"""
+
+    def __init__(self, application_name):
+        super().__init__(datefmt="%Y-%m-%dT%H:%M:%S%z")
+        self.application_name = application_name
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "app": self.application_name,
+        }
+        entry.update(getattr(record, "audit", {"message": record.getMessage()}))
+        return json.dumps(entry, separators=(",", ":"))
+
+
+def setup_logging(logging_dir, application_name, audit_format="text"):
+    """Send the audit and debug loggers to a queue and start a thread writing
+    the queued records to the log files, returning the QueueListener
+
+    Audit records are also written to the debug log, as they always have
+    been.  With audit_format json the audit log is dns-api-audit.jsonl
+    holding one json object per operation.
+    """
+    formatter = logging.Formatter(
+        f"%(asctime)s == {application_name} == %(message)s",
+        datefmt="%Y-%m-%dT%H:%M%z",
+    )
+    if audit_format == "json":
+        audit_handler = logging.handlers.TimedRotatingFileHandler(
+            f"{logging_dir}/dns-api-audit.jsonl", when="D", interval=7
+        )
+        audit_handler.setFormatter(JsonAuditFormatter(application_name))
+    else:
+        audit_handler = logging.handlers.TimedRotatingFileHandler(
+            f"{logging_dir}/dns-api-audit.log", when="D", interval=7
+        )
+        audit_handler.setFormatter(formatter)
+    audit_handler.addFilter(logging.Filter(auditlogger.name))
+    debug_handler = logging.handlers.RotatingFileHandler(
+        f"{logging_dir}/dns-api-debug.log",
+        maxBytes=(1024 * 1024 * 100),
+        backupCount=10,
+    )
+    debug_handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, audit_handler, debug_handler, respect_handler_level=True
+    )
+    auditlogger.setLevel(logging.INFO)
+    logger.setLevel(logging.DEBUG)
+    # audit records reach the queue by propagating to the bind-api logger
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def stop_logging(listener):
+    """write out the queued records and detach the queue from the loggers"""
+    for handler in list(logger.handlers):
+        if getattr(handler, "queue", None) is listener.queue:
+            logger.removeHandler(handler)
+    atexit.unregister(listener.stop)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,171 @@
+""" Prometheus metrics for the api handlers and the BIND operations they make
+
+When uvicorn runs several workers, cli.main points PROMETHEUS_MULTIPROC_DIR
+at a shared directory before they start, and /metrics then aggregates the
+values written there by every worker.  The live gauges of a worker that has
+exited are removed, by the worker as it stops or by the next /metrics if it
+died without stopping.
+"""
+import os
+import re
+import glob
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+RECORD_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+REQUESTS = Counter(
+    "bindapi_requests_total", "HTTP requests handled", ["handler", "status"]
+)
+REQUEST_DURATION = Histogram(
+    "bindapi_request_duration_seconds", "HTTP request latency", ["handler"]
+)
+IN_FLIGHT = Gauge(
+    "bindapi_requests_in_flight",
+    "HTTP requests being handled",
+    multiprocess_mode="livesum",
+)
+CHANGE_SUBSCRIBERS = Gauge(
+    "bindapi_change_subscribers",
+    "Clients waiting on zone change feeds",
+    multiprocess_mode="livesum",
+)
+AUTH_FAILURES = Counter(
+    "bindapi_auth_failures_total", "Rejected api keys", ["reason"]
+)
+RATE_LIMITED = Counter(
+    "bindapi_rate_limited_total", "Requests refused with 429", ["kind"]
+)
+TRANSFER_DURATION = Histogram(
+    "bindapi_transfer_duration_seconds", "Zone transfer duration", ["kind"]
+)
+TRANSFER_RECORDS = Histogram(
+    "bindapi_transfer_records",
+    "Records received in a full zone transfer",
+    ["kind"],
+    buckets=RECORD_BUCKETS,
+)
+RESOLVE_DURATION = Histogram(
+    "bindapi_resolve_duration_seconds", "Record lookup latency", ["rrtype"]
+)
+UPDATE_DURATION = Histogram(
+    "bindapi_update_duration_seconds", "DNS UPDATE round trip time"
+)
+IDEMPOTENT_REPLAYS = Counter(
+    "bindapi_idempotent_replays_total",
+    "Writes answered with the stored outcome of an earlier attempt",
+)
+UPDATES = Counter("bindapi_updates_total", "DNS UPDATEs sent", ["rcode"])
+READS = Counter(
+    "bindapi_reads_total",
+    "Lookups and zone transfers sent to each BIND server",
+    ["server", "kind"],
+)
+SERVER_UP = Gauge(
+    "bindapi_bind_server_up",
+    "Whether a BIND server passed its last health check",
+    ["server"],
+    multiprocess_mode="liveall",
+)
+SERVER_LATENCY = Gauge(
+    "bindapi_bind_server_latency_seconds",
+    "Smoothed SOA query round trip time of a BIND server",
+    ["server"],
+    multiprocess_mode="liveall",
+)
+UPDATE_BATCH_SIZE = Histogram(
+    "bindapi_update_batch_size",
+    "Changes merged into one coalesced DNS UPDATE",
+    buckets=BATCH_BUCKETS,
+)
+
+
+# the files prometheus_client keeps a worker's livesum and liveall gauges in
+LIVE_GAUGE_FILE = re.compile(r"gauge_live[a-z]+_(\d+)\.db$")
+
+
+def process_alive(pid):
+    """is there a process with pid"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def mark_dead_workers(path):
+    """remove the live gauges of workers that exited without doing so"""
+    pids = set()
+    for name in os.listdir(path):
+        match = LIVE_GAUGE_FILE.match(name)
+        if match is not None:
+            pids.add(int(match.group(1)))
+    for pid in pids:
+        if not process_alive(pid):
+            multiprocess.mark_process_dead(pid, path)
+
+
+def worker_stopped():
+    """remove this worker's live gauges, so they no longer add up"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def clear_multiprocess_dir(path):
+    """remove the values left by an earlier run"""
+    for name in glob.glob(os.path.join(path, "*.db")):
+        os.remove(name)
+
+
+def render():
+    """return the metrics page as (body, content type)"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        mark_dead_workers(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing requests by handler name"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            IN_FLIGHT.dec()
+            # the router adds the matched endpoint to the scope
+            endpoint = scope.get("endpoint")
+            handler = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUESTS.labels(handler, status[0]).inc()
+            REQUEST_DURATION.labels(handler).observe(time.perf_counter() - start)
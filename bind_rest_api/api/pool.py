@@ -0,0 +1,215 @@
+""" Pool of persistent TCP connections to the BIND server """
+import time
+import struct
+import asyncio
+import logging
+import dns.exception
+import dns.message
+import dns.query
+import dns.opcode
+from .timing import background_task, span
+
+logger = logging.getLogger("bind-api")
+
+
+class ConnectionClosed(ConnectionResetError):
+    """the connection was closed before the query was sent on it"""
+
+
+class PooledConnection:
+    """A TCP connection to a DNS server that can carry several queries at
+    once, matching each response to its query by message id
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # number of queries that have acquired this connection
+        self.active = 0
+        # set while an UPDATE has the connection to itself
+        self.exclusive = False
+        self.closed = False
+        self.last_used = time.monotonic()
+        self._waiting = {}
+        self._task = background_task(self._read_responses())
+
+    @classmethod
+    async def open(cls, server, port, timeout):
+        """connect to server and start reading responses"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(server, port), timeout
+        )
+        return cls(reader, writer)
+
+    async def _read_responses(self):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await self.reader.readexactly(2))
+                wire = await self.reader.readexactly(length)
+                future = self._waiting.pop(struct.unpack("!H", wire[:2])[0], None)
+                if future is not None and not future.done():
+                    future.set_result(wire)
+        except (EOFError, OSError, struct.error) as error:
+            logger.debug("connection to DNS server closed: %r", error)
+        finally:
+            self.closed = True
+            self.writer.close()
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionResetError("connection to DNS server closed")
+                    )
+            self._waiting.clear()
+
+    async def query(self, message, timeout):
+        """send message and wait for the matching response"""
+        while message.id in self._waiting:
+            # another query on this connection is using the same id
+            await asyncio.wait([self._waiting[message.id]])
+        if self.closed:
+            raise ConnectionClosed("connection to DNS server closed")
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[message.id] = future
+        try:
+            with span("build"):
+                wire = message.to_wire()
+            with span("bind"):
+                self.writer.write(struct.pack("!H", len(wire)) + wire)
+                await self.writer.drain()
+                wire = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as error:
+            raise dns.exception.Timeout(timeout=timeout) from error
+        finally:
+            if self._waiting.get(message.id) is future:
+                del self._waiting[message.id]
+        with span("build"):
+            response = dns.message.from_wire(
+                wire, keyring=message.keyring, request_mac=message.mac
+            )
+        if not message.is_response(response):
+            raise dns.query.BadResponse
+        return response
+
+    async def close(self):
+        """stop reading, which closes the socket and fails waiting queries"""
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class ConnectionPool:
+    """Keeps up to *size* TCP connections to a DNS server open
+
+    Queries are pipelined, up to *pipeline* at a time on a connection, and
+    responses are matched by message id.  UPDATE messages get a connection
+    to themselves so they are never interleaved with other traffic.
+    Connections idle for *idle_timeout* seconds are closed, and a query on a
+    reused connection that the server has since closed is retried once on a
+    new connection.  An UPDATE is only retried if it was not sent, as one
+    that reached the server before the connection dropped may have been
+    applied.
+    """
+
+    def __init__(
+        self, server, port=53, size=4, idle_timeout=20.0, timeout=10.0, pipeline=16
+    ):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self._connections = []
+        self._opening = 0
+        self._condition = None
+        self._reaper = None
+
+    @property
+    def _available(self):
+        # created on first use so it belongs to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def start(self):
+        """start closing idle connections in the background"""
+        self._reaper = background_task(self._reap())
+
+    async def close(self):
+        """close every connection"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+        await asyncio.gather(*(connection.close() for connection in self._connections))
+        self._connections = []
+
+    async def query(self, message, timeout=None):
+        """send message over a pooled connection and return the response"""
+        timeout = timeout or self.timeout
+        exclusive = message.opcode() == dns.opcode.UPDATE
+        for attempt in (1, 2):
+            connection, reused = await self._acquire(exclusive)
+            try:
+                return await connection.query(message, timeout)
+            except ConnectionError as error:
+                if not reused or attempt == 2:
+                    raise
+                if exclusive and not isinstance(error, ConnectionClosed):
+                    raise
+                logger.debug("retrying query to %s on a new connection", self.server)
+            finally:
+                await self._release(connection, exclusive)
+        return None  # not reached
+
+    def _usable(self, connection, exclusive):
+        if connection.closed or connection.exclusive:
+            return False
+        if exclusive:
+            return connection.active == 0
+        return connection.active < self.pipeline
+
+    async def _acquire(self, exclusive):
+        async with self._available:
+            while True:
+                self._connections = [c for c in self._connections if not c.closed]
+                usable = [c for c in self._connections if self._usable(c, exclusive)]
+                if usable:
+                    connection = min(usable, key=lambda c: c.active)
+                    connection.active += 1
+                    connection.exclusive = exclusive
+                    return (connection, True)
+                if len(self._connections) + self._opening < self.size:
+                    self._opening += 1
+                    break
+                await self._available.wait()
+        connection = None
+        try:
+            connection = await PooledConnection.open(
+                self.server, self.port, self.timeout
+            )
+        finally:
+            async with self._available:
+                self._opening -= 1
+                if connection is not None:
+                    connection.active += 1
+                    connection.exclusive = exclusive
+                    self._connections.append(connection)
+                self._available.notify_all()
+        return (connection, False)
+
+    async def _release(self, connection, exclusive):
+        async with self._available:
+            connection.active -= 1
+            if exclusive:
+                connection.exclusive = False
+            connection.last_used = time.monotonic()
+            self._available.notify_all()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            for connection in list(self._connections):
+                if (
+                    not connection.active
+                    and now - connection.last_used > self.idle_timeout
+                ):
+                    await connection.close()
@@ -0,0 +1,106 @@
+""" Waits for a zone change to reach every authoritative nameserver """
+import time
+import asyncio
+from collections import namedtuple
+import dns.asyncresolver
+import dns.exception
+import dns.serial
+
+NameServer = namedtuple("NameServer", "name address")
+
+
+def serial_reached(serial, target):
+    """is serial at or past target, in RFC 1982 serial number arithmetic"""
+    return dns.serial.Serial(serial) >= dns.serial.Serial(target)
+
+
+class PropagationChecker:
+    """Finds the nameservers of a zone and waits for them to serve a serial
+
+    The zone's NS records, and the addresses of the nameservers, are asked
+    of *resolver*, which is the primary, falling back to the system
+    resolver for nameservers outside the zones BIND serves.  Each
+    nameserver's SOA serial is then queried, all at once, every *interval*
+    seconds until every one of them has caught up.
+    """
+
+    def __init__(self, resolver, port=53, interval=1.0, timeout=2.0):
+        self.resolver = resolver
+        self.port = port
+        self.interval = interval
+        # seconds to wait for one nameserver to answer
+        self.timeout = timeout
+        self._system = None
+
+    def _resolvers(self):
+        if self._system is None:
+            self._system = dns.asyncresolver.Resolver()
+        return (self.resolver, self._system)
+
+    async def _addresses(self, name):
+        """the IPv4 and IPv6 addresses of a nameserver"""
+        for resolver in self._resolvers():
+            answers = await asyncio.gather(
+                *(resolver.resolve(name, rdtype) for rdtype in ("A", "AAAA")),
+                return_exceptions=True,
+            )
+            addresses = [
+                rdata.address
+                for answer in answers
+                if not isinstance(answer, Exception)
+                for rdata in answer
+            ]
+            if addresses:
+                return addresses
+        return []
+
+    async def nameservers(self, zone_name):
+        """the NameServers of a zone, one for each address of each NS"""
+        answer = await self.resolver.resolve(zone_name, "NS")
+        names = sorted(rdata.target.to_text() for rdata in answer)
+        addresses = await asyncio.gather(*(self._addresses(name) for name in names))
+        return [
+            NameServer(name, address)
+            for (name, found) in zip(names, addresses)
+            for address in found
+        ]
+
+    async def serial(self, server, zone_name):
+        """the SOA serial a nameserver has for a zone, None if it does not
+        answer
+        """
+        resolver = dns.asyncresolver.Resolver(configure=False)
+        resolver.nameservers = [server.address]
+        resolver.port = self.port
+        resolver.lifetime = self.timeout
+        try:
+            answer = await resolver.resolve(zone_name, "SOA")
+        except dns.exception.DNSException:
+            return None
+        return answer[0].serial
+
+    async def wait(self, zone_name, serial, timeout):
+        """wait up to timeout seconds for every nameserver of a zone to
+        serve serial or later
+
+        Returns (whether they all do, {NameServer: serial or None}).
+        """
+        deadline = time.monotonic() + timeout
+        pending = await self.nameservers(zone_name)
+        serials = {server: None for server in pending}
+        while True:
+            found = await asyncio.gather(
+                *(self.serial(server, zone_name) for server in pending)
+            )
+            serials.update(zip(pending, found))
+            pending = [
+                server
+                for server in pending
+                if serials[server] is None
+                or not serial_reached(serials[server], serial)
+            ]
+            if not pending:
+                return (True, serials)
+            if time.monotonic() + self.interval > deadline:
+                return (False, serials)
+            await asyncio.sleep(self.interval)
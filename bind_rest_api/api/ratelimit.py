@@ -0,0 +1,209 @@
+""" Token bucket rate limits per api key and a cap on concurrent transfers
+
+Both hold for the api as a whole.  With a WORKER_STATE_DIR the buckets are
+rows of a database there and the transfer slots are lock files in it, so
+they are shared by every worker; otherwise they are kept in memory.
+"""
+import os
+import time
+import asyncio
+from collections import namedtuple
+from .shared import open_database, transaction, try_lock
+
+# requests per second and how many may be made at once after a quiet spell
+Limit = namedtuple("Limit", "rate burst")
+
+# the kinds of request each key has a bucket for
+KINDS = ("read", "write", "xfr")
+
+# seconds between a worker's tries for a transfer slot held by others
+SLOT_POLL_INTERVAL = 0.02
+
+
+class Overloaded(Exception):
+    """a request that would have to wait too long to be admitted"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"try again in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def parse_limit(text):
+    """parse rate or rate:burst into a Limit, the burst defaulting to the
+    rate, or to 1 for rates below one per second
+    """
+    (rate, _, burst) = text.partition(":")
+    limit = Limit(float(rate), float(burst) if burst else max(float(rate), 1.0))
+    if limit.rate <= 0 or limit.burst < 1:
+        raise ValueError(f"invalid rate limit {text!r}")
+    return limit
+
+
+class TokenBucket:
+    """Holds up to *burst* tokens, refilled at *rate* a second
+
+    A request that finds the bucket empty may reserve a token ahead of
+    the refill, taking the bucket below zero, and then waits until the
+    token would have arrived.
+    """
+
+    __slots__ = ("limit", "tokens", "stamp")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.stamp = time.monotonic()
+
+    def reserve(self, max_wait):
+        """take a token and return the seconds to wait before using it, or
+        leave the bucket alone if that would be longer than max_wait
+        """
+        now = time.monotonic()
+        # a stamp from before a reboot would be ahead of the clock
+        self.tokens = min(
+            self.limit.burst,
+            self.tokens + max(0.0, now - self.stamp) * self.limit.rate,
+        )
+        self.stamp = now
+        wait = max(0.0, (1 - self.tokens) / self.limit.rate)
+        if wait <= max_wait:
+            self.tokens -= 1
+        return wait
+
+
+class SharedBuckets:
+    """The token buckets of every worker, as rows of the database in
+    directory
+
+    A bucket is read, refilled and written back in one transaction, which
+    takes tens of microseconds.
+    """
+
+    def __init__(self, directory):
+        self._database = open_database(directory)
+        self._database.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key_name TEXT, kind TEXT,"
+            " rate REAL, burst REAL, tokens REAL, stamp REAL,"
+            " PRIMARY KEY (key_name, kind))"
+        )
+
+    def reserve(self, key_name, kind, limit, max_wait):
+        """take a token from the bucket of key_name and kind, as
+        TokenBucket.reserve does
+        """
+        bucket = TokenBucket(limit)
+        with transaction(self._database) as database:
+            row = database.execute(
+                "SELECT rate, burst, tokens, stamp FROM buckets"
+                " WHERE key_name = ? AND kind = ?",
+                (key_name, kind),
+            ).fetchone()
+            if row is not None and Limit(*row[:2]) == limit:
+                # keys whose limit changed in the key file start afresh
+                (bucket.tokens, bucket.stamp) = row[2:]
+            wait = bucket.reserve(max_wait)
+            database.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?)",
+                (key_name, kind, *limit, bucket.tokens, bucket.stamp),
+            )
+        return wait
+
+    def close(self):
+        """close the database"""
+        self._database.close()
+
+
+class RateLimiter:
+    """A token bucket for each api key and kind of request
+
+    Keys without a limit of their own for a kind use the limit in
+    *defaults*, and are not limited if that is None.  A request waits up
+    to *max_wait* seconds for a token, and beyond that gets Overloaded.
+    Without a *directory* admitting a request is a dict lookup and some
+    arithmetic; with one, the buckets are SharedBuckets.
+    """
+
+    def __init__(self, defaults=None, max_wait=1.0, directory=""):
+        self.defaults = defaults or {}
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._shared = SharedBuckets(directory) if directory else None
+
+    async def admit(self, key_name, kind, limit=None):
+        """wait for a token for a request of kind by key_name
+
+        Raises Overloaded, with the seconds until a token is due, if the
+        wait would be longer than max_wait.
+        """
+        limit = limit or self.defaults.get(kind)
+        if limit is None:
+            return
+        if self._shared is not None:
+            wait = self._shared.reserve(key_name, kind, limit, self.max_wait)
+        else:
+            bucket = self._buckets.get((key_name, kind))
+            if bucket is None or bucket.limit != limit:
+                # new keys, and keys whose limit changed in the key file
+                bucket = self._buckets[(key_name, kind)] = TokenBucket(limit)
+            wait = bucket.reserve(self.max_wait)
+        if wait > self.max_wait:
+            raise Overloaded(wait)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def close(self):
+        """close the shared buckets"""
+        if self._shared is not None:
+            self._shared.close()
+
+
+class TransferSlots:
+    """Caps the zone transfers running at once, across all keys
+
+    *limit* of 0 leaves transfers uncapped.  With a *directory* the slots
+    are *limit* lock files there, shared by every worker: a transfer holds
+    the lock of one of them, and a worker finding them all held tries
+    again every SLOT_POLL_INTERVAL seconds.  A worker that exits gives its
+    slots back with its locks.
+    """
+
+    def __init__(self, limit, max_wait=1.0, directory=""):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.directory = directory
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+        self._held = []
+
+    async def acquire(self, wait=True):
+        """take a slot, waiting for as long as it takes, or with wait=False
+        up to max_wait seconds before raising Overloaded
+        """
+        if self._semaphore is None:
+            return
+        take = self._take_file if self.directory else self._semaphore.acquire
+        if wait:
+            await take()
+            return
+        try:
+            await asyncio.wait_for(take(), self.max_wait)
+        except asyncio.TimeoutError as error:
+            raise Overloaded(self.max_wait) from error
+
+    async def _take_file(self):
+        while True:
+            for slot in range(self.limit):
+                lock_file = try_lock(os.path.join(self.directory, f"xfr-{slot}.lock"))
+                if lock_file is not None:
+                    self._held.append(lock_file)
+                    return
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+
+    def release(self):
+        """give a slot back"""
+        if self._semaphore is None:
+            return
+        if self.directory:
+            # the slots are alike, so any one held by this worker will do
+            self._held.pop().close()
+        else:
+            self._semaphore.release()
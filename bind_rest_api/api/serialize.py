@@ -0,0 +1,167 @@
+""" Render parsed zones to response bodies in each export format
+
+Rendering walks each node's rdatasets rather than iterate_rdatas(), so a
+name and a type are converted to text once rather than once per record,
+and the result is encoded straight to bytes, with orjson when it is
+installed, instead of going through FastAPI's jsonable_encoder.
+"""
+import re
+import json
+import functools
+import dns.rdatatype
+
+try:
+    import orjson
+except ImportError:  # optional, see the fast extra
+    orjson = None
+
+# the media type of each export format
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columnar": "application/json",
+    "text": "text/dns",
+}
+# labels made only of these bytes need no escaping in text form
+PLAIN_LABEL = re.compile(rb'[^\x00-\x20\x7f-\xff"().;\\@$]*')
+SOA_FIELDS = ("expire", "minimum", "refresh", "retry", "rname", "mname", "serial")
+# the numbers of an SOA, in the order of its text form
+SOA_NUMBERS = ("serial", "refresh", "retry", "expire", "minimum")
+
+
+def dumps(content):
+    """encode content as compact json bytes, the way JSONResponse does"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+def name_text(name):
+    """name.to_text(), skipping the label by label escaping when no label
+    needs it
+    """
+    labels = name.labels
+    if labels and labels[0] and all(map(PLAIN_LABEL.fullmatch, labels)):
+        return b".".join(labels).decode("ascii")
+    return name.to_text()
+
+
+@functools.lru_cache(maxsize=None)
+def type_text(rdtype):
+    """the mnemonic of a record type"""
+    return dns.rdatatype.to_text(rdtype)
+
+
+def soa_json(ttl, soa):
+    """the json form of a zone's SOA"""
+    result = {"ttl": ttl}
+    for field_name in SOA_FIELDS:
+        value = getattr(soa, field_name)
+        result[field_name] = str(value) if field_name in ("rname", "mname") else value
+    return result
+
+
+def zone_json(zone):
+    """the SOA and a map of names to their records of a parsed zone"""
+    result = {}
+    records = {}
+    for (name, node) in zone.items():
+        name_records = []
+        for rdataset in node:
+            if rdataset.rdtype == dns.rdatatype.SOA:
+                result["SOA"] = soa_json(rdataset.ttl, rdataset[0])
+                continue
+            rrtype = type_text(rdataset.rdtype)
+            ttl = rdataset.ttl
+            name_records.extend(
+                {"response": rdata.to_text(), "rrtype": rrtype, "ttl": ttl}
+                for rdata in rdataset
+            )
+        if name_records:
+            records[name_text(name)] = name_records
+    result["records"] = records
+    return result
+
+
+def zone_columnar(zone, serial):
+    """a parsed zone as parallel arrays of name, rrtype, ttl and response,
+    one entry per record, which leaves out the keys repeated per record
+    """
+    columns = {"name": [], "rrtype": [], "ttl": [], "response": []}
+    for (name, node) in zone.items():
+        text = name_text(name)
+        for rdataset in node:
+            rrtype = type_text(rdataset.rdtype)
+            for rdata in rdataset:
+                columns["name"].append(text)
+                columns["rrtype"].append(rrtype)
+                columns["ttl"].append(rdataset.ttl)
+                columns["response"].append(rdata.to_text())
+    return {"origin": zone.origin.to_text(), "serial": serial, **columns}
+
+
+def render_zone(zone, serial, output_format):
+    """the body of a parsed zone in an export format, "json", "columnar" or
+    "text" for an RFC 1035 master file
+    """
+    if output_format == "text":
+        return zone.to_text(want_origin=True).encode()
+    if output_format == "columnar":
+        return dumps(zone_columnar(zone, serial))
+    return dumps(zone_json(zone))
+
+
+def snapshot_json(snapshot):
+    """zone_json() of a zone snapshot"""
+    result = {}
+    records = {}
+    for (name, name_records) in snapshot.nodes():
+        rendered = []
+        for (rdtype, ttl, rdata) in name_records:
+            if rdtype == dns.rdatatype.SOA:
+                (mname, rname, *numbers) = rdata.split()
+                soa = dict(
+                    zip(SOA_NUMBERS, map(int, numbers)), rname=rname, mname=mname
+                )
+                result["SOA"] = {"ttl": ttl, **{key: soa[key] for key in SOA_FIELDS}}
+                continue
+            rendered.append(
+                {"response": rdata, "rrtype": type_text(rdtype), "ttl": ttl}
+            )
+        if rendered:
+            records[name] = rendered
+    result["records"] = records
+    return result
+
+
+def snapshot_columnar(snapshot):
+    """zone_columnar() of a zone snapshot"""
+    columns = {"name": [], "rrtype": [], "ttl": [], "response": []}
+    for (name, name_records) in snapshot.nodes():
+        for (rdtype, ttl, rdata) in name_records:
+            columns["name"].append(name)
+            columns["rrtype"].append(type_text(rdtype))
+            columns["ttl"].append(ttl)
+            columns["response"].append(rdata)
+    return {"origin": snapshot.origin, "serial": snapshot.serial, **columns}
+
+
+def snapshot_text(snapshot):
+    """a zone snapshot as an RFC 1035 master file"""
+    lines = [f"$ORIGIN {snapshot.origin}"]
+    for (name, name_records) in snapshot.nodes():
+        lines.extend(
+            f"{name} {ttl} IN {type_text(rdtype)} {rdata}"
+            for (rdtype, ttl, rdata) in name_records
+        )
+    return "\n".join(lines) + "\n"
+
+
+def render_snapshot(snapshot, output_format):
+    """render_zone() of a zone snapshot"""
+    if output_format == "text":
+        return snapshot_text(snapshot).encode()
+    if output_format == "columnar":
+        return dumps(snapshot_columnar(snapshot))
+    return dumps(snapshot_json(snapshot))
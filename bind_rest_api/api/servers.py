@@ -0,0 +1,294 @@
+""" Health and latency checks of the BIND servers reads can be sent to """
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import namedtuple
+import dns.asyncquery
+import dns.exception
+import dns.message
+import dns.rdatatype
+from .metrics import SERVER_LATENCY, SERVER_UP
+from .shared import ZoneGenerations, ZoneTable, try_lock
+from .timing import background_task
+
+logger = logging.getLogger("bind-api")
+
+Server = namedtuple("Server", "host port")
+
+# weight of the newest round trip in the smoothed latency
+LATENCY_WEIGHT = 0.3
+# zones read within this many check intervals are checked
+RECENT_CHECKS = 12
+
+MONITOR_LOCK = "monitor.lock"
+MONITOR_FILE = "monitor.json"
+READS_FILE = "reads"
+
+
+def parse_servers(text, default_port=53):
+    """parse a comma separated list of host, host:port or [v6 host]:port
+    into Servers, the first being the primary
+    """
+    servers = []
+    for entry in text.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        (host, port) = (entry, default_port)
+        if entry.startswith("["):
+            (host, _, rest) = entry[1:].partition("]")
+            if rest.startswith(":"):
+                port = int(rest[1:])
+        elif entry.count(":") == 1:
+            (host, port) = entry.split(":")
+        servers.append(Server(host, int(port)))
+    if not servers:
+        raise ValueError("no BIND server given")
+    return servers
+
+
+def server_label(server):
+    """how a server is shown in logs and metrics"""
+    if ":" in server.host:
+        return f"[{server.host}]:{server.port}"
+    return f"{server.host}:{server.port}"
+
+
+async def soa_query(server, zone_name, timeout):
+    """return the SOA serial of a zone on a server"""
+    query = dns.message.make_query(zone_name, dns.rdatatype.SOA)
+    response = await dns.asyncquery.udp(
+        query, server.host, port=server.port, timeout=timeout
+    )
+    rrset = response.find_rrset(
+        response.answer,
+        query.question[0].name,
+        query.question[0].rdclass,
+        dns.rdatatype.SOA,
+    )
+    return rrset[0].serial
+
+
+class ServerMonitor:
+    """Picks the BIND server each read of a zone goes to
+
+    Every *interval* seconds the SOA of each zone read in the last
+    RECENT_CHECKS intervals is queried on the primary and on every
+    secondary, which gives each server a smoothed latency and the serial
+    it has for each zone.  Reads go to the fastest healthy secondary
+    holding the serial the primary has for the zone, and to the primary
+    when no secondary is current, or when the zone has not been checked
+    since it was last read.  A server that fails the query for a zone is
+    not read from for that zone until it answers again, and is unhealthy
+    only if it fails for every zone.
+
+    Writes always go to the primary.  Each one bumps the zone's count in
+    *generations*, and the zone is read from the primary until a check
+    started after the write shows which secondaries have caught up.
+
+    With a *directory* shared by the workers, only the worker holding the
+    lock file there runs the checks.  It publishes the results to a file
+    the other workers load every interval, and the zones each worker reads
+    are noted in a shared table.  If the checking worker exits, another
+    takes over.  With no secondaries nothing is checked.
+    """
+
+    def __init__(
+        self,
+        primary,
+        secondaries,
+        zones,
+        interval=5.0,
+        timeout=2.0,
+        generations=None,
+        directory="",
+    ):
+        self.primary = primary
+        self.secondaries = list(secondaries)
+        self.zones = list(zones)
+        self.interval = interval
+        self.timeout = timeout
+        self.generations = generations or ZoneGenerations(self.zones)
+        self.directory = directory
+        self.serials = {server: {} for server in [primary] + self.secondaries}
+        # None until a server has been checked
+        self.healthy = {server: None for server in self.serials}
+        self.latency = {}
+        # the write count of each zone when the serials were checked
+        self.checked = {}
+        # the time each zone was last read, in whole seconds
+        self.reads = ZoneTable(self.zones, directory, READS_FILE)
+        self._chosen = {}
+        self._lock_file = None
+        self._task = None
+
+    async def start(self):
+        """check the servers now and then every interval in the background"""
+        if self.secondaries:
+            await self.update()
+            self._task = background_task(self._watch())
+
+    async def close(self):
+        """stop checking and let another worker take over"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.reads.close()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.update()
+            except (OSError, ValueError) as error:
+                logger.warning("updating the BIND server checks failed: %s", error)
+
+    def _leads(self):
+        """does this worker check the servers, taking the lock if it is free"""
+        if not self.directory:
+            return True
+        if self._lock_file is None:
+            self._lock_file = try_lock(os.path.join(self.directory, MONITOR_LOCK))
+            if self._lock_file is not None:
+                logger.info("worker %s checks the BIND servers", os.getpid())
+        return self._lock_file is not None
+
+    async def update(self):
+        """check the servers, or load the checks of the worker that does"""
+        if self._leads():
+            await self.check()
+            if self.directory:
+                self._publish()
+        else:
+            self._load()
+
+    def recent_zones(self):
+        """the zones read in the last RECENT_CHECKS intervals"""
+        since = time.time() - self.interval * RECENT_CHECKS
+        return [zone for zone in self.zones if self.reads.get(zone) >= since]
+
+    async def check(self):
+        """query the SOA of every recently read zone on every server"""
+        zones = self.recent_zones()
+        generations = {zone: self.generations.get(zone) for zone in zones}
+        await asyncio.gather(
+            *(self.check_server(server, zones) for server in self.serials)
+        )
+        # zones no longer read are checked again before a secondary is used
+        self.checked = generations
+
+    async def check_server(self, server, zones):
+        """update the health, latency and serials of one server"""
+        label = server_label(server)
+
+        async def timed(zone_name):
+            start = time.perf_counter()
+            serial = await soa_query(server, zone_name, self.timeout)
+            return (serial, time.perf_counter() - start)
+
+        results = await asyncio.gather(
+            *(timed(zone) for zone in zones), return_exceptions=True
+        )
+        serials = {}
+        round_trips = []
+        failed = None
+        for (zone, result) in zip(zones, results):
+            # KeyError is an answer without the SOA, a zone the server lacks
+            if isinstance(
+                result, (dns.exception.DNSException, EOFError, OSError, KeyError)
+            ):
+                failed = result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                (serials[zone], rtt) = result
+                round_trips.append(rtt)
+        self.serials[server] = serials
+        if not zones:
+            return
+        if not round_trips:
+            if self.healthy[server] is not False:
+                logger.warning("BIND server %s failed its check: %s", label, failed)
+            self.healthy[server] = False
+            SERVER_UP.labels(label).set(0)
+            return
+        if failed is not None:
+            logger.debug("BIND server %s failed a zone check: %s", label, failed)
+        sample = sum(round_trips) / len(round_trips)
+        previous = self.latency.get(server)
+        if previous is not None:
+            sample = previous + LATENCY_WEIGHT * (sample - previous)
+        self.latency[server] = sample
+        SERVER_LATENCY.labels(label).set(sample)
+        if self.healthy[server] is False:
+            logger.info("BIND server %s passed its check", label)
+        self.healthy[server] = True
+        SERVER_UP.labels(label).set(1)
+
+    def _publish(self):
+        """write the results of a check for the other workers"""
+        path = os.path.join(self.directory, MONITOR_FILE)
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w", encoding="utf-8") as results:
+            json.dump(
+                {
+                    "checked": self.checked,
+                    "servers": [
+                        [
+                            list(server),
+                            self.healthy[server],
+                            self.latency.get(server),
+                            self.serials[server],
+                        ]
+                        for server in self.serials
+                    ],
+                },
+                results,
+            )
+        os.replace(partial, path)
+
+    def _load(self):
+        """read the results the checking worker last published"""
+        try:
+            with open(
+                os.path.join(self.directory, MONITOR_FILE), encoding="utf-8"
+            ) as results:
+                published = json.load(results)
+        except FileNotFoundError:
+            return
+        for (server, healthy, latency, serials) in published["servers"]:
+            server = Server(*server)
+            if server in self.serials:
+                self.healthy[server] = healthy
+                self.latency[server] = latency
+                self.serials[server] = serials
+        self.checked = published["checked"]
+
+    def choose(self, zone_name, serial=None):
+        """the server to read a zone from, one holding serial if it is
+        given, otherwise the serial last seen on the primary
+        """
+        now = int(time.time())
+        if self.reads.get(zone_name) != now:
+            self.reads.set(zone_name, now)
+        if serial is None and self.checked.get(zone_name) == self.generations.get(
+            zone_name
+        ):
+            serial = self.serials[self.primary].get(zone_name)
+        current = [
+            server
+            for server in self.secondaries
+            if self.healthy[server]
+            and serial is not None
+            and self.serials[server].get(zone_name) == serial
+        ]
+        server = min(current, key=self.latency.get) if current else self.primary
+        if self._chosen.get(zone_name) != server:
+            logger.info("reading zone %s from %s", zone_name, server_label(server))
+            self._chosen[zone_name] = server
+        return server
@@ -0,0 +1,72 @@
+""" Settings for the api, read from environment variables """
+from typing import Dict, FrozenSet, List
+from pydantic import BaseSettings
+from .ratelimit import KINDS, Limit, parse_limit
+from .servers import Server, parse_servers
+
+
+class Settings(BaseSettings):
+    """api settings, each read from the environment variable of the same
+    name in upper case, so bind_server comes from BIND_SERVER
+    """
+
+    bind_server: str
+    bind_port: int = 53
+    tsig_username: str
+    tsig_password: str
+    bind_allowed_zones: str
+    logging_application_name: str
+    logging_dir: str = "./logs"
+    audit_log_format: str = "text"
+    api_key_file: str = "apikeys.pass"
+    api_key_reload_interval: float = 2
+    zone_cache_max_age: float = 5
+    zone_snapshot_dir: str = ""
+    worker_state_dir: str = ""
+    answer_cache_size: int = 10000
+    write_coalesce_window: float = 0
+    write_coalesce_max: int = 50
+    bind_pool_size: int = 4
+    bind_pool_idle_timeout: float = 20
+    bind_check_interval: float = 5
+    rate_limit_read: str = ""
+    rate_limit_write: str = ""
+    rate_limit_xfr: str = ""
+    rate_limit_wait: float = 1
+    max_concurrent_xfr: int = 4
+    change_poll_interval: float = 1
+    change_journal_size: int = 100
+    idempotency_max_keys: int = 10000
+    idempotency_ttl: float = 3600
+    server_timing: bool = True
+    profile_api_keys: str = ""
+
+    @property
+    def servers(self) -> List[Server]:
+        """the BIND servers, the primary first and then any secondaries"""
+        return parse_servers(self.bind_server, self.bind_port)
+
+    @property
+    def rate_limits(self) -> Dict[str, Limit]:
+        """the rate limits of keys that set none of their own, by kind"""
+        limits = {}
+        for kind in KINDS:
+            text = getattr(self, f"rate_limit_{kind}")
+            if text:
+                limits[kind] = parse_limit(text)
+        return limits
+
+    @property
+    def profile_keys(self) -> FrozenSet[str]:
+        """the names of the api keys that may profile their requests"""
+        return frozenset(
+            name.strip() for name in self.profile_api_keys.split(",") if name.strip()
+        )
+
+    @property
+    def allowed_zones(self) -> List[str]:
+        """the allowed zones, fully qualified"""
+        return [
+            f"{zone.strip().rstrip('.')}."
+            for zone in self.bind_allowed_zones.split(",")
+        ]
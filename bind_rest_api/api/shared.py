@@ -0,0 +1,133 @@
+""" State the workers of one api share through files in a directory
+
+`bindapi serve` points WORKER_STATE_DIR at a fresh directory when it starts
+more than one worker.  Without a directory everything here is kept in the
+memory of the one process instead.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import sqlite3
+import contextlib
+
+GENERATIONS_FILE = "generations"
+DATABASE_FILE = "state.sqlite3"
+COUNTER = struct.Struct("<Q")
+
+
+def open_lock(path):
+    """open a lock file, creating it if needed"""
+    return open(path, "a+b")  # pylint: disable=consider-using-with
+
+
+def try_lock(path):
+    """the open lock file at path if this process could lock it, else None
+
+    The lock is held until the file is closed, or the process exits.
+    """
+    lock_file = open_lock(path)
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def open_database(directory):
+    """a connection to the sqlite database the workers share in directory
+
+    The connection is in autocommit mode, so changes that must be made
+    together go in a transaction().
+    """
+    database = sqlite3.connect(
+        os.path.join(directory, DATABASE_FILE),
+        timeout=5,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    database.execute("PRAGMA journal_mode=WAL")
+    # losing the last changes to a power cut is fine for this state
+    database.execute("PRAGMA synchronous=OFF")
+    return database
+
+
+@contextlib.contextmanager
+def transaction(database):
+    """run statements as one transaction, taking the write lock up front so
+    a read and the write based on it can't interleave with another worker's
+    """
+    database.execute("BEGIN IMMEDIATE")
+    try:
+        yield database
+    except BaseException:
+        database.execute("ROLLBACK")
+        raise
+    database.execute("COMMIT")
+
+
+class ZoneTable:
+    """A 64 bit number for each allowed zone, 0 to begin with
+
+    With a directory the numbers are the file *name* there, mapped by every
+    worker, so reading one costs no more than reading a dict.  Without one
+    they are kept in memory.
+    """
+
+    def __init__(self, zones, directory="", name=""):
+        self._positions = {zone: position for (position, zone) in enumerate(zones)}
+        size = max(len(self._positions), 1) * COUNTER.size
+        self._file = None
+        if not directory:
+            self._numbers = bytearray(size)
+            return
+        self._file = open_lock(os.path.join(directory, name))
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._numbers = mmap.mmap(self._file.fileno(), size)
+
+    def get(self, zone_name):
+        """the number of a zone, 0 for zones not allowed"""
+        position = self._positions.get(zone_name)
+        if position is None:
+            return 0
+        return COUNTER.unpack_from(self._numbers, position * COUNTER.size)[0]
+
+    def set(self, zone_name, value):
+        """set the number of a zone, ignoring zones not allowed"""
+        position = self._positions.get(zone_name)
+        if position is not None:
+            COUNTER.pack_into(self._numbers, position * COUNTER.size, value)
+
+    def close(self):
+        """unmap the shared numbers"""
+        if self._file is not None:
+            self._numbers.close()
+            self._file.close()
+            self._file = None
+
+
+class ZoneGenerations(ZoneTable):
+    """A count of the writes made to each allowed zone through any worker
+
+    Counting a write takes an exclusive lock on the shared file.
+    """
+
+    def __init__(self, zones, directory=""):
+        super().__init__(zones, directory, GENERATIONS_FILE)
+
+    def bump(self, zone_name):
+        """count a write to a zone"""
+        if self._file is None:
+            self.set(zone_name, self.get(zone_name) + 1)
+            return
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self.set(zone_name, self.get(zone_name) + 1)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
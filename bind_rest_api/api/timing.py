@@ -0,0 +1,213 @@
+""" Timing spans of the stages of each request, and profiles of single requests
+
+TimingMiddleware gives each request a Timings, found through a context
+variable, so code anywhere below a handler can time a stage with
+``with span("bind"):`` without the Timings being passed down.  Spans of the
+same name add up.  Outside a request, or with SERVER_TIMING off, span()
+returns a shared no-op context manager.  Tasks started while serving a
+request would inherit its Timings, so background tasks are started with
+background_task() instead.
+
+The spans are sent back in a Server-Timing header and written to the debug
+log:
+
+* validate: reading and validating the request, less auth and helper
+* auth: checking the api key and rate limit
+* helper: finding the zone and starting the UPDATE
+* build: encoding and signing DNS messages
+* bind: waiting on BIND for answers to queries and UPDATEs
+* xfr: zone transfers
+* serialize: rendering the response body
+* total: the whole request, up to the response headers
+"""
+import os
+import time
+import asyncio
+import cProfile
+import logging
+import functools
+import contextlib
+import contextvars
+from fastapi.routing import APIRoute
+
+logger = logging.getLogger("bind-api")
+
+# the header an allowed api key sets to profile its request
+PROFILE_HEADER = "x-profile"
+
+_timings = contextvars.ContextVar("timings", default=None)
+NO_SPAN = contextlib.nullcontext()
+
+
+class Timings:
+    """The spans of one request, in seconds by name"""
+
+    # a profile of one request at a time, since a profile sees the whole worker
+    profiling = False
+
+    __slots__ = ("start", "spans", "endpoint_end", "profiler")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.endpoint_end = None
+        self.profiler = None
+
+    def add(self, name, duration):
+        """add duration to the span name"""
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def header(self):
+        """the Server-Timing header value"""
+        return ", ".join(
+            f"{name};dur={duration * 1000:.2f}"
+            for (name, duration) in self.spans.items()
+        )
+
+
+class Span:
+    """context manager adding the time it is entered for to a span"""
+
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+def span(name):
+    """a context manager timing a stage of the current request"""
+    timings = _timings.get()
+    if timings is None:
+        return NO_SPAN
+    return Span(timings, name)
+
+
+def background_task(coroutine):
+    """start coroutine as a task outside the current request, so its spans
+    are not added to a request that may have finished
+    """
+    context = contextvars.copy_context()
+    context.run(_timings.set, None)
+    return context.run(asyncio.ensure_future, coroutine)
+
+
+def start_profile():
+    """profile the rest of the current request, unless another request is
+    being profiled
+
+    Returns whether the profile was started.
+    """
+    timings = _timings.get()
+    if timings is None or Timings.profiling:
+        return False
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler, outside the api, is running
+        return False
+    Timings.profiling = True
+    timings.profiler = profiler
+    return True
+
+
+def timed_endpoint(call):
+    """wrap an async endpoint to mark where validating the request ended
+    and the handler ran
+    """
+    if not asyncio.iscoroutinefunction(call):
+        return call
+
+    @functools.wraps(call)
+    async def endpoint(**values):
+        timings = _timings.get()
+        if timings is None:
+            return await call(**values)
+        spans = timings.spans
+        timings.add(
+            "validate",
+            time.perf_counter()
+            - timings.start
+            - spans.get("auth", 0.0)
+            - spans.get("helper", 0.0),
+        )
+        try:
+            return await call(**values)
+        finally:
+            timings.endpoint_end = time.perf_counter()
+
+    return endpoint
+
+
+class TimedRoute(APIRoute):
+    """An APIRoute whose endpoint records the validate span"""
+
+    def get_route_handler(self):
+        self.dependant.call = timed_endpoint(self.dependant.call)
+        return super().get_route_handler()
+
+
+class TimingMiddleware:
+    """ASGI middleware giving each request its Timings, adding the
+    Server-Timing header and saving any profile to *profile_dir*
+    """
+
+    def __init__(self, app, profile_dir="."):
+        self.app = app
+        self.profile_dir = profile_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = Timings()
+        token = _timings.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                if timings.endpoint_end is not None:
+                    timings.add("serialize", now - timings.endpoint_end)
+                timings.add("total", now - timings.start)
+                message["headers"] = list(message.get("headers", ())) + [
+                    (b"server-timing", timings.header().encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+            if timings.profiler is not None:
+                self.save_profile(scope, timings.profiler)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "%s %s timings: %s",
+                    scope["method"],
+                    scope["path"],
+                    timings.header(),
+                )
+
+    def save_profile(self, scope, profiler):
+        """stop a request's profile and write it for pstats or snakeviz"""
+        profiler.disable()
+        Timings.profiling = False
+        endpoint = scope.get("endpoint")
+        handler = endpoint.__name__ if endpoint is not None else "unmatched"
+        path = os.path.join(
+            self.profile_dir,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{handler}.prof",
+        )
+        profiler.dump_stats(path)
+        logger.info(
+            "profile of %s %s saved to %s", scope["method"], scope["path"], path
+        )
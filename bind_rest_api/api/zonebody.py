@@ -0,0 +1,138 @@
+""" Encoded and compressed zone response bodies, kept per SOA serial """
+import io
+import os
+import gzip
+
+try:
+    import zstandard
+except ImportError:  # optional, see the fast extra
+    zstandard = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# the subdirectory of ZONE_SNAPSHOT_DIR the workers share bodies in
+BODIES_DIR = "bodies"
+
+
+def compress(body, encoding):
+    """body compressed with a content-coding"""
+    if encoding == "gzip":
+        # mtime=0 so the same body always compresses to the same bytes,
+        # through GzipFile as gzip.compress() only takes mtime from 3.8
+        compressed = io.BytesIO()
+        with gzip.GzipFile(
+            fileobj=compressed, mode="wb", compresslevel=GZIP_LEVEL, mtime=0
+        ) as gzip_file:
+            gzip_file.write(body)
+        return compressed.getvalue()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return body
+
+
+def choose_encoding(accept_encoding):
+    """the content-coding to answer an Accept-Encoding header with, zstd
+    when it is accepted and zstandard is installed, then gzip, otherwise
+    the body as it is ("identity")
+    """
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        (coding, *params) = [field.strip().lower() for field in part.split(";")]
+        refused = False
+        for param in params:
+            (name, _, value) = param.partition("=")
+            try:
+                refused = refused or (name.strip() == "q" and float(value) == 0)
+            except ValueError:
+                continue
+        if coding and not refused:
+            accepted.add(coding)
+    if zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def etag(serial):
+    """the entity tag of a zone at a serial, weak since the compressed
+    forms differ in bytes
+    """
+    return f'W/"{serial}"'
+
+
+def etag_matches(if_none_match, serial):
+    """does an If-None-Match header name the zone at serial"""
+    if if_none_match is None:
+        return False
+    tags = set()
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # weak comparison, W/"1" matches "1"
+        tags.add(tag[2:] if tag.startswith("W/") else tag)
+    return "*" in tags or f'"{serial}"' in tags
+
+
+class ZoneBodies:
+    """The encoded bodies of the current version of each zone
+
+    A body is rendered once per zone serial and export format, and each
+    compressed form on first request, so fetching an unchanged zone again
+    only copies bytes.  Only the latest serial of each zone is kept.
+
+    With a *directory* the bodies are files there, one directory per zone,
+    that every worker sharing it reads, so a body is rendered once and held
+    once, in the page cache, rather than in each worker.
+    """
+
+    def __init__(self, directory=""):
+        self.directory = directory
+        self._bodies = {}
+
+    def get(self, zone_name, serial, render, encoding="identity", key="json"):
+        """the body of zone_name at serial in an encoding, calling
+        render() for the body if the one for key is not kept
+        """
+        if self.directory:
+            return self._shared(zone_name, serial, render, encoding, key)
+        (kept_serial, encoded) = self._bodies.get(zone_name, (None, {}))
+        if kept_serial != serial:
+            encoded = {}
+            self._bodies[zone_name] = (serial, encoded)
+        encoded = encoded.setdefault(key, {})
+        if "identity" not in encoded:
+            encoded["identity"] = render()
+        if encoding not in encoded:
+            encoded[encoding] = compress(encoded["identity"], encoding)
+        return encoded[encoding]
+
+    def _shared(self, zone_name, serial, render, encoding, key):
+        """get() from the files in the directory, writing the body if it is
+        not there
+        """
+        directory = os.path.join(self.directory, zone_name)
+        path = os.path.join(directory, f"{serial}.{key}.{encoding}")
+        try:
+            with open(path, "rb") as body_file:
+                return body_file.read()
+        except FileNotFoundError:
+            pass
+        if encoding == "identity":
+            body = render()
+        else:
+            body = compress(
+                self._shared(zone_name, serial, render, "identity", key), encoding
+            )
+        os.makedirs(directory, exist_ok=True)
+        # replaced in one step so no worker reads half a body
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as body_file:
+            body_file.write(body)
+        os.replace(partial, path)
+        for entry in os.listdir(directory):
+            if not entry.startswith(f"{serial}.") and not entry.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass  # removed by another worker
+        return body
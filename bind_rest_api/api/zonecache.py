@@ -0,0 +1,307 @@
+""" In-memory cache of parsed zones, kept current with IXFR """
+import time
+import functools
+import asyncio
+import logging
+import dns.asyncquery
+import dns.exception
+import dns.message
+import dns.rdatatype
+import dns.zone
+from .metrics import READS, TRANSFER_DURATION, TRANSFER_RECORDS
+from .ratelimit import TransferSlots
+from .servers import Server, server_label
+from .timing import span
+
+logger = logging.getLogger("bind-api")
+
+
+def zone_serial(zone):
+    """return the SOA serial of a parsed zone"""
+    return zone.find_rdataset(zone.origin, dns.rdatatype.SOA)[0].serial
+
+
+def zone_records(zone):
+    """the records of a parsed zone, other than the SOA, as a frozenset of
+    (name, ttl, rdata)
+    """
+    return frozenset(
+        (name, ttl, rdata)
+        for (name, ttl, rdata) in zone.iterate_rdatas()
+        if rdata.rdtype != dns.rdatatype.SOA
+    )
+
+
+class ZoneChanges:
+    """The records deleted from and added to a zone by the IXFR diff
+    sequences applied to it, netted out, other than the SOA
+
+    *replaced* is set if the server answered with the whole zone instead.
+    """
+
+    def __init__(self):
+        self.deletes = set()
+        self.adds = set()
+        self.replaced = False
+
+    def delete(self, record):
+        """note a record the transfer deleted"""
+        if record in self.adds:
+            self.adds.remove(record)
+        else:
+            self.deletes.add(record)
+
+    def add(self, record):
+        """note a record the transfer added"""
+        if record in self.deletes:
+            self.deletes.remove(record)
+        else:
+            self.adds.add(record)
+
+
+class RecordingTransaction:
+    """A zone transaction noting the records it deletes and adds in
+    ZoneChanges once it commits
+    """
+
+    def __init__(self, transaction, changes):
+        self._transaction = transaction
+        self._changes = changes
+        self._applied = []
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._transaction.rollback()
+        return False
+
+    def delete_exact(self, name, rdataset):
+        """delete the records of rdataset, noting each one"""
+        self._transaction.delete_exact(name, rdataset)
+        self._note(self._changes.delete, name, rdataset)
+
+    def add(self, name, rdataset):
+        """add the records of rdataset, noting each one"""
+        self._transaction.add(name, rdataset)
+        self._note(self._changes.add, name, rdataset)
+
+    def _note(self, apply, name, rdataset):
+        if rdataset.rdtype != dns.rdatatype.SOA:
+            self._applied.extend(
+                functools.partial(apply, (name, rdataset.ttl, rdata))
+                for rdata in rdataset
+            )
+
+    def commit(self):
+        """commit the transaction and its changes"""
+        self._transaction.commit()
+        for apply in self._applied:
+            apply()
+
+
+class RecordingZone:
+    """Stands in for a zone in an inbound transfer, recording what its
+    transactions change in *changes*
+    """
+
+    def __init__(self, zone, changes):
+        self._zone = zone
+        self._changes = changes
+
+    def __getattr__(self, name):
+        return getattr(self._zone, name)
+
+    def writer(self, replacement=False):
+        """a transaction on the zone that records its changes"""
+        if replacement:
+            self._changes.replaced = True
+        return RecordingTransaction(self._zone.writer(replacement), self._changes)
+
+
+class ZoneCache:
+    """Cache of parsed zones keyed by their SOA serial
+
+    The first request for a zone transfers it with AXFR.  After that a cheap
+    SOA query tells us whether the zone moved on, and if it did the cached
+    copy is brought forward with IXFR from the cached serial.  AXFR is only
+    used again if the IXFR fails.  The SOA is always asked of *server*, but
+    the transfer can come from any server *select* returns as holding that
+    serial, falling back to *server* if that transfer fails.  Transfers
+    wait for one of the TransferSlots in *slots*, if given.
+
+    Callbacks given to listen() for a zone are called with the serials
+    before and after each transfer that moves the cached zone on, and the
+    sets of (name, ttl, rdata) records it deleted and added.  These come
+    from the IXFR diff sequences, so only a fall back to AXFR costs a
+    comparison of the whole zone.
+    """
+
+    def __init__(
+        self,
+        server,
+        port=53,
+        max_age=5.0,
+        timeout=10.0,
+        query=None,
+        select=None,
+        slots=None,
+    ):
+        self.server = server
+        self.port = port
+        # coroutine used for SOA queries, plain UDP unless one is given
+        self.query = query or functools.partial(
+            dns.asyncquery.udp, where=server, port=port
+        )
+        # picks the Server to transfer a zone at a serial from
+        self.select = select or (lambda zone_name, serial: Server(server, port))
+        self.slots = slots or TransferSlots(0)
+        # seconds a zone is served without checking the SOA serial
+        self.max_age = max_age
+        self.timeout = timeout
+        self._zones = {}
+        self._checked = {}
+        self._locks = {}
+        self._listeners = {}
+
+    def _lock(self, zone_name):
+        return self._locks.setdefault(zone_name, asyncio.Lock())
+
+    async def soa(self, zone_name):
+        """ask the server for the current SOA record of a zone"""
+        query = dns.message.make_query(zone_name, dns.rdatatype.SOA)
+        response = await self.query(query, timeout=self.timeout)
+        rrset = response.find_rrset(
+            response.answer,
+            query.question[0].name,
+            query.question[0].rdclass,
+            dns.rdatatype.SOA,
+        )
+        return rrset[0]
+
+    async def soa_serial(self, zone_name):
+        """ask the server for the current SOA serial of a zone"""
+        return (await self.soa(zone_name)).serial
+
+    async def get(self, zone_name):
+        """return the current parsed zone, transferring it if needed"""
+        async with self._lock(zone_name):
+            zone = self._zones.get(zone_name)
+            if (
+                zone is not None
+                and time.monotonic() - self._checked.get(zone_name, 0) < self.max_age
+            ):
+                return zone
+            serial = await self.soa_serial(zone_name)
+            if zone is None or zone_serial(zone) != serial:
+                previous = zone
+                start = None if zone is None else zone_serial(zone)
+                changes = ZoneChanges()
+                await self.slots.acquire()
+                try:
+                    zone = await self._fetch(zone_name, zone, serial, changes)
+                finally:
+                    self.slots.release()
+                if previous is not None:
+                    self._changed(zone_name, start, previous, zone, changes)
+                self._zones[zone_name] = zone
+            self._checked[zone_name] = time.monotonic()
+            return zone
+
+    async def current_serial(self, zone_name):
+        """the serial of the current parsed zone, transferring it if needed"""
+        return zone_serial(await self.get(zone_name))
+
+    def invalidate(self, zone_name):
+        """force the next read of a zone to check the server for changes"""
+        self._checked.pop(zone_name, None)
+
+    def listen(self, zone_name, callback):
+        """call callback(start, serial, deletes, adds) for each change to a
+        cached zone
+        """
+        self._listeners.setdefault(zone_name, []).append(callback)
+
+    def unlisten(self, zone_name, callback):
+        """stop calling callback for changes to a zone"""
+        listeners = self._listeners.get(zone_name, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners:
+            self._listeners.pop(zone_name, None)
+
+    def _changed(self, zone_name, start, previous, zone, changes):
+        listeners = self._listeners.get(zone_name)
+        if not listeners:
+            return
+        (deletes, adds) = (changes.deletes, changes.adds)
+        if changes.replaced or zone is not previous:
+            # an AXFR, which left the zone it replaced as it was
+            (old, new) = (zone_records(previous), zone_records(zone))
+            (deletes, adds) = (old - new, new - old)
+        for callback in list(listeners):
+            callback(start, zone_serial(zone), deletes, adds)
+
+    async def _fetch(self, zone_name, zone, serial, changes):
+        source = self.select(zone_name, serial)
+        primary = Server(self.server, self.port)
+        try:
+            return await self._transfer(zone_name, zone, source, changes)
+        except (dns.exception.DNSException, EOFError, OSError) as error:
+            if source == primary:
+                raise
+            logger.warning(
+                "transfer of %s from %s failed, using %s: %s",
+                zone_name,
+                server_label(source),
+                server_label(primary),
+                error,
+            )
+        return await self._transfer(zone_name, zone, primary, changes)
+
+    async def _transfer(self, zone_name, zone, source, changes):
+        """the zone brought forward with IXFR, noting what changed in
+        changes, or a new zone loaded by AXFR
+        """
+        label = server_label(source)
+        if zone is not None:
+            try:
+                # a zone with an SOA makes inbound_xfr ask for IXFR
+                READS.labels(label, "ixfr").inc()
+                with TRANSFER_DURATION.labels("ixfr").time(), span("xfr"):
+                    await dns.asyncquery.inbound_xfr(
+                        source.host,
+                        RecordingZone(zone, changes),
+                        port=source.port,
+                        lifetime=self.timeout,
+                    )
+                logger.debug(
+                    "zone %s updated to %s by IXFR from %s",
+                    zone_name,
+                    zone_serial(zone),
+                    label,
+                )
+                return zone
+            except (dns.exception.DNSException, EOFError, OSError) as error:
+                logger.debug(
+                    "IXFR of %s failed, falling back to AXFR: %s", zone_name, error
+                )
+        zone = dns.zone.Zone(zone_name)
+        READS.labels(label, "axfr").inc()
+        with TRANSFER_DURATION.labels("axfr").time(), span("xfr"):
+            await dns.asyncquery.inbound_xfr(
+                source.host, zone, port=source.port, lifetime=self.timeout
+            )
+        TRANSFER_RECORDS.labels("axfr").observe(
+            sum(len(rdataset) for (_, rdataset) in zone.iterate_rdatasets())
+        )
+        logger.debug(
+            "zone %s loaded at %s by AXFR from %s", zone_name, zone_serial(zone), label
+        )
+        return zone
@@ -0,0 +1,69 @@
+""" Longest-match lookup of the zones the api may change """
+import dns.exception
+import dns.name
+
+
+# key holding the zone name in a trie node, labels are always bytes
+ZONE = None
+
+
+def _reversed_labels(domain):
+    """return the lowercased labels of domain from the root down, or None"""
+    try:
+        return [label.lower() for label in reversed(dns.name.from_text(domain).labels)]
+    except dns.exception.DNSException:
+        return None
+
+
+class ZoneIndex:
+    """Allowed zones in a trie keyed on reversed, lowercased name labels
+
+    Finding the zone for a domain walks one trie node per label, so the cost
+    depends on the depth of the name and not on how many zones are allowed.
+    The most specific zone wins, so a delegated child zone is picked over
+    its parent.
+    """
+
+    def __init__(self, zones=()):
+        self._root = {}
+        self._zones = []
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        """allow a zone, given as text ending with a period"""
+        node = self._root
+        for label in _reversed_labels(zone):
+            node = node.setdefault(label, {})
+        if ZONE not in node:
+            self._zones.append(zone)
+        node[ZONE] = zone
+
+    def find(self, domain):
+        """return the most specific allowed zone containing domain, or None"""
+        zone = None
+        node = self._root
+        for label in _reversed_labels(domain) or ():
+            node = node.get(label)
+            if node is None:
+                break
+            zone = node.get(ZONE, zone)
+        return zone
+
+    def get(self, zone):
+        """return the allowed zone named exactly zone, or None"""
+        node = self._root
+        for label in _reversed_labels(zone) or ():
+            node = node.get(label)
+            if node is None:
+                return None
+        return node.get(ZONE)
+
+    def __contains__(self, zone):
+        return self.get(zone) is not None
+
+    def __iter__(self):
+        return iter(self._zones)
+
+    def __len__(self):
+        return len(self._zones)
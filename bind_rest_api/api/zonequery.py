@@ -0,0 +1,170 @@
+""" Indexed, filtered and paginated queries over a parsed zone """
+import base64
+import bisect
+from collections import OrderedDict
+import dns.rdatatype
+
+
+class CursorError(ValueError):
+    """a cursor that cannot be decoded"""
+
+
+class CursorExpired(CursorError):
+    """a cursor for a zone version that is no longer kept"""
+
+
+def name_key(name):
+    """a sort key putting names in DNS canonical order, so the names at and
+    below any name sort together straight after it
+    """
+    return tuple(label.lower() for label in reversed(name.labels))
+
+
+def rdata_text(rdata):
+    """the text rdata filters match, TXT strings without their quotes"""
+    if rdata.rdtype == dns.rdatatype.TXT:
+        return b"".join(rdata.strings).decode(errors="replace")
+    return rdata.to_text()
+
+
+def _text_range(keys, prefix):
+    """the slice of sorted text keys starting with prefix"""
+    start = bisect.bisect_left(keys, prefix)
+    if not prefix:
+        return (start, len(keys))
+    # the first key after everything starting with prefix
+    after = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (start, bisect.bisect_left(keys, after))
+
+
+def encode_cursor(serial, offset):
+    """an opaque cursor for the next page"""
+    return base64.urlsafe_b64encode(f"{serial}:{offset}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """return (serial, offset) from a cursor"""
+    try:
+        (serial, offset) = base64.urlsafe_b64decode(cursor.encode()).split(b":")
+        return (int(serial), int(offset))
+    except ValueError as error:
+        raise CursorError("invalid cursor") from error
+
+
+class ZoneView:
+    """The records of one version of a zone with indexes for filtering
+
+    Records, other than the SOA, are kept as (name, ttl, rdata) with names
+    relative to the origin.  Each index is a list of records sorted on one
+    key with a parallel list of the keys, built on first use for all types
+    and for each type separately.  A filter then finds its first record
+    with a binary search and a page costs its own size, plus any records a
+    second filter skips over.
+    """
+
+    def __init__(self, serial, records):
+        self.serial = serial
+        self.records = [
+            (name, ttl, rdata)
+            for (name, ttl, rdata) in records
+            if rdata.rdtype != dns.rdatatype.SOA
+        ]
+        self._indexes = {}
+
+    def index(self, kind, rdtype=None):
+        """return (keys, records) sorted by "name", "text" or "rdata" keys"""
+        if (kind, rdtype) not in self._indexes:
+            key = {
+                "name": lambda record: name_key(record[0]),
+                "text": lambda record: record[0].to_text().lower(),
+                "rdata": lambda record: rdata_text(record[2]),
+            }[kind]
+            records = self.records
+            if rdtype is not None:
+                records = [r for r in records if r[2].rdtype == rdtype]
+            keyed = sorted(((key(r), r) for r in records), key=lambda k: k[0])
+            self._indexes[(kind, rdtype)] = (
+                [k for (k, _) in keyed],
+                [r for (_, r) in keyed],
+            )
+        return self._indexes[(kind, rdtype)]
+
+    def query(self, rdtype=None, suffix=None, prefix=None, rdata=None):
+        """return (records, start, end, check) where records[start:end] are
+        the candidates in the order of the index used and check(record)
+        applies the filters that index does not
+        """
+        if suffix is not None:
+            kind = "name"
+        elif prefix is not None:
+            kind = "text"
+        elif rdata is not None:
+            kind = "rdata"
+        else:
+            kind = "name"
+        (keys, records) = self.index(kind, rdtype)
+        if suffix is not None:
+            low = name_key(suffix)
+            start = bisect.bisect_left(keys, low)
+            end = len(keys)
+            if low:
+                # the first name after everything at and below suffix
+                end = bisect.bisect_left(keys, low[:-1] + (low[-1] + b"\0",))
+        elif prefix is not None:
+            (start, end) = _text_range(keys, prefix.lower())
+        elif rdata is not None:
+            (start, end) = _text_range(keys, rdata)
+        else:
+            (start, end) = (0, len(keys))
+        checks = []
+        if prefix is not None and kind != "text":
+            checks.append(lambda r: r[0].to_text().lower().startswith(prefix.lower()))
+        if rdata is not None and kind != "rdata":
+            checks.append(lambda r: rdata_text(r[2]).startswith(rdata))
+        return (records, start, end, lambda r: all(check(r) for check in checks))
+
+    def page(self, limit, cursor=None, **filters):
+        """return (records, next cursor or None) for one page of a query"""
+        (records, start, end, check) = self.query(**filters)
+        if cursor is not None:
+            (_, offset) = decode_cursor(cursor)
+            start = max(start, offset)
+        found = []
+        position = start
+        while position < end and len(found) < limit:
+            if check(records[position]):
+                found.append(records[position])
+            position += 1
+        if position < end:
+            return (found, encode_cursor(self.serial, position))
+        return (found, None)
+
+
+class ZoneViews:
+    """The views of the last *keep* versions of each zone, so a client
+    paging through a zone keeps seeing the version it started on
+    """
+
+    def __init__(self, keep=4):
+        self.keep = keep
+        self._views = {}
+
+    def get(self, zone_name, serial, records):
+        """the view of a zone at serial, calling records() for its (name,
+        ttl, rdata) records if that version has no view yet
+        """
+        views = self._views.setdefault(zone_name, OrderedDict())
+        if serial not in views:
+            views[serial] = ZoneView(serial, records())
+            while len(views) > self.keep:
+                views.popitem(last=False)
+        views.move_to_end(serial)
+        return views[serial]
+
+    def find(self, zone_name, cursor):
+        """the view a cursor was issued from"""
+        (serial, _) = decode_cursor(cursor)
+        view = self._views.get(zone_name, {}).get(serial)
+        if view is None:
+            raise CursorExpired("the zone version this cursor is for has expired")
+        return view
@@ -0,0 +1,384 @@
+""" Zone snapshots shared by the workers of one api through memory maps
+
+One worker, the one holding the lock file in the snapshot directory, owns
+the zone transfers.  It keeps its zone cache current with IXFR as usual
+and publishes every new version of a zone as an immutable snapshot file,
+replacing the previous one.  The other workers map the file read-only, so
+each zone is transferred once and its records are in memory once, in the
+page cache, however many workers there are.
+
+A snapshot is laid out as:
+
+* a header: magic, version, SOA serial, name and record counts and the
+  length of the origin, followed by the origin
+* the name index: for each name, in DNS canonical order, the offset and
+  length of its text and its first record and number of records
+* the record table: for each record, its type, ttl and the offset and
+  length of its rdata text
+* the text of every name, relative to the origin, and rdata
+
+Integers are little endian.  Texts are in the form they are served in, so
+rendering a zone only slices and decodes the map.
+"""
+import os
+import time
+import mmap
+import fcntl
+import struct
+import asyncio
+import logging
+import dns.exception
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+from .timing import background_task
+from .zonecache import zone_serial
+from .zonequery import name_key
+
+logger = logging.getLogger("bind-api")
+
+MAGIC = b"BZSN"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIII")
+NAME_ENTRY = struct.Struct("<IIII")
+RECORD_ENTRY = struct.Struct("<IIII")
+
+LOCK_FILE = "owner.lock"
+SNAPSHOT_SUFFIX = "snap"
+WANT_SUFFIX = "want"
+# seconds between the owner's checks for requested zones, and between a
+# worker's checks for the snapshot it requested
+POLL_INTERVAL = 0.05
+
+
+class SnapshotError(ValueError):
+    """a file that is not a zone snapshot"""
+
+
+def encode_snapshot(zone):
+    """the snapshot of a parsed zone as bytes"""
+    origin = zone.origin.to_text().encode()
+    texts = bytearray()
+    names = []
+    records = []
+
+    def add_text(text):
+        data = text.encode()
+        texts.extend(data)
+        return (len(texts) - len(data), len(data))
+
+    for name in sorted(zone.keys(), key=name_key):
+        first = len(records)
+        for rdataset in zone[name]:
+            for rdata in rdataset:
+                records.append(
+                    RECORD_ENTRY.pack(
+                        rdataset.rdtype, rdataset.ttl, *add_text(rdata.to_text())
+                    )
+                )
+        if len(records) > first:
+            names.append(
+                NAME_ENTRY.pack(*add_text(name.to_text()), first, len(records) - first)
+            )
+    header = HEADER.pack(
+        MAGIC, VERSION, 0, zone_serial(zone), len(names), len(records), len(origin)
+    )
+    return b"".join([header, origin] + names + records + [bytes(texts)])
+
+
+def write_snapshot(path, zone):
+    """write the snapshot of a parsed zone to path, replacing the file in
+    one step so a worker never maps half of it
+    """
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "wb") as snapshot_file:
+        snapshot_file.write(encode_snapshot(zone))
+    os.replace(partial, path)
+
+
+class ZoneSnapshot:
+    """A read-only map of a snapshot file
+
+    The map stays valid after the file is replaced, until the snapshot is
+    no longer referenced.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self.inode = os.fstat(snapshot_file.fileno()).st_ino
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, _, serial, names, records, origin) = HEADER.unpack_from(
+                self._map
+            )
+        except struct.error as error:
+            raise SnapshotError(f"{path} is too short") from error
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError(f"{path} is not a version {VERSION} zone snapshot")
+        self.serial = serial
+        self.name_count = names
+        self.record_count = records
+        self.origin = self._map[HEADER.size : HEADER.size + origin].decode()
+        self._names = HEADER.size + origin
+        self._records = self._names + names * NAME_ENTRY.size
+        self._texts = self._records + records * RECORD_ENTRY.size
+
+    def _text(self, offset, length):
+        start = self._texts + offset
+        return self._map[start : start + length].decode()
+
+    def name(self, position):
+        """(name text, first record, record count) of the name at position
+        in the index
+        """
+        (offset, length, first, count) = NAME_ENTRY.unpack_from(
+            self._map, self._names + position * NAME_ENTRY.size
+        )
+        return (self._text(offset, length), first, count)
+
+    def record(self, position):
+        """(rdtype, ttl, rdata text) of the record at position"""
+        (rdtype, ttl, offset, length) = RECORD_ENTRY.unpack_from(
+            self._map, self._records + position * RECORD_ENTRY.size
+        )
+        return (rdtype, ttl, self._text(offset, length))
+
+    def nodes(self):
+        """(name text, records) for each name, in canonical order"""
+        for position in range(self.name_count):
+            (name, first, count) = self.name(position)
+            yield (
+                name,
+                [self.record(record) for record in range(first, first + count)],
+            )
+
+    def parse(self, name, rdtype, ttl, rdata):
+        """a (name, ttl, rdata) record, parsed as in a dns.zone.Zone, of a
+        name text and the record of it read from the snapshot
+        """
+        origin = dns.name.from_text(self.origin)
+        return (
+            dns.name.from_text(name, None),
+            ttl,
+            dns.rdata.from_text(dns.rdataclass.IN, rdtype, rdata, origin=origin),
+        )
+
+    def iterate_rdatas(self):
+        """the (name, ttl, rdata) records of the snapshot parsed, like
+        dns.zone.Zone.iterate_rdatas()
+        """
+        for (name, records) in self.nodes():
+            for record in records:
+                yield self.parse(name, *record)
+
+    def texts(self):
+        """the records other than the SOA as a set of (name text, rdtype,
+        ttl, rdata text)
+        """
+        return {
+            (name, *record)
+            for (name, records) in self.nodes()
+            for record in records
+            if record[0] != dns.rdatatype.SOA
+        }
+
+    def soa(self):
+        """the parsed SOA record of the zone"""
+        for (rdtype, ttl, rdata) in self.find(dns.name.empty):
+            if rdtype == dns.rdatatype.SOA:
+                return self.parse("@", rdtype, ttl, rdata)[2]
+        raise SnapshotError(f"the snapshot of {self.origin} has no SOA")
+
+    def find(self, name):
+        """the records of a name, given as a dns.name.Name relative to the
+        origin, with a binary search of the name index
+        """
+        key = name_key(name)
+        (low, high) = (0, self.name_count)
+        while low < high:
+            middle = (low + high) // 2
+            if name_key(dns.name.from_text(self.name(middle)[0], None)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.name_count:
+            (text, first, count) = self.name(low)
+            if name_key(dns.name.from_text(text, None)) == key:
+                return [self.record(record) for record in range(first, first + count)]
+        return []
+
+
+class SharedZones:
+    """The zone snapshots of a directory shared by every worker
+
+    The worker that takes the lock file publishes snapshots from its zone
+    cache.  Other workers check the zone's SOA serial every *max_age*
+    seconds, like the zone cache does, and if the snapshot is behind leave
+    a request file for the owner and wait up to *timeout* seconds for it to
+    publish.  If the owner exits its lock is released and the next worker
+    to need a snapshot takes over.
+
+    Like the zone cache, callbacks given to listen() for a zone are called
+    with the serials before and after each new snapshot this worker maps
+    and the (name, ttl, rdata) records it deleted and added, found by
+    comparing the two maps.
+    """
+
+    def __init__(self, directory, zonecache, max_age=5.0, timeout=10.0):
+        self.directory = directory
+        self.zonecache = zonecache
+        self.max_age = max_age
+        self.timeout = timeout
+        self._snapshots = {}
+        self._checked = {}
+        self._lock_file = None
+        self._task = None
+        self._listeners = {}
+
+    def _path(self, zone_name, suffix=SNAPSHOT_SUFFIX):
+        return os.path.join(self.directory, f"{zone_name}{suffix}")
+
+    def _own(self):
+        """does this worker publish the snapshots, taking the lock if it is
+        free
+        """
+        if self._lock_file is None:
+            lock_file = open(  # pylint: disable=consider-using-with
+                os.path.join(self.directory, LOCK_FILE), "wb"
+            )
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            self._task = background_task(self._serve_requests())
+            logger.info("worker %s publishes the zone snapshots", os.getpid())
+        return True
+
+    def _mapped(self, zone_name):
+        """the snapshot of a zone, mapping the file again if it was replaced"""
+        snapshot = self._snapshots.get(zone_name)
+        try:
+            inode = os.stat(self._path(zone_name)).st_ino
+        except FileNotFoundError:
+            return snapshot
+        if snapshot is None or snapshot.inode != inode:
+            previous = snapshot
+            snapshot = self._snapshots[zone_name] = ZoneSnapshot(self._path(zone_name))
+            if previous is not None and previous.serial != snapshot.serial:
+                self._changed(zone_name, previous, snapshot)
+        return snapshot
+
+    def _changed(self, zone_name, previous, snapshot):
+        listeners = self._listeners.get(zone_name)
+        if not listeners:
+            return
+        (old, new) = (previous.texts(), snapshot.texts())
+        # only the records that differ are parsed
+        deletes = {previous.parse(*record) for record in old - new}
+        adds = {snapshot.parse(*record) for record in new - old}
+        for callback in list(listeners):
+            callback(previous.serial, snapshot.serial, deletes, adds)
+
+    async def get(self, zone_name):
+        """the current snapshot of a zone"""
+        snapshot = self._snapshots.get(zone_name)
+        if (
+            snapshot is not None
+            and time.monotonic() - self._checked.get(zone_name, 0) < self.max_age
+        ):
+            return snapshot
+        if self._own():
+            snapshot = await self._publish(zone_name)
+        else:
+            serial = await self.zonecache.soa_serial(zone_name)
+            snapshot = self._mapped(zone_name)
+            if snapshot is None or snapshot.serial != serial:
+                snapshot = await self._request(zone_name, serial)
+        self._checked[zone_name] = time.monotonic()
+        return snapshot
+
+    async def current_serial(self, zone_name):
+        """the serial of the current snapshot of a zone"""
+        return (await self.get(zone_name)).serial
+
+    def invalidate(self, zone_name):
+        """force the next read of a zone to check the server for changes"""
+        self._checked.pop(zone_name, None)
+        # the owner publishes from its zone cache
+        self.zonecache.invalidate(zone_name)
+
+    def listen(self, zone_name, callback):
+        """call callback(start, serial, deletes, adds) for each new
+        snapshot of a zone
+        """
+        self._listeners.setdefault(zone_name, []).append(callback)
+
+    def unlisten(self, zone_name, callback):
+        """stop calling callback for new snapshots of a zone"""
+        listeners = self._listeners.get(zone_name, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners:
+            self._listeners.pop(zone_name, None)
+
+    async def _publish(self, zone_name):
+        zone = await self.zonecache.get(zone_name)
+        serial = zone_serial(zone)
+        snapshot = self._mapped(zone_name)
+        if snapshot is None or snapshot.serial != serial:
+            write_snapshot(self._path(zone_name), zone)
+            snapshot = self._mapped(zone_name)
+            logger.debug("published zone %s at %s", zone_name, serial)
+        return snapshot
+
+    async def _request(self, zone_name, serial):
+        """ask the owner for the snapshot of a zone at serial and wait for it"""
+        with open(self._path(zone_name, WANT_SUFFIX), "wb"):
+            pass
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+            if self._own():
+                return await self._publish(zone_name)
+            snapshot = self._mapped(zone_name)
+            if snapshot is not None and snapshot.serial == serial:
+                return snapshot
+        snapshot = self._snapshots.get(zone_name)
+        if snapshot is None:
+            raise dns.exception.Timeout(
+                f"no snapshot of zone {zone_name} was published"
+            )
+        logger.warning(
+            "snapshot of zone %s is still at %s, not %s",
+            zone_name,
+            snapshot.serial,
+            serial,
+        )
+        return snapshot
+
+    async def _serve_requests(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            for entry in os.listdir(self.directory):
+                if not entry.endswith(WANT_SUFFIX):
+                    continue
+                zone_name = entry[: -len(WANT_SUFFIX)]
+                try:
+                    os.remove(os.path.join(self.directory, entry))
+                    # the request may be for a write made through another worker
+                    self.zonecache.invalidate(zone_name)
+                    await self._publish(zone_name)
+                except (dns.exception.DNSException, EOFError, OSError) as error:
+                    logger.warning("publishing zone %s failed: %s", zone_name, error)
+
+    async def close(self):
+        """stop publishing and let another worker take over"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
@@ -0,0 +1,93 @@
+""" Streaming AXFR that yields records as transfer messages arrive """
+import time
+import socket
+import struct
+import dns.asyncbackend
+import dns.asyncquery
+import dns.exception
+import dns.inet
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.xfr
+from fastapi.responses import StreamingResponse
+from .metrics import TRANSFER_DURATION, TRANSFER_RECORDS
+
+
+async def _read_exactly(sock, count, expiration):
+    """read count bytes from a stream socket"""
+    data = b""
+    while count > 0:
+        chunk = await sock.recv(count, max(expiration - time.time(), 0))
+        if chunk == b"":
+            raise EOFError
+        count -= len(chunk)
+        data += chunk
+    return data
+
+
+async def iterate_axfr(where, zone_name, port=53, timeout=10.0):
+    """Transfer a zone with AXFR, yielding (name, ttl, rdata) tuples
+
+    Only one transfer message is held in memory at a time, so memory use does
+    not depend on the size of the zone.  Names and rdata are relativized to
+    the zone origin, the same as a zone loaded with relativize=True.  The SOA
+    is yielded first and the closing SOA is not yielded.
+    """
+    query = dns.message.make_query(zone_name, dns.rdatatype.AXFR)
+    origin = query.question[0].name
+    backend = dns.asyncbackend.get_default_backend()
+    sock = await backend.make_socket(
+        dns.inet.af_for_address(where),
+        socket.SOCK_STREAM,
+        destination=(where, port),
+        timeout=timeout,
+    )
+    start = time.perf_counter()
+    count = 0
+    async with sock:
+        await dns.asyncquery.send_tcp(sock, query, time.time() + timeout)
+        first = True
+        while True:
+            expiration = time.time() + timeout
+            (length,) = struct.unpack("!H", await _read_exactly(sock, 2, expiration))
+            # one_rr_per_rrset keeps the opening and closing SOA apart
+            response = dns.message.from_wire(
+                await _read_exactly(sock, length, expiration),
+                xfr=True,
+                origin=origin,
+                one_rr_per_rrset=True,
+            )
+            if response.rcode() != dns.rcode.NOERROR:
+                raise dns.xfr.TransferError(response.rcode())
+            for rrset in response.answer:
+                is_soa = (
+                    rrset.rdtype == dns.rdatatype.SOA and rrset.name == dns.name.empty
+                )
+                if first:
+                    if not is_soa:
+                        raise dns.exception.FormError("first RR is not the SOA")
+                    first = False
+                elif is_soa:
+                    TRANSFER_DURATION.labels("stream").observe(
+                        time.perf_counter() - start
+                    )
+                    TRANSFER_RECORDS.labels("stream").observe(count)
+                    return
+                for rdata in rrset:
+                    count += 1
+                    yield (rrset.name, rrset.ttl, rdata)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that closes its body iterator when the response
+    ends, so a client that goes away mid-stream closes the transfer under
+    it at once rather than when the generator is garbage collected
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
@@ -0,0 +1,104 @@
+""" Work out the changes that make a zone hold a desired set of records """
+from collections import namedtuple
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.update
+
+# action is "add" or "delete", name is relative to the zone origin
+Change = namedtuple("Change", "action name rdtype ttl rdata")
+
+
+def in_scope(name, subtree):
+    """is a relative name at or below the relative subtree name"""
+    return subtree is None or name == subtree or name.is_subdomain(subtree)
+
+
+def current_rrsets(records, rdtypes, subtree=None):
+    """map (name, rdtype) to (ttl, rdatas) for the managed records among
+    the (name, ttl, rdata) records of a zone, leaving out the SOA and the
+    NS records of the zone itself
+    """
+    rrsets = {}
+    for (name, ttl, rdata) in records:
+        if rdata.rdtype not in rdtypes or not in_scope(name, subtree):
+            continue
+        if name == dns.name.empty and rdata.rdtype == dns.rdatatype.NS:
+            continue
+        rrsets.setdefault((name, rdata.rdtype), (ttl, set()))[1].add(rdata)
+    return rrsets
+
+
+def desired_rrsets(origin, records, rdtypes, subtree=None):
+    """parse the records of a zone sync, a dict of name to Record-like
+    objects as get_zone returns them, into (name, rdtype) -> (ttl, rdatas)
+    relative to origin like a parsed zone
+
+    Raises ValueError for records that cannot be managed.
+    """
+    rrsets = {}
+    for (text, name_records) in records.items():
+        name = dns.name.from_text(text, origin)
+        if not name.is_subdomain(origin):
+            raise ValueError(f"{name} is not in zone {origin}")
+        name = name.relativize(origin)
+        if not in_scope(name, subtree):
+            raise ValueError(f"{name.derelativize(origin)} is outside the subtree")
+        for record in name_records:
+            rdtype = dns.rdatatype.from_text(record.rrtype)
+            if rdtype not in rdtypes or (
+                name == dns.name.empty and rdtype == dns.rdatatype.NS
+            ):
+                raise ValueError(
+                    f"{dns.rdatatype.to_text(rdtype)} records at {text} are not managed"
+                )
+            rdata = dns.rdata.from_text(
+                dns.rdataclass.IN, rdtype, record.response, origin=origin
+            )
+            (ttl, rdatas) = rrsets.setdefault((name, rdtype), (record.ttl, set()))
+            if ttl != record.ttl:
+                raise ValueError(
+                    f"{text} {dns.rdatatype.to_text(rdtype)} records differ in ttl"
+                )
+            rdatas.add(rdata)
+    return rrsets
+
+
+def diff_rrsets(current, desired):
+    """the deletes and adds that turn the current rrsets into the desired
+    ones, deletes first; a ttl change deletes and re-adds the whole rrset
+    """
+    deletes = []
+    adds = []
+    for key in sorted(set(current) | set(desired)):
+        (name, rdtype) = key
+        (old_ttl, old) = current.get(key, (None, set()))
+        (new_ttl, new) = desired.get(key, (None, set()))
+        if old and new and old_ttl != new_ttl:
+            (removed, added) = (old, new)
+        else:
+            (removed, added) = (old - new, new - old)
+        deletes.extend(
+            Change("delete", name, rdtype, old_ttl, rdata)
+            for rdata in sorted(removed, key=str)
+        )
+        adds.extend(
+            Change("add", name, rdtype, new_ttl, rdata)
+            for rdata in sorted(added, key=str)
+        )
+    return deletes + adds
+
+
+def build_update(origin, soa, changes, keyring):
+    """one UPDATE making the changes, only if the zone's SOA, and so its
+    serial, is still soa, the one the changes were worked out from
+    """
+    update = dns.update.Update(origin, keyring=keyring)
+    update.present(dns.name.empty, soa)
+    for change in changes:
+        if change.action == "delete":
+            update.delete(change.name, change.rdata)
+        else:
+            update.add(change.name, change.ttl, change.rdata)
+    return update
@@ -1,11 +1,44 @@
 """ cli entry point for setting up the fastapi app with options passed"""
 import os
 import sys
+import tempfile
+import itertools
+import importlib.util
 import click
 import uvicorn
+from pydantic import ValidationError
 from bind_rest_api.api.constants import VERSION
+from bind_rest_api.api.metrics import clear_multiprocess_dir
+from bind_rest_api.api.settings import Settings
 from .password import generate_password
-from .api import api
+from .replay import Replayer, read_entries, schedule
+
+APP_FACTORY = "bind_rest_api.api.api:create_app"
+# subcommands that never talk to BIND, so don't ask for its TSIG key
+NO_BIND_COMMANDS = frozenset(["add-key", "replay"])
+
+
+def default_workers():
+    """one worker for each core this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return os.cpu_count() or 1
+
+
+def server_implementations():
+    """the uvicorn (loop, http) implementations to use, preferring uvloop
+    and httptools when they are installed
+    """
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    return (loop, http)
+
+
+def echo_row(heading, value):
+    """print one row of the dry run output"""
+    click.echo(click.style(f"{heading:>13}: ", fg="blue"), nl=False)
+    click.echo(click.style(str(value), fg="cyan"))
 
 
 @click.group(name="bindapi", invoke_without_command=True)
@@ -22,7 +55,13 @@ from .api import api
     help="TCP port to bind to for the api service",
     show_default="8000",
 )
-@click.option("--workers", "-w", default=3, help="Number of workers to deploy")
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    help="Number of workers for bindapi serve to deploy",
+    show_default="number of cores",
+)
 @click.option("--dry-run", "-n", is_flag=True, help="Do not actually run - for testing")
 @click.option("--debug", is_flag=True, help="Pass debug flag to uvicorn")
 @click.option(
@@ -37,7 +76,6 @@ from .api import api
 @click.option(
     "--bind-user",
     envvar="TSIG_USERNAME",
-    prompt=True,
     help=(
         "The user/TSIG keyname to connect to the bind server as. "
         "Will read from environment variable TSIG_USERNAME"
@@ -46,7 +84,6 @@ from .api import api
 @click.option(
     "--bind-pass",
     envvar="TSIG_PASSWORD",
-    prompt=True,
     help=(
         "The TSIG key secret to pass to the bind server."
         "  Will read from environment variable TSIG_PASSWORD"
@@ -73,6 +110,11 @@ def main(
     debug,
 ):
     """main logic for the cli"""
+    if ctx.invoked_subcommand not in NO_BIND_COMMANDS:
+        if bind_user is None:
+            bind_user = click.prompt("Bind user")
+        if bind_pass is None:
+            bind_pass = click.prompt("Bind pass")
     # if we don't get a host from env, use localhost
     if not host:
         host = "127.0.0.1"
@@ -87,6 +129,20 @@ def main(
         # api_key_file_check
         # I don't want to test the api running through the CLI, that will be
         # separate testing so skip coverage of this section also
+    ctx.obj = {
+        "host": host,
+        "port": port,
+        "workers": workers or default_workers(),
+        "dry_run": dry_run,
+        "debug": debug,
+        # the app reads its settings from the environment in every worker
+        "environ": {
+            "BIND_SERVER": bind_server,
+            "API_KEY_FILE": api_key_file,
+            "TSIG_USERNAME": bind_user or "",
+            "TSIG_PASSWORD": bind_pass or "",
+        },
+    }
     if not dry_run and not ctx.invoked_subcommand:  # pragma: no cover
         # We can't assume TSIG values, if they aren't in env or passed via
         # options just error out
@@ -99,37 +155,73 @@ def main(
                 " or you must specify --bind-user and --bind-password"
             )
             sys.exit(1)
-        DNS_SERVER = bind_server
+        os.environ.update(ctx.obj["environ"])
+        # development server, restarted when the code changes
         uvicorn.run(
-            "bind_rest_api.api.api:app",
+            APP_FACTORY,
+            factory=True,
             host=host,
             port=port,
             reload=True,
             debug=debug,
-            workers=workers,
         )
     elif dry_run and not ctx.invoked_subcommand:
-        # Set colors for styled output
-        # row heading color
-        hcolor = "blue"
-        # text color, the value of the row heading
-        tcolor = "cyan"
         click.echo(click.style("              API", bold=True))
-        click.echo(click.style("         host: ", fg=hcolor), nl=False)
-        click.echo(click.style(host, fg=tcolor))
-        click.echo(click.style("         port: ", fg=hcolor), nl=False)
-        click.echo(click.style(str(port), fg=tcolor))
-        click.echo(click.style("      workers: ", fg=hcolor), nl=False)
-        click.echo(click.style(str(workers), fg=tcolor))
-        click.echo(click.style(" api key file: ", fg=hcolor), nl=False)
-        click.echo(click.style(api_key_file, fg=tcolor))
+        echo_row("host", host)
+        echo_row("port", port)
+        echo_row("workers", ctx.obj["workers"])
+        echo_row("api key file", api_key_file)
         click.echo(click.style("          BIND Server", bold=True))
-        click.echo(click.style("  bind server: ", fg=hcolor), nl=False)
-        click.echo(click.style(bind_server, fg=tcolor))
-        click.echo(click.style("    TSIG user: ", fg=hcolor), nl=False)
-        click.echo(click.style(bind_user, fg=tcolor))
-        click.echo(click.style("    TSIG pass: ", fg=hcolor), nl=False)
-        click.echo(click.style(bind_pass, fg=tcolor))
+        echo_row("bind server", bind_server)
+        echo_row("TSIG user", bind_user)
+        echo_row("TSIG pass", bind_pass)
+
+
+@main.command()
+@click.pass_context
+def serve(ctx):
+    """Run the api for production, without reloading, in a worker for each
+    core unless --workers is given
+    """
+    options = ctx.obj
+    (loop, http) = server_implementations()
+    if options["dry_run"]:
+        click.echo(click.style("            Serve", bold=True))
+        echo_row("host", options["host"])
+        echo_row("port", options["port"])
+        echo_row("workers", options["workers"])
+        echo_row("loop", loop)
+        echo_row("http", http)
+        return
+    os.environ.update(options["environ"])
+    try:
+        # fail once here rather than in every worker
+        Settings()
+    except ValidationError as error:
+        click.echo(f"Error in the api settings:\n{error}", err=True)
+        sys.exit(1)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # values from an earlier run would be added to this one's
+        clear_multiprocess_dir(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+    elif options["workers"] > 1:
+        # let /metrics aggregate the values from every worker
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(
+            prefix="bindapi-metrics-"
+        )
+    if options["workers"] > 1 and "WORKER_STATE_DIR" not in os.environ:
+        # for state every worker must see, such as rate limits and idempotency keys
+        os.environ["WORKER_STATE_DIR"] = tempfile.mkdtemp(prefix="bindapi-state-")
+    uvicorn.run(  # pragma: no cover
+        APP_FACTORY,
+        factory=True,
+        host=options["host"],
+        port=options["port"],
+        workers=options["workers"],
+        loop=loop,
+        http=http,
+        lifespan="on",
+        debug=options["debug"],
+    )
 
 
 @main.command()
@@ -150,5 +242,87 @@ def add_key(username, length):
         print(password)
 
 
+@main.command()
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "--url",
+    "-u",
+    default="http://127.0.0.1:8000",
+    help="The api to replay the changes against",
+    show_default=True,
+)
+@click.option(
+    "--api-key",
+    envvar="BINDAPI_KEY",
+    prompt=True,
+    hide_input=True,
+    help="The api key to send.  Will read from environment variable BINDAPI_KEY",
+)
+@click.option(
+    "--speed",
+    "-s",
+    type=click.FloatRange(min=0),
+    default=1.0,
+    help="How many times faster than logged to send changes, 0 for no pauses",
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=click.IntRange(min=1),
+    default=8,
+    help="How many requests may be in flight at once",
+    show_default=True,
+)
+@click.option("--limit", "-l", type=int, help="Replay only the first LIMIT changes")
+@click.option("--skip-failed", is_flag=True, help="Leave out changes that failed")
+@click.option(
+    "--timeout",
+    type=float,
+    default=30.0,
+    help="Seconds to wait for each response",
+    show_default=True,
+)
+@click.pass_context
+def replay(ctx, paths, url, api_key, speed, concurrency, limit, skip_failed, timeout):
+    """Replay the changes in audit logs against an api, to load test it
+
+    PATHS are audit log files or logging directories, and rotated logs are
+    replayed oldest first.
+    """
+    entries = read_entries(paths)
+    if skip_failed:
+        entries = (entry for entry in entries if not entry.failed)
+    if limit is not None:
+        entries = itertools.islice(entries, limit)
+    if ctx.obj["dry_run"]:
+        # read the logs without sending anything
+        (count, seconds) = (0, 0.0)
+        for (seconds, _) in schedule(entries):
+            count += 1
+        click.echo(click.style("           Replay", bold=True))
+        echo_row("url", url)
+        echo_row("changes", count)
+        echo_row("logged over", f"{seconds:.0f}s")
+        echo_row("replay in", f"{seconds / speed:.0f}s" if speed else "no pauses")
+        return
+    report = Replayer(url, api_key, concurrency, speed, timeout).run(entries)
+    click.echo(click.style("           Replay", bold=True))
+    echo_row("requests", report.requests)
+    echo_row("seconds", f"{report.seconds:.2f}")
+    echo_row("throughput", f"{report.throughput:.1f}/s")
+    for name in ("p50", "p90", "p99", "max"):
+        echo_row(f"{name} latency", f"{getattr(report, name) * 1000:.1f}ms")
+    echo_row(
+        "errors",
+        f"{report.errors} ({report.errors / max(report.requests, 1):.1%})",
+    )
+    for (status, count) in sorted(report.statuses.items(), key=str):
+        echo_row(status, count)
+    echo_row("max lag", f"{report.lag * 1000:.1f}ms")
+    if report.errors:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()  # pylint: disable=no-value-for-parameter #pragma: no cover
@@ -0,0 +1,316 @@
+""" Replay audit logs against an api, for load testing and capacity planning
+
+Audit logs are read a line at a time, from the oldest rotated file to the
+current one, and each change is sent again as the request that made it.
+Requests are sent at the pace they were logged, divided by a speed-up
+factor, over a fixed number of keep-alive connections.  The text log only
+has the minute of each change, and the json log the second, so changes
+logged within the same minute or second are spread evenly across it.
+"""
+import os
+import re
+import ast
+import math
+import gzip
+import json
+import time
+import queue
+import threading
+import itertools
+import http.client
+from collections import Counter, namedtuple
+from datetime import datetime
+from urllib.parse import quote, urlencode, urlsplit
+
+# one change from an audit log, resolution being the seconds its time
+# stands for
+AuditEntry = namedtuple(
+    "AuditEntry", "time resolution action domain rrtype ttl rdata failed"
+)
+Result = namedtuple("Result", "status latency lag")
+Report = namedtuple(
+    "Report", "requests seconds throughput p50 p90 p99 max errors statuses lag"
+)
+
+TEXT_TIME_FORMAT = "%Y-%m-%dT%H:%M%z"
+JSON_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+ACTIONS = ("CREATE", "REPLACE", "DELETE")
+# the record sent with a change, as logged before the text format had its
+# own fields, the repr of the request's Record
+BASELINE_RECORD = re.compile(
+    r"response=(?P<response>'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")"
+    r" rrtype=<RecordType\.\w+: '(?P<rrtype>\w+)'> ttl=(?P<ttl>\d+)$"
+)
+
+
+def parse_baseline_change(change):
+    """(action, domain, rrtype, ttl, rdata) texts of a change in the text
+    audit format older logs have, "<action> <domain> RecordType.<type>
+    <key> -> <domain> record <Record repr>", or a list of the types in
+    place of the Record for deletes of whole record types
+    """
+    (head, record) = change.split(" record ", 1)
+    (action, domain, rrtype) = head.split(" ")[:3]
+    if record.startswith("["):
+        types = [name.rsplit(".", 1)[-1] for name in rrtype.split(",")]
+        return (action, domain, ",".join(types), "-", "-")
+    match = BASELINE_RECORD.match(record)
+    if match is None:
+        raise ValueError(f"not a logged record: {record}")
+    return (
+        action,
+        domain,
+        match["rrtype"],
+        match["ttl"],
+        ast.literal_eval(match["response"]),
+    )
+
+
+def parse_text_line(line):
+    """an AuditEntry from a text audit log line, or None for other lines
+
+    Lines are "<time> == <app> == [FAILED:]<action> <domain> <rrtype> <ttl>
+    <rdata> for key <key>", with - for a missing ttl or rdata, or have the
+    change in the older form parse_baseline_change() reads.
+    """
+    try:
+        (stamp, _, message) = line.rstrip("\n").split(" == ", 2)
+        (change, _) = message.rsplit(" for key ", 1)
+        failed = change.startswith("FAILED:")
+        if failed:
+            change = change[len("FAILED:") :]
+        if change.split(" ", 5)[4:5] == ["->"]:
+            (action, domain, rrtype, ttl, rdata) = parse_baseline_change(change)
+        else:
+            (action, domain, rrtype, ttl, rdata) = change.split(" ", 4)
+        when = datetime.strptime(stamp, TEXT_TIME_FORMAT)
+        ttl = None if ttl == "-" else int(ttl)
+    except (ValueError, SyntaxError):
+        # SyntaxError from a logged response that is not a string literal
+        return None
+    if action not in ACTIONS:
+        return None
+    return AuditEntry(
+        when,
+        60,
+        action,
+        domain,
+        rrtype,
+        ttl,
+        None if rdata == "-" else rdata,
+        failed,
+    )
+
+
+def parse_json_line(line):
+    """an AuditEntry from a json audit log line, or None for other lines"""
+    try:
+        entry = json.loads(line)
+        when = datetime.strptime(entry["time"], JSON_TIME_FORMAT)
+        action = entry["action"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if action not in ACTIONS:
+        return None
+    return AuditEntry(
+        when,
+        1,
+        action,
+        entry["name"],
+        entry["rrtype"],
+        entry.get("ttl"),
+        entry.get("rdata"),
+        entry.get("result") == "failed",
+    )
+
+
+def parse_line(line):
+    """an AuditEntry from a line of either audit log format"""
+    if line.startswith("{"):
+        return parse_json_line(line)
+    return parse_text_line(line)
+
+
+def _rotation_order(path):
+    # rotated files are suffixed with the date they start, and the file
+    # being written to has no suffix and comes last
+    name = os.path.basename(path)
+    for current in ("dns-api-audit.log", "dns-api-audit.jsonl"):
+        if name.startswith(current + "."):
+            return (False, name[len(current) + 1 :], name)
+    return (True, "", name)
+
+
+def audit_files(paths):
+    """the audit log files in paths, oldest first, looking for
+    dns-api-audit.log* and dns-api-audit.jsonl* files in directories
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.startswith("dns-api-audit.")
+            )
+        else:
+            files.append(path)
+    return sorted(files, key=_rotation_order)
+
+
+def read_entries(paths):
+    """the AuditEntries of the audit logs in paths, read as they are needed"""
+    for path in audit_files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as log_file:
+            for line in log_file:
+                entry = parse_line(line)
+                if entry is not None:
+                    yield entry
+
+
+def schedule(entries):
+    """(seconds after the first change, AuditEntry) for each entry, with
+    the entries logged at the same time spread across its resolution
+    """
+    first = None
+    for (when, group) in itertools.groupby(entries, key=lambda entry: entry.time):
+        group = list(group)
+        if first is None:
+            first = when
+        offset = (when - first).total_seconds()
+        for (position, entry) in enumerate(group):
+            yield (offset + entry.resolution * position / len(group), entry)
+
+
+def request_for(entry):
+    """the (method, path, json body or None) that makes an audited change"""
+    path = f"/dns/record/{quote(entry.domain)}"
+    if entry.action == "DELETE" and entry.rdata is None:
+        # deletes of whole record types, whose rrtype lists the types
+        query = urlencode(
+            [("recordtypes", rrtype) for rrtype in entry.rrtype.split(",")]
+        )
+        return ("DELETE", f"/dns/allrecords/{quote(entry.domain)}?{query}", None)
+    body = {"response": entry.rdata, "rrtype": entry.rrtype}
+    if entry.ttl is not None:
+        body["ttl"] = entry.ttl
+    method = {"CREATE": "POST", "REPLACE": "PUT", "DELETE": "DELETE"}[entry.action]
+    return (method, path, body)
+
+
+def percentile(ordered, fraction):
+    """the nearest rank percentile of sorted values"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(results, seconds):
+    """a Report of the Results of a replay that took seconds"""
+    latencies = sorted(result.latency for result in results)
+    statuses = Counter(result.status for result in results)
+    errors = sum(
+        count
+        for (status, count) in statuses.items()
+        if not isinstance(status, int) or status >= 400
+    )
+    return Report(
+        requests=len(results),
+        seconds=seconds,
+        throughput=len(results) / seconds if seconds else 0.0,
+        p50=percentile(latencies, 0.5),
+        p90=percentile(latencies, 0.9),
+        p99=percentile(latencies, 0.99),
+        max=latencies[-1] if latencies else 0.0,
+        errors=errors,
+        statuses=dict(statuses),
+        lag=max((result.lag for result in results), default=0.0),
+    )
+
+
+class Replayer:
+    """Sends audited changes to the api at *url* as the api key *api_key*
+
+    Each of *concurrency* threads sends requests over its own keep-alive
+    connection.  Requests are due at their logged offset divided by
+    *speed*, or at once with a speed of 0.  When every thread is busy the
+    requests wait, and how late the latest one started is reported as lag.
+    *send* stands in for sending a request in tests.
+    """
+
+    def __init__(self, url, api_key, concurrency=8, speed=1.0, timeout=30.0, send=None):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or "http"
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.speed = speed
+        self.timeout = timeout
+        self.send = send or self._send
+        self._local = threading.local()
+        self._results = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _send(self, method, path, body):
+        """send a request over this thread's connection, returning its status"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        headers = {"X-Api-Key": self.api_key}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(body)
+        try:
+            connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        return response.status
+
+    def _work(self, requests):
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            (due, entry) = item
+            start = time.perf_counter()
+            try:
+                status = self.send(*request_for(entry))
+            except (OSError, http.client.HTTPException) as error:
+                status = type(error).__name__
+            result = Result(status, time.perf_counter() - start, max(0.0, start - due))
+            with self._lock:
+                self._results.append(result)
+
+    def run(self, entries):
+        """replay the entries and return a Report"""
+        requests = queue.Queue(maxsize=self.concurrency)
+        workers = [
+            threading.Thread(target=self._work, args=(requests,), daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        self._results = []
+        start = time.perf_counter()
+        for (offset, entry) in schedule(entries):
+            due = start + (offset / self.speed if self.speed else 0.0)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            requests.put((due, entry))
+        for _ in workers:
+            requests.put(None)
+        for worker in workers:
+            worker.join()
+        return summarize(self._results, time.perf_counter() - start)
@@ -12,5 +12,5 @@ source $HOME/bind-rest-api/config.env
 pyenv activate bind
 
 cd $HOME/bind-rest-api
-uvicorn bindapi:app
+python bindapi.py serve
 
@@ -0,0 +1,49 @@
+""" test the answer cache kept coherent across workers """
+import time
+from unittest import mock
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+from bind_rest_api.api.answercache import AnswerCache
+from bind_rest_api.api.shared import ZoneGenerations
+from bind_rest_api.api.zoneindex import ZoneIndex
+
+ZONES = ["example.org.", "example.com."]
+
+
+def key(name):
+    """the cache key of an A lookup"""
+    return (dns.name.from_text(name), dns.rdatatype.A, dns.rdataclass.IN)
+
+
+def answer():
+    """an answer stand-in that has not expired"""
+    return mock.Mock(expiration=time.time() + 60)
+
+
+def test_write_through_another_worker_drops_the_zone(tmp_path):
+    """answers for the written zone are missed, other zones are kept"""
+    (mine, theirs) = (ZoneGenerations(ZONES, str(tmp_path)) for _ in range(2))
+    cache = AnswerCache(10, ZoneIndex(ZONES), mine)
+    for name in ("www.example.org.", "www.example.com."):
+        cache.put(key(name), answer())
+    theirs.bump("example.org.")
+    assert cache.get(key("www.example.org.")) is None
+    assert cache.get(key("www.example.com.")) is not None
+
+
+def test_answer_fetched_during_a_write_is_not_kept():
+    """an answer is stamped with the count from before its lookup"""
+    generations = ZoneGenerations(ZONES)
+    cache = AnswerCache(10, ZoneIndex(ZONES), generations)
+    assert cache.get(key("www.example.org.")) is None
+    generations.bump("example.org.")
+    cache.put(key("www.example.org."), answer())
+    assert cache.get(key("www.example.org.")) is None
+
+
+def test_names_outside_the_zones_are_cached():
+    """answers for names in no allowed zone are kept for their ttl"""
+    cache = AnswerCache(10, ZoneIndex(ZONES), ZoneGenerations(ZONES))
+    cache.put(key("www.example.net."), answer())
+    assert cache.get(key("www.example.net.")) is not None
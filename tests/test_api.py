@@ -0,0 +1,682 @@
+""" test the api endpoints against a mocked BIND server """
+import time
+import asyncio
+import pstats
+import pathlib
+from unittest import mock
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.zone
+import pytest
+from fastapi.testclient import TestClient
+from bind_rest_api.api import api
+from bind_rest_api.api.api import create_app
+from bind_rest_api.api.keystore import KeyEntry, KeyStore
+from bind_rest_api.api.logs import auditlogger
+from bind_rest_api.api.ratelimit import Limit, RateLimiter
+from bind_rest_api.api.settings import Settings
+from bind_rest_api.api.timing import NO_SPAN, TimingMiddleware, background_task, span
+
+HEADERS = {"X-Api-Key": "hithere"}
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    """a client for an app started with the example settings"""
+    settings = Settings(
+        bind_server="127.0.0.1",
+        tsig_username="local-ddns",
+        tsig_password="YWJjMTIz",
+        bind_allowed_zones="example.com,example.org",
+        api_key_file="example_apikeys.pass",
+        logging_application_name="bind-api-test",
+        logging_dir=str(tmp_path_factory.mktemp("logs")),
+    )
+    with TestClient(create_app(settings)) as test_client:
+        yield test_client
+
+
+def answer(rcode=dns.rcode.NOERROR):
+    """build a tcpquery stand-in that records updates and answers with rcode"""
+    sent = []
+
+    async def tcpquery(update):
+        sent.append(update)
+        response = dns.message.make_response(update)
+        response.set_rcode(rcode)
+        return response
+
+    tcpquery.sent = sent
+    return tcpquery
+
+
+def test_batch_sends_one_update_per_zone(client):
+    """operations are grouped into one update per zone, results keep order"""
+    tcpquery = answer()
+    with mock.patch.object(client.app.state.backend, "tcpquery", tcpquery):
+        response = client.post(
+            "/dns/batch",
+            headers=HEADERS,
+            json=[
+                {
+                    "action": "add",
+                    "domain": "host.example.org",
+                    "record": {"response": "10.0.0.1", "rrtype": "A"},
+                },
+                {
+                    "action": "replace",
+                    "domain": "host.example.com.",
+                    "record": {"response": "10.0.0.2", "rrtype": "A"},
+                },
+                {
+                    "action": "delete",
+                    "domain": "old.example.org.",
+                    "record": {"response": "10.0.0.3", "rrtype": "A"},
+                },
+            ],
+        )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["domain"] for result in results] == [
+        "host.example.org.",
+        "host.example.com.",
+        "old.example.org.",
+    ]
+    assert {result["status"] for result in results} == {"ok"}
+    assert len(tcpquery.sent) == 2
+    assert sorted(str(update.zone[0].name) for update in tcpquery.sent) == [
+        "example.com.",
+        "example.org.",
+    ]
+
+
+def test_batch_reports_failed_zone(client):
+    """a refused update marks every operation for that zone as failed"""
+    with mock.patch.object(
+        client.app.state.backend, "tcpquery", answer(dns.rcode.REFUSED)
+    ):
+        response = client.post(
+            "/dns/batch",
+            headers=HEADERS,
+            json=[
+                {
+                    "action": "add",
+                    "domain": "host.example.org.",
+                    "record": {"response": "10.0.0.1", "rrtype": "A"},
+                }
+            ],
+        )
+    assert response.json()["results"][0]["status"] == "failed"
+    assert response.json()["results"][0]["rcode"] == "REFUSED"
+
+
+def test_batch_rejects_unknown_zone(client):
+    """a domain outside the allowed zones rejects the whole batch"""
+    with mock.patch.object(client.app.state.backend, "tcpquery", answer()) as tcpquery:
+        response = client.post(
+            "/dns/batch",
+            headers=HEADERS,
+            json=[
+                {
+                    "action": "add",
+                    "domain": "host.example.net.",
+                    "record": {"response": "10.0.0.1", "rrtype": "A"},
+                }
+            ],
+        )
+    assert response.status_code == 400
+    assert not tcpquery.sent
+
+
+def test_scoped_secret_is_checked_not_its_name(client, tmp_path):
+    """a secret limited to example.org may not change example.com, even
+    when an unscoped secret has the same key name
+    """
+    key_file = tmp_path / "apikeys.pass"
+    key_file.write_text("alice,scopedsecret,zones=example.org\nalice,othersecret\n")
+    backend = client.app.state.backend
+    scoped = {"X-Api-Key": "scopedsecret"}
+    batch = [
+        {
+            "action": "add",
+            "domain": "host.example.com.",
+            "record": {"response": "10.0.0.1", "rrtype": "A"},
+        }
+    ]
+    with mock.patch.object(backend, "keys", KeyStore(str(key_file))):
+        with mock.patch.object(backend, "tcpquery", answer()) as tcpquery:
+            in_batch = client.post("/dns/batch", headers=scoped, json=batch)
+            in_path = client.delete(
+                "/dns/allrecords/host.example.com.?recordtypes=A", headers=scoped
+            )
+            other = client.post(
+                "/dns/batch", headers={"X-Api-Key": "othersecret"}, json=batch
+            )
+    assert (in_batch.status_code, in_path.status_code) == (403, 403)
+    assert other.status_code == 200
+    assert len(tcpquery.sent) == 1
+
+
+def test_get_record_resolves_types_concurrently(client):
+    """every requested type is looked up, missing types are left out"""
+    looked_up = []
+
+    async def resolve(domain, record_type):
+        looked_up.append(record_type)
+        if record_type != "A":
+            raise dns.resolver.NoAnswer
+        return mock.Mock(rrset=["10.0.0.1"])
+
+    with mock.patch.object(client.app.state.backend.resolver, "resolve", resolve):
+        response = client.get(
+            "/dns/record/host.example.org?record_types=A&record_types=TXT",
+            headers=HEADERS,
+        )
+    assert response.json() == {"A": ["10.0.0.1"]}
+    assert sorted(looked_up) == ["A", "TXT"]
+
+
+def test_write_evicts_cached_answers(client):
+    """a successful write drops cached answers for the zone"""
+    key = (
+        dns.name.from_text("host.example.org."),
+        dns.rdatatype.A,
+        dns.rdataclass.IN,
+    )
+    client.app.state.backend.resolver.cache.put(
+        key, mock.Mock(expiration=time.time() + 60)
+    )
+    with mock.patch.object(client.app.state.backend, "tcpquery", answer()):
+        client.post(
+            "/dns/record/host.example.org",
+            headers=HEADERS,
+            json={"response": "10.0.0.2", "rrtype": "A"},
+        )
+    assert client.app.state.backend.resolver.cache.get(key) is None
+
+
+def test_writes_are_audited_once(client):
+    """each write is audited once, as failed when the update fails"""
+
+    async def unreachable(update):
+        raise OSError("connection refused")
+
+    with mock.patch.object(client.app.state.backend, "tcpquery", unreachable):
+        with mock.patch.object(auditlogger, "_log") as log:
+            client.post(
+                "/dns/record/host.example.org",
+                headers=HEADERS,
+                json={"response": "10.0.0.2", "rrtype": "A", "ttl": 60},
+            )
+    assert log.call_count == 1
+    fields = log.call_args[1]["extra"]["audit"]
+    assert fields["action"] == "CREATE"
+    assert fields["zone"] == "example.org."
+    assert fields["rrtype"] == "A"
+    assert fields["ttl"] == 60
+    assert fields["result"] == "failed"
+
+
+def cached_zone(text="www 300 IN A 10.0.0.2"):
+    """a zonecache.get stand-in returning a small example.org zone"""
+    zone = dns.zone.from_text(
+        "@ 3600 IN SOA ns1 hostmaster 7 3600 600 86400 300\n"
+        "@ 3600 IN NS ns1\n" + text,
+        origin="example.org.",
+    )
+
+    async def get(zone_name):
+        return zone
+
+    return get
+
+
+def test_sync_zone_dry_run_and_apply(client):
+    """a sync returns the diff, and sends it as one update unless dry_run"""
+    backend = client.app.state.backend
+    desired = {
+        "records": {"www": [{"response": "10.0.0.3", "rrtype": "A", "ttl": 300}]}
+    }
+    tcpquery = answer()
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        with mock.patch.object(backend, "tcpquery", tcpquery):
+            dry = client.put(
+                "/dns/zone/example.org/records?dry_run=true",
+                headers=HEADERS,
+                json=desired,
+            )
+            assert not tcpquery.sent
+            applied = client.put(
+                "/dns/zone/example.org/records", headers=HEADERS, json=desired
+            )
+    assert dry.json()["applied"] is False
+    assert dry.json()["serial"] == 7
+    assert [(c["action"], c["response"]) for c in dry.json()["changes"]] == [
+        ("delete", "10.0.0.2"),
+        ("add", "10.0.0.3"),
+    ]
+    assert applied.json()["applied"] is True
+    (update,) = tcpquery.sent
+    assert update.prerequisite[0][0].serial == 7
+
+
+def test_sync_zone_retries_then_conflicts(client):
+    """a failed serial prerequisite is retried, and reported after that"""
+    backend = client.app.state.backend
+    tcpquery = answer(dns.rcode.NXRRSET)
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        with mock.patch.object(backend, "tcpquery", tcpquery):
+            response = client.put(
+                "/dns/zone/example.org/records", headers=HEADERS, json={"records": {}}
+            )
+    assert response.status_code == 409
+    assert len(tcpquery.sent) == api.SYNC_ATTEMPTS
+
+
+def test_metrics_count_requests_by_handler(client):
+    """requests are counted under the name of the handler that served them"""
+    client.get("/dns/zone/example.net.", headers=HEADERS)
+    client.get("/dns/zone/example.org.", headers={"X-Api-Key": "wrong"})
+    body = client.get("/metrics").text
+    assert 'bindapi_requests_total{handler="get_zone",status="400"}' in body
+    assert 'bindapi_auth_failures_total{reason="invalid"}' in body
+
+
+def test_get_zone_query_pages(client):
+    """filtered zone queries return a page and a cursor for the next"""
+    backend = client.app.state.backend
+    hosts = "".join(f"host{i}.k8s 300 IN A 10.1.0.{i}\n" for i in range(5))
+    with mock.patch.object(backend.zonecache, "get", cached_zone(hosts)):
+        first = client.get(
+            "/dns/zone/example.org?suffix=k8s&rrtype=A&limit=3", headers=HEADERS
+        )
+        assert first.status_code == 200
+        assert first.json()["serial"] == 7
+        assert len(first.json()["records"]) == 3
+        rest = client.get(
+            f"/dns/zone/example.org?suffix=k8s&rrtype=A&limit=3"
+            f"&cursor={first.json()['next']}",
+            headers=HEADERS,
+        )
+        assert len(rest.json()["records"]) == 2
+        assert rest.json()["next"] is None
+        records = first.json()["records"] + rest.json()["records"]
+        assert {r["name"] for r in records} == {f"host{i}.k8s" for i in range(5)}
+        expired = client.get(
+            "/dns/zone/example.org?limit=1&cursor=OTk5OjA=", headers=HEADERS
+        )
+        assert expired.status_code == 410
+
+
+def test_zone_changes_long_poll(client):
+    """the change feed returns the current serial, then changes since it"""
+    backend = client.app.state.backend
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        current = client.get("/dns/zone/example.org/changes", headers=HEADERS)
+        assert current.json() == {"serial": 7, "changes": []}
+        idle = client.get(
+            "/dns/zone/example.org/changes?since=7&timeout=0.01", headers=HEADERS
+        )
+        assert idle.json() == {"serial": 7, "changes": []}
+        expired = client.get(
+            "/dns/zone/example.org/changes?since=3&timeout=0.01", headers=HEADERS
+        )
+        assert expired.status_code == 410
+
+
+def test_workers_read_zones_from_the_shared_snapshots(tmp_path):
+    """with a snapshot directory, a worker that does not own the snapshots
+    answers zone queries, syncs, change feeds and zone bodies without
+    transferring the zone
+    """
+    (tmp_path / "zones").mkdir()
+    settings = Settings(
+        bind_server="127.0.0.1",
+        tsig_username="local-ddns",
+        tsig_password="YWJjMTIz",
+        bind_allowed_zones="example.org",
+        api_key_file="example_apikeys.pass",
+        logging_application_name="bind-api-test",
+        logging_dir=str(tmp_path),
+        zone_snapshot_dir=str(tmp_path / "zones"),
+    )
+
+    async def soa_serial(zone_name):
+        return 7
+
+    def no_transfer(zone_name):
+        raise AssertionError("the zone was transferred")
+
+    with TestClient(create_app(settings)) as owner:
+        with TestClient(create_app(settings)) as worker:
+            owner_cache = owner.app.state.backend.zonecache
+            with mock.patch.object(owner_cache, "get", cached_zone()):
+                assert owner.get("/dns/zone/example.org", headers=HEADERS).ok
+            worker_cache = worker.app.state.backend.zonecache
+            with mock.patch.object(worker_cache, "get", no_transfer):
+                with mock.patch.object(worker_cache, "soa_serial", soa_serial):
+                    page = worker.get("/dns/zone/example.org?rrtype=A", headers=HEADERS)
+                    sync = worker.put(
+                        "/dns/zone/example.org/records?dry_run=true",
+                        headers=HEADERS,
+                        json={"records": {}},
+                    )
+                    feed = worker.get("/dns/zone/example.org/changes", headers=HEADERS)
+                    body = worker.get("/dns/zone/example.org", headers=HEADERS)
+    assert page.json()["records"] == [
+        {"name": "www", "response": "10.0.0.2", "rrtype": "A", "ttl": 300}
+    ]
+    assert [(c["action"], c["response"]) for c in sync.json()["changes"]] == [
+        ("delete", "10.0.0.2")
+    ]
+    assert feed.json() == {"serial": 7, "changes": []}
+    assert body.json()["records"]["www"][0]["response"] == "10.0.0.2"
+    assert (tmp_path / "zones" / "bodies" / "example.org." / "7.json.identity").exists()
+
+
+def test_get_zone_etag_and_compression(client):
+    """zones carry an etag, a matching If-None-Match gets a 304 from an SOA
+    query alone, and the body is gzipped when the client accepts it
+    """
+    backend = client.app.state.backend
+
+    async def soa_serial(zone_name):
+        return 7
+
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        response = client.get(
+            "/dns/zone/example.org",
+            headers={**HEADERS, "Accept-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.headers["etag"] == 'W/"7"'
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["records"]["www"][0]["response"] == "10.0.0.2"
+    with mock.patch.object(backend.zonecache, "soa_serial", soa_serial):
+        with mock.patch.object(backend.zonecache, "get") as get:
+            cached = client.get(
+                "/dns/zone/example.org", headers={**HEADERS, "If-None-Match": '"7"'}
+            )
+            assert not get.called
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == 'W/"7"'
+
+
+def test_get_zone_formats(client):
+    """the columnar and master file formats come from the cached zone"""
+    backend = client.app.state.backend
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        columnar = client.get("/dns/zone/example.org?format=columnar", headers=HEADERS)
+        text = client.get("/dns/zone/example.org?format=text", headers=HEADERS)
+        query = client.get("/dns/zone/example.org?format=text&limit=1", headers=HEADERS)
+    assert columnar.json()["name"] == ["@", "@", "www"]
+    assert text.headers["content-type"].startswith("text/dns")
+    assert "www 300 IN A 10.0.0.2" in text.text
+    assert query.status_code == 400
+
+
+def test_rate_limited_key_gets_429(client):
+    """a key over its write limit is refused with a Retry-After"""
+    backend = client.app.state.backend
+    limiter = RateLimiter({"write": Limit(0.1, 1)}, max_wait=0)
+    with mock.patch.object(backend, "limiter", limiter):
+        with mock.patch.object(backend, "tcpquery", answer()):
+            first = client.delete(
+                "/dns/allrecords/www.example.org?recordtypes=A", headers=HEADERS
+            )
+            second = client.delete(
+                "/dns/allrecords/www.example.org?recordtypes=A", headers=HEADERS
+            )
+        # reads have their own bucket
+        read = client.get("/dns/zone/example.org/changes?since=-1", headers=HEADERS)
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.headers["retry-after"] == "10"
+    assert read.status_code != 429
+
+
+def soa_lookup(serial=7):
+    """a zonecache.soa stand-in for the example.org SOA at serial"""
+
+    async def soa(zone_name):
+        zone = await cached_zone()(zone_name)
+        return zone.get_rdataset("@", "SOA")[0].replace(serial=serial)
+
+    return soa
+
+
+def test_preconditions_become_prerequisites(client):
+    """preconditions are sent as prerequisites of the same update"""
+    backend = client.app.state.backend
+    tcpquery = answer()
+    with mock.patch.object(backend, "tcpquery", tcpquery):
+        with mock.patch.object(backend.zonecache, "soa", soa_lookup(9)):
+            response = client.put(
+                "/dns/record/host.example.org",
+                headers=HEADERS,
+                json={
+                    "response": "10.0.0.2",
+                    "rrtype": "A",
+                    "preconditions": {"rrset": ["10.0.0.1"], "serial": 7},
+                },
+            )
+    assert response.status_code == 200
+    (update,) = tcpquery.sent
+    prerequisites = sorted(rrset.to_text() for rrset in update.prerequisite)
+    assert prerequisites == [
+        "example.org. 0 IN SOA ns1 hostmaster 7 3600 600 86400 300",
+        "host.example.org. 0 IN A 10.0.0.1",
+    ]
+
+
+def test_failed_precondition_gets_412(client):
+    """a failed precondition answers 412 with the current value"""
+    backend = client.app.state.backend
+    sent = []
+
+    async def tcpquery(message):
+        sent.append(message)
+        response = dns.message.make_response(message)
+        if message.opcode() == dns.opcode.UPDATE:
+            response.set_rcode(dns.rcode.YXDOMAIN)
+        else:
+            question = message.question[0]
+            rrset = response.find_rrset(
+                response.answer,
+                question.name,
+                question.rdclass,
+                question.rdtype,
+                create=True,
+            )
+            rrset.add(dns.rdata.from_text("IN", "A", "10.0.0.3"), 300)
+        return response
+
+    async def soa_serial(zone_name):
+        return 8
+
+    with mock.patch.object(backend, "tcpquery", tcpquery):
+        with mock.patch.object(backend.zonecache, "soa_serial", soa_serial):
+            response = client.post(
+                "/dns/record/host.example.org",
+                headers=HEADERS,
+                json={
+                    "response": "10.0.0.2",
+                    "rrtype": "A",
+                    "preconditions": {"exists": False},
+                },
+            )
+    assert response.status_code == 412
+    assert response.json()["detail"] == {
+        "message": "precondition failed: YXDOMAIN",
+        "current": {"exists": True, "rrset": ["10.0.0.3"], "serial": 8},
+    }
+    # the update is not merged with others
+    assert [message.opcode() for message in sent] == [
+        dns.opcode.UPDATE,
+        dns.opcode.QUERY,
+    ]
+
+
+def test_server_timing_header(client):
+    """responses carry the time spent in each stage"""
+    with mock.patch.object(client.app.state.backend, "tcpquery", answer()):
+        response = client.post(
+            "/dns/record/host.example.org",
+            headers=HEADERS,
+            json={"response": "10.0.0.2", "rrtype": "A"},
+        )
+    spans = dict(
+        entry.split(";dur=") for entry in response.headers["server-timing"].split(", ")
+    )
+    assert {"auth", "helper", "validate", "serialize", "total"} <= set(spans)
+    assert all(float(duration) >= 0 for duration in spans.values())
+
+
+def test_background_tasks_are_not_timed():
+    """tasks started during a request don't add spans to it"""
+    seen = []
+
+    async def later():
+        await asyncio.sleep(0)
+        seen.append(span("bind"))
+
+    async def app(scope, receive, send):
+        seen.append(span("bind"))
+        await background_task(later())
+
+    async def scenario():
+        await TimingMiddleware(app)(
+            {"type": "http", "method": "GET", "path": "/"}, None, None
+        )
+
+    asyncio.run(scenario())
+    assert seen[0] is not NO_SPAN
+    assert seen[1] is NO_SPAN
+
+
+def test_allowed_key_profiles_request(client):
+    """the profile header saves a profile only for an allowed key"""
+    backend = client.app.state.backend
+    logging_dir = pathlib.Path(backend.settings.logging_dir)
+    headers = {**HEADERS, "X-Profile": "1"}
+    with mock.patch.object(backend.zonecache, "get", cached_zone()):
+        client.get("/dns/zone/example.org", headers=headers)
+        assert not list(logging_dir.glob("profile-*.prof"))
+        settings = backend.settings.copy(update={"profile_api_keys": "testkey"})
+        with mock.patch.object(backend, "settings", settings):
+            response = client.get("/dns/zone/example.org", headers=headers)
+    assert response.status_code == 200
+    (profile,) = logging_dir.glob("profile-*-get_zone.prof")
+    assert pstats.Stats(str(profile)).total_calls > 0
+
+
+def test_idempotent_retry_is_not_sent_again(client):
+    """a retried write with the same Idempotency-Key reaches BIND once"""
+    tcpquery = answer()
+    headers = {**HEADERS, "Idempotency-Key": "retry-1"}
+    body = {"response": "10.0.0.2", "rrtype": "A"}
+    with mock.patch.object(client.app.state.backend, "tcpquery", tcpquery):
+        with mock.patch.object(auditlogger, "_log") as log:
+            first = client.post(
+                "/dns/record/host.example.org", headers=headers, json=body
+            )
+            retry = client.post(
+                "/dns/record/host.example.org", headers=headers, json=body
+            )
+        other = client.post(
+            "/dns/record/host.example.org",
+            headers=headers,
+            json={"response": "10.0.0.3", "rrtype": "A"},
+        )
+    assert (first.status_code, retry.status_code) == (200, 200)
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert len(tcpquery.sent) == 1
+    assert log.call_count == 1
+    assert other.status_code == 422
+
+
+def test_idempotent_retry_is_checked_before_replay(client):
+    """a retry is only replayed to a key still allowed to change the zone"""
+    backend = client.app.state.backend
+    headers = {**HEADERS, "Idempotency-Key": "retry-2"}
+    body = [
+        {
+            "action": "add",
+            "domain": "host.example.org",
+            "record": {"response": "10.0.0.2", "rrtype": "A"},
+        }
+    ]
+    with mock.patch.object(backend, "tcpquery", answer()):
+        first = client.post("/dns/batch", headers=headers, json=body)
+        scoped = KeyEntry("testkey", frozenset(["example.com."]), {})
+        with mock.patch.object(backend.keys, "lookup", return_value=scoped):
+            retry = client.post("/dns/batch", headers=headers, json=body)
+    assert first.status_code == 200
+    assert retry.status_code == 403
+    assert "idempotent-replayed" not in retry.headers
+
+
+def test_acme_challenge_waits_for_nameservers(client):
+    """the challenge record is added and the nameservers waited for"""
+    backend = client.app.state.backend
+    tcpquery = answer()
+    server = mock.Mock(address="10.0.0.1")
+    server.name = "ns1.example.org."
+    waits = []
+
+    async def wait(zone_name, serial, timeout):
+        waits.append((zone_name, serial, timeout))
+        return (len(waits) == 1, {server: serial if len(waits) == 1 else 7})
+
+    async def soa_serial(zone_name):
+        return 8
+
+    with mock.patch.object(backend, "tcpquery", tcpquery):
+        with mock.patch.object(backend.zonecache, "soa_serial", soa_serial):
+            with mock.patch.object(backend.propagation, "wait", wait):
+                added = client.post(
+                    "/dns/acme/_acme-challenge.host.example.org",
+                    headers=HEADERS,
+                    json={"value": "abc-123_x", "timeout": 30},
+                )
+                late = client.post(
+                    "/dns/acme/_acme-challenge.www.example.org",
+                    headers=HEADERS,
+                    json={"value": "abc-123_x"},
+                )
+            removed = client.delete(
+                "/dns/acme/_acme-challenge.host.example.org",
+                headers=HEADERS,
+                json={"value": "abc-123_x", "wait": False},
+            )
+            wrong = client.post(
+                "/dns/acme/host.example.org", headers=HEADERS, json={"value": "abc"}
+            )
+    assert added.status_code == 200
+    assert added.json() == {
+        "name": "_acme-challenge.host.example.org.",
+        "zone": "example.org.",
+        "serial": 8,
+        "propagated": True,
+        "nameservers": [
+            {"name": "ns1.example.org.", "address": "10.0.0.1", "serial": 8}
+        ],
+    }
+    assert waits[0] == ("example.org.", 8, 30)
+    assert late.status_code == 504
+    assert late.json()["detail"]["nameservers"][0]["serial"] == 7
+    assert removed.json() == {
+        "name": "_acme-challenge.host.example.org.",
+        "zone": "example.org.",
+    }
+    assert wrong.status_code == 400
+    assert [rrset.to_text() for rrset in tcpquery.sent[0].update] == [
+        '_acme-challenge.host.example.org. 30 IN TXT "abc-123_x"'
+    ]
+    assert len(tcpquery.sent) == 3
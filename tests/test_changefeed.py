@@ -0,0 +1,141 @@
+""" test the zone change feed """
+import asyncio
+import dns.zone
+import pytest
+from bind_rest_api.api.changefeed import ChangeFeed, ChangesExpired
+from bind_rest_api.api.zonecache import zone_records, zone_serial
+
+
+class FakeZoneCache:
+    """a zone cache serving whichever zone the test last set, telling its
+    listeners what changed like the IXFR would
+    """
+
+    def __init__(self):
+        self.zone = None
+        self.gets = 0
+        self.listeners = []
+
+    def set(self, serial, text):
+        """make the zone have this serial and these records"""
+        previous = self.zone
+        self.zone = dns.zone.from_text(
+            f"@ 3600 IN SOA ns1 hostmaster {serial} 3600 600 86400 300\n"
+            "@ 3600 IN NS ns1\n" + text,
+            origin="example.org.",
+        )
+        if previous is not None:
+            (old, new) = (zone_records(previous), zone_records(self.zone))
+            for callback in self.listeners:
+                callback(zone_serial(previous), serial, old - new, new - old)
+
+    def listen(self, zone_name, callback):
+        """tell callback about each change"""
+        self.listeners.append(callback)
+
+    def unlisten(self, zone_name, callback):
+        """stop telling callback about changes"""
+        self.listeners.remove(callback)
+
+    def invalidate(self, zone_name):
+        """nothing to do, the zone is always current"""
+
+    async def current_serial(self, zone_name):
+        """count the reads the watcher makes"""
+        self.gets += 1
+        return zone_serial(self.zone)
+
+
+def test_changes_are_journalled_between_serials():
+    """each serial change is journalled as the records deleted and added"""
+    cache = FakeZoneCache()
+
+    async def run():
+        watcher = ChangeFeed(cache).watcher("example.org.")
+        cache.set(1, "www 300 IN A 10.0.0.1\n")
+        await watcher.poll()
+        cache.set(2, "www 300 IN A 10.0.0.2\n")
+        await watcher.poll()
+        cache.set(3, "www 300 IN A 10.0.0.2\nmail 300 IN A 10.0.0.3\n")
+        await watcher.poll()
+        return watcher
+
+    watcher = asyncio.run(run())
+    assert watcher.changes_since(3) == []
+    (first, second) = watcher.changes_since(1)
+    assert (first.start, first.serial) == (1, 2)
+    assert [str(rdata) for (_, _, rdata) in first.deletes] == ["10.0.0.1"]
+    assert [str(rdata) for (_, _, rdata) in first.adds] == ["10.0.0.2"]
+    assert second.deletes == []
+    assert [str(name) for (name, _, _) in second.adds] == ["mail"]
+    assert watcher.changes_since(2) == [second]
+    with pytest.raises(ChangesExpired):
+        watcher.changes_since(0)
+
+
+def test_subscribers_share_one_watcher():
+    """waiting subscribers are woken by the one watcher polling the zone"""
+    cache = FakeZoneCache()
+    cache.set(1, "www 300 IN A 10.0.0.1\n")
+
+    async def subscriber(feed):
+        watcher = feed.watcher("example.org.")
+        await watcher.acquire()
+        try:
+            return await watcher.wait(1, timeout=5)
+        finally:
+            watcher.release()
+
+    async def run():
+        feed = ChangeFeed(cache, interval=0.01)
+        waiting = [asyncio.ensure_future(subscriber(feed)) for _ in range(20)]
+        await asyncio.sleep(0.05)
+        gets = cache.gets
+        cache.set(2, "www 300 IN A 10.0.0.2\n")
+        results = await asyncio.gather(*waiting)
+        await feed.close()
+        return (results, gets)
+
+    (results, gets) = asyncio.run(run())
+    # the first subscriber reads the zone, the rest wait on its watcher
+    assert gets < 20
+    assert all(len(changes) == 1 for changes in results)
+    assert results[0][0].serial == 2
+
+
+def test_wait_times_out_without_changes():
+    """a long poll with nothing new returns no changes"""
+    cache = FakeZoneCache()
+    cache.set(1, "")
+
+    async def run():
+        watcher = ChangeFeed(cache, interval=60).watcher("example.org.")
+        await watcher.acquire()
+        try:
+            return await watcher.wait(1, timeout=0.01)
+        finally:
+            watcher.release()
+            await watcher.close()
+
+    assert asyncio.run(run()) == []
+
+
+def test_watcher_is_dropped_after_its_last_subscriber():
+    """an unwatched zone keeps no watcher, journal or cache listener"""
+    cache = FakeZoneCache()
+    cache.set(1, "www 300 IN A 10.0.0.1\n")
+
+    async def run():
+        feed = ChangeFeed(cache, interval=0.01)
+        watcher = feed.watcher("example.org.")
+        await watcher.acquire()
+        cache.set(2, "www 300 IN A 10.0.0.2\n")
+        assert len(watcher.journal) == 1
+        watcher.release()
+        await asyncio.sleep(0.05)
+        return (feed, watcher)
+
+    (feed, watcher) = asyncio.run(run())
+    assert feed.watcher("example.org.") is not watcher
+    assert not watcher.journal
+    assert not cache.listeners
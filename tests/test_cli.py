@@ -2,7 +2,7 @@
 import os
 from unittest import mock
 from click.testing import CliRunner
-from bind_rest_api.cli import main as cli_main
+from bind_rest_api.cli import main as cli_main, default_workers
 from bind_rest_api.api.constants import __version__ as cli_version
 
 
@@ -110,3 +110,43 @@ def test_password():
     # subsequent calls should generate random data.  There should be no way
     # this is ever equal.
     assert response1.output.strip() != response2.output.strip()
+
+
+def test_serve_dry_run():
+    """serve defaults to a worker per core and reports the server it uses"""
+    response = runner.invoke(
+        cli_main,
+        ["--dry-run", "--bind-user", "test", "--bind-pass", "test", "serve"],
+    )
+    assert response.exit_code == 0
+    assert f"workers: {default_workers()}" in response.output
+    assert "loop: " in response.output
+    response = runner.invoke(
+        cli_main,
+        ["--dry-run", "-w", "2", "--bind-user", "test", "--bind-pass", "test", "serve"],
+    )
+    assert "workers: 2" in response.output
+
+
+@mock.patch.dict(os.environ, {"BIND_ALLOWED_ZONES": ""}, clear=True)
+def test_serve_checks_settings():
+    """serve stops before starting workers when settings are missing"""
+    with mock.patch("uvicorn.run") as run:
+        response = runner.invoke(
+            cli_main, ["--bind-user", "test", "--bind-pass", "test", "serve"]
+        )
+    assert response.exit_code == 1
+    assert "logging_application_name" in response.output
+    assert not run.called
+
+
+def test_tsig_prompts():
+    """the TSIG key is asked for by commands that talk to BIND, only"""
+    env = {"TSIG_USERNAME": None, "TSIG_PASSWORD": None}
+    response = runner.invoke(cli_main, ["--dry-run"], input="user\nsecret\n", env=env)
+    assert response.exit_code == 0
+    assert "Bind user: user" in response.output
+    assert "TSIG pass: secret" in response.output
+    response = runner.invoke(cli_main, ["add-key"], env=env)
+    assert response.exit_code == 0
+    assert "Bind user" not in response.output
@@ -0,0 +1,92 @@
+""" test merging of concurrent zone updates """
+import asyncio
+import dns.message
+import dns.rcode
+import dns.update
+from bind_rest_api.api.coalesce import WriteCoalescer
+
+
+def add(name, address):
+    """build an update adding an A record"""
+    action = dns.update.Update("example.org.")
+    action.add(name, 300, "A", address)
+    return action
+
+
+async def submit_all(coalescer, actions):
+    """submit actions concurrently, returning results or exceptions"""
+    return await asyncio.gather(
+        *(coalescer.submit("example.org.", action) for action in actions),
+        return_exceptions=True,
+    )
+
+
+def test_updates_within_window_are_merged():
+    """concurrent updates go out as one message and everyone gets the reply"""
+    sent = []
+
+    async def send(update):
+        sent.append(update)
+        return dns.message.make_response(update)
+
+    coalescer = WriteCoalescer(send, None, window=0.05)
+    results = asyncio.run(
+        submit_all(coalescer, [add("a", "10.0.0.1"), add("b", "10.0.0.2")])
+    )
+    assert len(sent) == 1
+    assert [str(rrset.name) for rrset in sent[0].update] == ["a", "b"]
+    assert results[0] is results[1]
+    assert coalescer.batch_sizes == {2: 1}
+
+
+def test_max_batch_flushes_early():
+    """a full batch is sent without waiting for the window"""
+    sent = []
+
+    async def send(update):
+        sent.append(update)
+        return dns.message.make_response(update)
+
+    coalescer = WriteCoalescer(send, None, window=60, max_batch=2)
+    asyncio.run(
+        asyncio.wait_for(
+            submit_all(coalescer, [add("a", "10.0.0.1"), add("b", "10.0.0.2")]), 5
+        )
+    )
+    assert len(sent) == 1
+
+
+def test_send_failure_reaches_every_caller():
+    """if the merged update fails each caller sees the error"""
+
+    async def send(update):
+        raise ConnectionRefusedError
+
+    coalescer = WriteCoalescer(send, None, window=0.01)
+    results = asyncio.run(
+        submit_all(coalescer, [add("a", "10.0.0.1"), add("b", "10.0.0.2")])
+    )
+    assert all(isinstance(result, ConnectionRefusedError) for result in results)
+
+
+def test_rejected_batch_is_sent_again_change_by_change():
+    """when BIND rejects the merged update each caller gets its own answer"""
+    sent = []
+
+    async def send(update):
+        sent.append(update)
+        response = dns.message.make_response(update)
+        if any(str(rrset.name) == "bad" for rrset in update.update):
+            response.set_rcode(dns.rcode.REFUSED)
+        return response
+
+    coalescer = WriteCoalescer(send, None, window=0.05)
+    results = asyncio.run(
+        submit_all(coalescer, [add("a", "10.0.0.1"), add("bad", "10.0.0.2")])
+    )
+    assert len(sent) == 3
+    assert [result.rcode() for result in results] == [
+        dns.rcode.NOERROR,
+        dns.rcode.REFUSED,
+    ]
+    assert not coalescer._tasks  # pylint: disable=protected-access
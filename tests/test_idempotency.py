@@ -0,0 +1,166 @@
+""" test the idempotency stores """
+import asyncio
+import subprocess
+import sys
+import pytest
+from fastapi import HTTPException
+from bind_rest_api.api.idempotency import (
+    IdempotencyStore,
+    KeyReused,
+    SharedIdempotencyStore,
+)
+
+
+@pytest.fixture(params=["memory", "shared"])
+def make_store(request, tmp_path):
+    """builds stores kept in memory, or shared through tmp_path"""
+    stores = []
+
+    def make(**options):
+        if request.param == "memory":
+            store = IdempotencyStore(**options)
+        else:
+            store = SharedIdempotencyStore(str(tmp_path), **options)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.close()
+
+
+def handler(calls, status=200):
+    """a handler stand-in counting its calls and answering with status"""
+
+    async def call():
+        calls.append(status)
+        await asyncio.sleep(0.01)
+        if status >= 400:
+            raise HTTPException(status, "failed")
+        return {"call": len(calls)}
+
+    return call
+
+
+def test_repeat_is_replayed(make_store):
+    """a repeated key gets the first response without calling again"""
+    store = make_store()
+    calls = []
+
+    async def attempts():
+        first = await store.run("key", "digest", handler(calls))
+        second = await store.run("key", "digest", handler(calls))
+        return (first, second)
+
+    (first, second) = asyncio.run(attempts())
+    assert calls == [200]
+    assert first == (False, {"call": 1})
+    assert second == (True, {"call": 1})
+
+
+def test_concurrent_repeats_wait_for_the_first(make_store):
+    """repeats sent while the first runs wait for its outcome"""
+    store = make_store()
+    calls = []
+
+    async def attempts():
+        return await asyncio.gather(
+            *(store.run("key", "digest", handler(calls)) for _ in range(3))
+        )
+
+    outcomes = asyncio.run(attempts())
+    assert calls == [200]
+    assert {value["call"] for (_, value) in outcomes} == {1}
+
+
+def test_client_errors_kept_server_errors_retried(make_store):
+    """4xx outcomes are replayed, 5xx ones run again"""
+    store = make_store()
+    calls = []
+
+    async def attempt(key, status):
+        with pytest.raises(HTTPException) as error:
+            await store.run(key, "digest", handler(calls, status))
+        return error.value
+
+    async def attempts():
+        await attempt("conflict", 412)
+        replayed = await attempt("conflict", 412)
+        await attempt("failure", 500)
+        await attempt("failure", 500)
+        return replayed
+
+    replayed = asyncio.run(attempts())
+    assert calls == [412, 500, 500]
+    assert (replayed.status_code, replayed.detail) == (412, "failed")
+    assert replayed.headers == {"idempotent-replayed": "true"}
+
+
+def test_key_reused_for_another_request(make_store):
+    """a key sent with a different request is refused"""
+    store = make_store()
+
+    async def attempts():
+        await store.run("key", "digest", handler([]))
+        await store.run("key", "other", handler([]))
+
+    with pytest.raises(KeyReused):
+        asyncio.run(attempts())
+
+
+def test_outcomes_expire(make_store):
+    """outcomes are dropped after the ttl"""
+    calls = []
+
+    async def attempts(store, *keys):
+        for key in keys:
+            await store.run(key, "digest", handler(calls))
+
+    asyncio.run(attempts(make_store(ttl=0), "a", "a"))
+    assert len(calls) == 2
+
+
+def test_outcomes_are_bounded():
+    """only the latest max_keys outcomes are kept"""
+    calls = []
+
+    async def attempts(store, *keys):
+        for key in keys:
+            await store.run(key, "digest", handler(calls))
+
+    asyncio.run(attempts(IdempotencyStore(max_keys=2), "a", "b", "c", "c", "a"))
+    # a was evicted by c
+    assert len(calls) == 4
+
+
+def test_outcomes_are_shared_between_workers(tmp_path):
+    """a retry handled by another worker gets the first outcome"""
+    (one, other) = (SharedIdempotencyStore(str(tmp_path)) for _ in range(2))
+    calls = []
+
+    async def attempts():
+        first = asyncio.ensure_future(one.run("key", "digest", handler(calls)))
+        await asyncio.sleep(0)
+        # the first attempt is still running, so the retry waits for it
+        return (await first, await other.run("key", "digest", handler(calls)))
+
+    (first, retry) = asyncio.run(attempts())
+    assert calls == [200]
+    assert retry == (True, first[1])
+    one.close()
+    other.close()
+
+
+def test_claim_of_an_exited_worker_is_taken_over(tmp_path):
+    """a key claimed by a worker that exited mid-request runs again"""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    store = SharedIdempotencyStore(str(tmp_path))
+    store._database.execute(  # pylint: disable=protected-access
+        "INSERT INTO outcomes VALUES (?, 'digest', ?, 1e12, NULL)",
+        ('"key"', process.pid),
+    )
+    calls = []
+    outcome = asyncio.run(store.run("key", "digest", handler(calls)))
+    assert (calls, outcome) == ([200], (False, {"call": 1}))
+    store.close()
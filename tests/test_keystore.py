@@ -0,0 +1,76 @@
+""" test the api key store """
+import os
+from bind_rest_api.api.keystore import KeyStore, hash_secret, parse_key_line
+from bind_rest_api.api.ratelimit import Limit
+
+
+def test_parse_plain_and_scoped_lines():
+    """keys may carry a zone scope after the secret"""
+    (digest, entry) = parse_key_line("acme,s3cret,zones=example.org;Example.com.")
+    assert digest == hash_secret("s3cret")
+    assert entry.name == "acme"
+    assert entry.zones == {"example.org.", "example.com."}
+    (digest, entry) = parse_key_line("admin,s3cret")
+    assert entry.zones is None
+
+
+def test_legacy_secret_with_commas():
+    """fields that are not known options stay part of the secret"""
+    (digest, entry) = parse_key_line("old,a,b=c,d")
+    assert digest == hash_secret("a,b=c,d")
+    assert entry.zones is None
+
+
+def test_hashed_secret():
+    """a sha256: keypass is used as the digest directly"""
+    (digest, _) = parse_key_line(f"hashed,sha256:{hash_secret('s3cret').upper()}")
+    assert digest == hash_secret("s3cret")
+
+
+def test_lookup_scopes_and_reload(tmp_path):
+    """keys are found by secret, scoped by zone, and reloaded on change"""
+    key_file = tmp_path / "apikeys.pass"
+    key_file.write_text("# comment\nadmin,one\nacme,two,zones=example.org\n")
+    store = KeyStore(str(key_file), interval=0)
+    assert store.lookup("one").name == "admin"
+    assert store.lookup("nope") is None
+    assert store.lookup("one").permits("example.com.")
+    assert store.lookup("two").permits("Example.org.")
+    assert not store.lookup("two").permits("example.com.")
+
+    key_file.write_text("admin,three\n")
+    stat = os.stat(key_file)
+    os.utime(key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert store.lookup("one") is None
+    assert store.lookup("three").name == "admin"
+
+
+def test_secrets_sharing_a_name_keep_their_scopes(tmp_path):
+    """a scoped secret stays scoped when an unscoped one has its name"""
+    key_file = tmp_path / "apikeys.pass"
+    key_file.write_text("alice,scopedsecret,zones=example.org\nalice,othersecret\n")
+    store = KeyStore(str(key_file), interval=0)
+    scoped = store.lookup("scopedsecret")
+    assert scoped.permits("example.org.")
+    assert not scoped.permits("example.com.")
+    assert store.lookup("othersecret").permits("example.com.")
+
+
+def test_broken_file_keeps_current_keys(tmp_path):
+    """a key file that fails to parse leaves the loaded keys in place"""
+    key_file = tmp_path / "apikeys.pass"
+    key_file.write_text("admin,one\n")
+    store = KeyStore(str(key_file), interval=0)
+    key_file.write_text("no comma here\n")
+    stat = os.stat(key_file)
+    os.utime(key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert store.lookup("one").name == "admin"
+
+
+def test_parse_rate_limits():
+    """read, write and xfr options set a key's rate limits"""
+    (_, entry) = parse_key_line("acme,s3cret,zones=example.org,write=1:5,xfr=0.1")
+    assert entry.limits == {"write": Limit(1, 5), "xfr": Limit(0.1, 1)}
+    assert entry.zones == {"example.org."}
+    (_, entry) = parse_key_line("admin,s3cret")
+    assert entry.limits == {}
@@ -0,0 +1,28 @@
+""" test audit logging """
+import json
+import logging
+from bind_rest_api.api.logs import JsonAuditFormatter
+
+
+def test_json_audit_formatter():
+    """audit fields are written as one compact json object"""
+    record = logging.LogRecord(
+        "bind-api.audit", logging.INFO, __file__, 1, "CREATE ...", (), None
+    )
+    record.audit = {"action": "CREATE", "name": "www.example.org.", "ttl": 300}
+    line = JsonAuditFormatter("dns-api").format(record)
+    assert "\n" not in line
+    entry = json.loads(line)
+    assert entry["app"] == "dns-api"
+    assert entry["action"] == "CREATE"
+    assert entry["ttl"] == 300
+    assert "time" in entry
+
+
+def test_json_audit_formatter_plain_message():
+    """records logged without audit fields keep their message"""
+    record = logging.LogRecord(
+        "bind-api.audit", logging.INFO, __file__, 1, "hello %s", ("there",), None
+    )
+    entry = json.loads(JsonAuditFormatter("dns-api").format(record))
+    assert entry["message"] == "hello there"
@@ -0,0 +1,38 @@
+""" test the bookkeeping of metrics shared between workers """
+import os
+import subprocess
+import sys
+from bind_rest_api.api.metrics import clear_multiprocess_dir, mark_dead_workers
+
+
+def exited_pid():
+    """the pid of a process that has exited"""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_dead_workers_live_gauges_are_removed(tmp_path):
+    """only the live gauges of exited workers go"""
+    (alive, dead) = (os.getpid(), exited_pid())
+    names = [
+        f"gauge_livesum_{alive}.db",
+        f"gauge_liveall_{dead}.db",
+        f"gauge_livesum_{dead}.db",
+        f"counter_{dead}.db",
+    ]
+    for name in names:
+        (tmp_path / name).write_bytes(b"")
+    mark_dead_workers(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"counter_{dead}.db",
+        f"gauge_livesum_{alive}.db",
+    ]
+
+
+def test_clear_multiprocess_dir(tmp_path):
+    """an earlier run's values are removed and other files kept"""
+    (tmp_path / "counter_1.db").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("keep")
+    clear_multiprocess_dir(str(tmp_path))
+    assert [path.name for path in tmp_path.iterdir()] == ["notes.txt"]
@@ -0,0 +1,130 @@
+""" test the pooled TCP connections to BIND """
+import asyncio
+import struct
+import dns.message
+import dns.opcode
+import dns.update
+import pytest
+from bind_rest_api.api.pool import ConnectionPool
+
+
+class Responder:
+    """tiny TCP DNS server answering every message, counting connections"""
+
+    def __init__(self, delay=0.0, close_after=None, drop_updates=False):
+        self.delay = delay
+        self.close_after = close_after
+        self.drop_updates = drop_updates
+        self.connections = 0
+        self.updates = 0
+        self.server = None
+
+    async def handle(self, reader, writer):
+        """answer messages in arrival order after the configured delay"""
+        self.connections += 1
+        answered = 0
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                query = dns.message.from_wire(await reader.readexactly(length))
+                if query.opcode() == dns.opcode.UPDATE:
+                    self.updates += 1
+                    if self.drop_updates:
+                        # as if the connection dropped after the update arrived
+                        break
+                await asyncio.sleep(self.delay)
+                wire = dns.message.make_response(query).to_wire()
+                writer.write(struct.pack("!H", len(wire)) + wire)
+                await writer.drain()
+                answered += 1
+                if answered == self.close_after:
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+    async def start(self):
+        """listen on a free port and return it"""
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+def run(coroutine):
+    """run a test coroutine"""
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_queries_are_pipelined_on_one_connection():
+    """once open, a connection carries concurrent queries, each of which
+    gets its own response
+    """
+
+    async def scenario():
+        responder = Responder(delay=0.01)
+        pool = ConnectionPool("127.0.0.1", port=await responder.start(), size=4)
+        queries = [dns.message.make_query(f"h{i}.example.org.", "A") for i in range(5)]
+        await pool.query(queries[0])
+        responses = await asyncio.gather(*(pool.query(q) for q in queries))
+        await pool.close()
+        responder.server.close()
+        return queries, responses, responder.connections
+
+    queries, responses, connections = run(scenario())
+    assert [r.question[0].name for r in responses] == [
+        q.question[0].name for q in queries
+    ]
+    assert connections == 1
+
+
+def test_updates_do_not_share_a_connection():
+    """concurrent UPDATE messages each get a connection to themselves"""
+
+    async def scenario():
+        responder = Responder(delay=0.05)
+        pool = ConnectionPool("127.0.0.1", port=await responder.start(), size=4)
+        await pool.query(dns.update.Update("example.org."))
+        await asyncio.gather(
+            pool.query(dns.update.Update("example.org.")),
+            pool.query(dns.update.Update("example.org.")),
+        )
+        await pool.close()
+        responder.server.close()
+        return responder.connections
+
+    assert run(scenario()) == 2
+
+
+def test_closed_connection_is_replaced():
+    """a connection the server closed is retried on a new one"""
+
+    async def scenario():
+        responder = Responder(close_after=1)
+        pool = ConnectionPool("127.0.0.1", port=await responder.start())
+        await pool.query(dns.message.make_query("a.example.org.", "A"))
+        await asyncio.sleep(0.05)
+        response = await pool.query(dns.message.make_query("b.example.org.", "A"))
+        await pool.close()
+        responder.server.close()
+        return response, responder.connections
+
+    response, connections = run(scenario())
+    assert str(response.question[0].name) == "b.example.org."
+    assert connections == 2
+
+
+def test_update_is_not_sent_again():
+    """an UPDATE whose reused connection drops after sending it fails
+    rather than being applied twice
+    """
+
+    async def scenario():
+        responder = Responder(drop_updates=True)
+        pool = ConnectionPool("127.0.0.1", port=await responder.start())
+        await pool.query(dns.message.make_query("a.example.org.", "A"))
+        with pytest.raises(ConnectionError):
+            await pool.query(dns.update.Update("example.org."))
+        await pool.close()
+        responder.server.close()
+        return responder.updates
+
+    assert run(scenario()) == 1
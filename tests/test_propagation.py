@@ -0,0 +1,85 @@
+""" test waiting for changes to reach every nameserver """
+import asyncio
+from unittest import mock
+import dns.name
+import dns.resolver
+from bind_rest_api.api.propagation import (
+    NameServer,
+    PropagationChecker,
+    serial_reached,
+)
+
+NS1 = NameServer("ns1.example.org.", "10.0.0.1")
+NS2 = NameServer("ns2.example.net.", "10.1.0.1")
+
+
+def resolver(answers):
+    """a resolver stand-in answering (name, rdtype) from answers"""
+
+    async def resolve(name, rdtype):
+        if (name, rdtype) not in answers:
+            raise dns.resolver.NoAnswer
+        return answers[(name, rdtype)]
+
+    return mock.Mock(resolve=resolve)
+
+
+def serials(*rounds):
+    """a serial stand-in answering each nameserver from successive rounds"""
+    asked = {}
+
+    async def serial(server, zone_name):
+        asked[server] = asked.get(server, -1) + 1
+        return rounds[min(asked[server], len(rounds) - 1)][server]
+
+    return serial
+
+
+def test_serial_reached():
+    """serials compare with RFC 1982 arithmetic"""
+    assert serial_reached(7, 7)
+    assert not serial_reached(6, 7)
+    assert serial_reached(1, 4294967295)
+
+
+def test_nameservers():
+    """each address of each NS is a nameserver, found on the primary or
+    with the system resolver
+    """
+    primary = resolver(
+        {
+            ("example.org.", "NS"): [
+                mock.Mock(target=dns.name.from_text(NS2.name)),
+                mock.Mock(target=dns.name.from_text(NS1.name)),
+            ],
+            (NS1.name, "A"): [mock.Mock(address=NS1.address)],
+        }
+    )
+    checker = PropagationChecker(primary)
+    checker._system = resolver(  # pylint: disable=protected-access
+        {(NS2.name, "AAAA"): [mock.Mock(address="fd00::1")]}
+    )
+    servers = asyncio.run(checker.nameservers("example.org."))
+    assert servers == [NS1, NameServer(NS2.name, "fd00::1")]
+
+
+def test_wait_until_every_nameserver_is_current():
+    """the wait ends when the last nameserver catches up"""
+    checker = PropagationChecker(None, interval=0)
+    with mock.patch.object(checker, "nameservers", return_value=[NS1, NS2]):
+        with mock.patch.object(
+            checker, "serial", serials({NS1: 8, NS2: 7}, {NS2: None}, {NS2: 8})
+        ):
+            (done, found) = asyncio.run(checker.wait("example.org.", 8, 10))
+    assert done
+    assert found == {NS1: 8, NS2: 8}
+
+
+def test_wait_times_out():
+    """a nameserver that never catches up ends the wait at the timeout"""
+    checker = PropagationChecker(None, interval=0.01)
+    with mock.patch.object(checker, "nameservers", return_value=[NS1, NS2]):
+        with mock.patch.object(checker, "serial", serials({NS1: 8, NS2: 7})):
+            (done, found) = asyncio.run(checker.wait("example.org.", 8, 0.05))
+    assert not done
+    assert found == {NS1: 8, NS2: 7}
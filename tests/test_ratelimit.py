@@ -0,0 +1,134 @@
+""" test the rate limits and transfer cap """
+import asyncio
+from unittest import mock
+import pytest
+from bind_rest_api.api import ratelimit
+from bind_rest_api.api.ratelimit import (
+    Limit,
+    Overloaded,
+    RateLimiter,
+    TransferSlots,
+    parse_limit,
+)
+
+
+def test_parse_limit():
+    """rate or rate:burst, the burst at least one"""
+    assert parse_limit("5") == Limit(5, 5)
+    assert parse_limit("0.5") == Limit(0.5, 1)
+    assert parse_limit("2:10") == Limit(2, 10)
+    for text in ("0", "-1", "1:0", "fast"):
+        with pytest.raises(ValueError):
+            parse_limit(text)
+
+
+class Clock:
+    """a monotonic clock the test moves on"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_buckets_refill_and_queue():
+    """a burst is admitted at once, then requests queue up to max_wait"""
+    clock = Clock()
+    limiter = RateLimiter({"write": Limit(2, 2)}, max_wait=0.5)
+    waits = []
+
+    async def sleep(seconds):
+        waits.append(seconds)
+
+    async def run():
+        with mock.patch.object(ratelimit.time, "monotonic", clock), mock.patch.object(
+            ratelimit.asyncio, "sleep", sleep
+        ):
+            await limiter.admit("acme", "write")
+            await limiter.admit("acme", "write")
+            # the next token is half a second away, which is worth waiting for
+            await limiter.admit("acme", "write")
+            with pytest.raises(Overloaded) as error:
+                await limiter.admit("acme", "write")
+            # other keys and kinds have buckets of their own
+            await limiter.admit("other", "write")
+            await limiter.admit("acme", "read")
+            clock.now += 10
+            await limiter.admit("acme", "write")
+        return error.value
+
+    error = asyncio.run(run())
+    assert waits == [0.5]
+    assert error.retry_after == pytest.approx(1.0)
+
+
+def test_key_limits_override_defaults():
+    """a key's own limit replaces the default"""
+    limiter = RateLimiter({}, max_wait=0)
+
+    async def run():
+        await limiter.admit("acme", "xfr")
+        await limiter.admit("acme", "xfr")
+        await limiter.admit("acme", "xfr", Limit(1, 1))
+        await limiter.admit("acme", "xfr", Limit(1, 1))
+
+    with pytest.raises(Overloaded):
+        asyncio.run(run())
+
+
+def test_transfer_slots():
+    """only limit transfers run at once, others wait or are refused"""
+
+    async def run():
+        slots = TransferSlots(1, max_wait=0.01)
+        await slots.acquire()
+        with pytest.raises(Overloaded):
+            await slots.acquire(wait=False)
+        waiting = asyncio.ensure_future(slots.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        slots.release()
+        await waiting
+
+    asyncio.run(run())
+
+
+def test_buckets_are_shared_between_workers(tmp_path):
+    """workers sharing a directory draw on the same bucket"""
+    (one, other) = (
+        RateLimiter({"write": Limit(0.1, 2)}, max_wait=0, directory=str(tmp_path))
+        for _ in range(2)
+    )
+
+    async def run():
+        await one.admit("acme", "write")
+        await other.admit("acme", "write")
+        with pytest.raises(Overloaded):
+            await one.admit("acme", "write")
+        # a changed limit starts a new bucket
+        await other.admit("acme", "write", Limit(0.1, 1))
+
+    asyncio.run(run())
+    one.close()
+    other.close()
+
+
+def test_transfer_slots_are_shared_between_workers(tmp_path):
+    """a slot held by one worker is not free for another"""
+
+    async def run():
+        (one, other) = (
+            TransferSlots(1, max_wait=0.05, directory=str(tmp_path)) for _ in range(2)
+        )
+        await one.acquire()
+        with pytest.raises(Overloaded):
+            await other.acquire(wait=False)
+        waiting = asyncio.ensure_future(other.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        one.release()
+        await asyncio.wait_for(waiting, 1)
+        other.release()
+
+    asyncio.run(run())
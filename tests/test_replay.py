@@ -0,0 +1,217 @@
+""" test replaying audit logs """
+import gzip
+import json
+import time
+import threading
+from click.testing import CliRunner
+from bind_rest_api.cli import main as cli_main
+from bind_rest_api.replay import (
+    Replayer,
+    audit_files,
+    parse_line,
+    read_entries,
+    request_for,
+    schedule,
+    summarize,
+    Result,
+)
+
+TEXT_LINES = [
+    "2021-10-10T10:00+0000 == bind-api == CREATE www.example.org. A 300 10.0.0.1 "
+    "for key testkey\n",
+    "2021-10-10T10:00+0000 == bind-api == REPLACE txt.example.org. TXT 60 "
+    '"hi there for key me" for key testkey\n',
+    "2021-10-10T10:01+0000 == bind-api == FAILED:DELETE www.example.org. A,AAAA - - "
+    "for key testkey\n",
+]
+
+
+def json_line(action, name, rrtype, rdata, ttl, when="2021-10-11T10:00:30+0000"):
+    """a json audit log line"""
+    return (
+        json.dumps(
+            {
+                "time": when,
+                "app": "bind-api",
+                "action": action,
+                "key": "testkey",
+                "zone": "example.org.",
+                "name": name,
+                "rrtype": rrtype,
+                "rdata": rdata,
+                "ttl": ttl,
+                "result": "ok",
+                "latency_ms": 1.5,
+            }
+        )
+        + "\n"
+    )
+
+
+def test_parse_text_lines():
+    """text audit lines are parsed, with spaces in rdata"""
+    (create, replace, delete) = [parse_line(line) for line in TEXT_LINES]
+    assert (create.action, create.domain, create.rrtype) == (
+        "CREATE",
+        "www.example.org.",
+        "A",
+    )
+    assert (create.ttl, create.rdata, create.failed) == (300, "10.0.0.1", False)
+    assert replace.rdata == '"hi there for key me"'
+    assert (delete.rrtype, delete.ttl, delete.rdata) == ("A,AAAA", None, None)
+    assert delete.failed
+    assert create.resolution == 60
+    assert parse_line("2021-10-10T10:00+0000 == bind-api == api started\n") is None
+    assert parse_line("garbage\n") is None
+
+
+BASELINE_LINES = [
+    "2021-10-09T10:00+0000 == bind-api == CREATE www.example.org. RecordType.A "
+    "testkey -> www.example.org. record response='10.0.0.1' "
+    "rrtype=<RecordType.A: 'A'> ttl=300 for key testkey\n",
+    "2021-10-09T10:00+0000 == bind-api == FAILED:REPLACE txt.example.org. "
+    'RecordType.TXT testkey -> txt.example.org. record response="it\'s for key me" '
+    "rrtype=<RecordType.TXT: 'TXT'> ttl=60 for key testkey\n",
+    "2021-10-09T10:01+0000 == bind-api == DELETE www.example.org. A,AAAA testkey "
+    "-> www.example.org. record ['A', 'AAAA'] for key testkey\n",
+]
+
+
+def test_parse_baseline_text_lines():
+    """lines logged in the older text format are parsed from the Record"""
+    (create, replace, delete) = [parse_line(line) for line in BASELINE_LINES]
+    assert (create.action, create.domain, create.rrtype) == (
+        "CREATE",
+        "www.example.org.",
+        "A",
+    )
+    assert (create.ttl, create.rdata, create.failed) == (300, "10.0.0.1", False)
+    assert (replace.rrtype, replace.ttl, replace.rdata) == (
+        "TXT",
+        60,
+        "it's for key me",
+    )
+    assert replace.failed
+    assert (delete.rrtype, delete.ttl, delete.rdata) == ("A,AAAA", None, None)
+    assert request_for(create) == (
+        "POST",
+        "/dns/record/www.example.org.",
+        {"response": "10.0.0.1", "rrtype": "A", "ttl": 300},
+    )
+    # a record that is not a Record repr is skipped rather than raising
+    assert parse_line(BASELINE_LINES[0].replace("ttl=300", "ttl=x")) is None
+
+
+def test_parse_json_lines():
+    """json audit lines are parsed, and other json lines are not"""
+    entry = parse_line(json_line("DELETE", "www.example.org.", "A", "10.0.0.1", None))
+    assert (entry.action, entry.domain, entry.rdata, entry.ttl) == (
+        "DELETE",
+        "www.example.org.",
+        "10.0.0.1",
+        None,
+    )
+    assert entry.resolution == 1
+    assert parse_line('{"time": "2021-10-11T10:00:30+0000", "message": "hi"}') is None
+
+
+def test_rotated_files_oldest_first(tmp_path):
+    """rotated logs come before the current one, gzipped ones are read"""
+    (tmp_path / "dns-api-audit.log").write_text(TEXT_LINES[2])
+    (tmp_path / "dns-api-audit.log.2021-10-03").write_text(TEXT_LINES[0])
+    with gzip.open(tmp_path / "dns-api-audit.log.2021-09-26.gz", "wt") as log_file:
+        log_file.write(TEXT_LINES[1])
+    (tmp_path / "dns-api-debug.log").write_text(TEXT_LINES[0])
+    files = audit_files([str(tmp_path)])
+    assert [path.rsplit("/", 1)[1] for path in files] == [
+        "dns-api-audit.log.2021-09-26.gz",
+        "dns-api-audit.log.2021-10-03",
+        "dns-api-audit.log",
+    ]
+    assert [entry.action for entry in read_entries([str(tmp_path)])] == [
+        "REPLACE",
+        "CREATE",
+        "DELETE",
+    ]
+
+
+def test_schedule_spreads_entries():
+    """entries logged in the same minute are spread across it"""
+    entries = [parse_line(line) for line in TEXT_LINES]
+    assert [offset for (offset, _) in schedule(entries)] == [0.0, 30.0, 60.0]
+
+
+def test_requests_for_entries():
+    """each audited change maps to the request that made it"""
+    (create, replace, delete) = [parse_line(line) for line in TEXT_LINES]
+    assert request_for(create) == (
+        "POST",
+        "/dns/record/www.example.org.",
+        {"response": "10.0.0.1", "rrtype": "A", "ttl": 300},
+    )
+    assert request_for(replace)[0] == "PUT"
+    assert request_for(delete) == (
+        "DELETE",
+        "/dns/allrecords/www.example.org.?recordtypes=A&recordtypes=AAAA",
+        None,
+    )
+    single = parse_line(json_line("DELETE", "www.example.org.", "A", "10.0.0.1", None))
+    assert request_for(single) == (
+        "DELETE",
+        "/dns/record/www.example.org.",
+        {"response": "10.0.0.1", "rrtype": "A"},
+    )
+
+
+def test_summarize():
+    """percentiles and errors are reported"""
+    results = [Result(200, latency / 100, 0.0) for latency in range(1, 100)]
+    results.append(Result(500, 2.0, 0.5))
+    results.append(Result("ConnectionRefusedError", 0.01, 0.0))
+    report = summarize(results, 10.0)
+    assert (report.requests, report.throughput) == (101, 10.1)
+    assert (report.p50, report.p90, report.max) == (0.5, 0.9, 2.0)
+    assert report.errors == 2
+    assert report.statuses == {200: 99, 500: 1, "ConnectionRefusedError": 1}
+    assert report.lag == 0.5
+
+
+def test_replay_sends_every_change():
+    """the replayer sends each change once, at most concurrency at a time"""
+    sent = []
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def send(method, path, body):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.001)
+        with lock:
+            sent.append((method, path))
+            in_flight[0] -= 1
+        return 200 if method != "DELETE" else 404
+
+    entries = [parse_line(line) for line in TEXT_LINES * 10]
+    report = Replayer("http://api", "secret", concurrency=3, speed=0, send=send).run(
+        entries
+    )
+    assert len(sent) == report.requests == 30
+    assert in_flight[1] <= 3
+    assert report.statuses == {200: 20, 404: 10}
+    assert report.errors == 10
+
+
+def test_replay_dry_run(tmp_path):
+    """a dry run reads the logs without sending, or asking for the BIND
+    TSIG key
+    """
+    (tmp_path / "dns-api-audit.log").write_text("".join(TEXT_LINES))
+    response = CliRunner().invoke(
+        cli_main,
+        ["--dry-run", "replay", "--api-key", "x", "--skip-failed", str(tmp_path)],
+        env={"TSIG_USERNAME": None, "TSIG_PASSWORD": None},
+    )
+    assert response.exit_code == 0
+    assert "changes: 2" in response.output
+    assert "logged over: 30s" in response.output
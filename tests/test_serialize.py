@@ -0,0 +1,70 @@
+""" test the zone export formats """
+import json
+from unittest import mock
+import dns.name
+import dns.zone
+from bind_rest_api.api import serialize
+from bind_rest_api.api.serialize import dumps, name_text, render_zone
+
+ZONE = """
+@ 3600 IN SOA ns1 hostmaster 7 3600 600 86400 300
+@ 3600 IN NS ns1
+@ 300 IN TXT "v=spf1 -all"
+www 300 IN A 10.0.0.1
+www 300 IN A 10.0.0.2
+we\\"ird 60 IN CNAME www
+"""
+
+
+def make_zone():
+    """a zone with a name that needs escaping"""
+    return dns.zone.from_text(ZONE, origin="example.org.")
+
+
+def test_zone_json():
+    """the json form groups records by name and lists the SOA fields"""
+    content = json.loads(render_zone(make_zone(), 7, "json"))
+    assert content["SOA"] == {
+        "ttl": 3600,
+        "expire": 86400,
+        "minimum": 300,
+        "refresh": 3600,
+        "retry": 600,
+        "rname": "hostmaster",
+        "mname": "ns1",
+        "serial": 7,
+    }
+    assert content["records"]["@"] == [
+        {"response": "ns1", "rrtype": "NS", "ttl": 3600},
+        {"response": '"v=spf1 -all"', "rrtype": "TXT", "ttl": 300},
+    ]
+    assert len(content["records"]["www"]) == 2
+    assert content["records"]['we\\"ird'][0]["rrtype"] == "CNAME"
+
+
+def test_zone_columnar_and_text():
+    """the columnar form has one entry per record in each column, and the
+    text form reads back as the same zone
+    """
+    zone = make_zone()
+    content = json.loads(render_zone(zone, 7, "columnar"))
+    assert (content["origin"], content["serial"]) == ("example.org.", 7)
+    assert len(content["name"]) == len(content["response"]) == 6
+    assert content["rrtype"][content["name"].index("www")] == "A"
+    text = render_zone(zone, 7, "text").decode()
+    assert text.startswith("$ORIGIN example.org.")
+    assert dns.zone.from_text(text, origin="example.org.") == zone
+
+
+def test_name_text_matches_dnspython():
+    """the fast path gives the same text as Name.to_text"""
+    for text in ("www", "@", "a.example.org.", ".", "*.k8s", 'we\\"ird', "a\\032b"):
+        name = dns.name.from_text(text, None)
+        assert name_text(name) == name.to_text()
+
+
+def test_dumps_without_orjson():
+    """the standard library encoder gives the same bytes"""
+    content = {"name": "ünïcode", "ttl": 300, "records": [1, 2]}
+    with mock.patch.object(serialize, "orjson", None):
+        assert dumps(content) == '{"name":"ünïcode","ttl":300,"records":[1,2]}'.encode()
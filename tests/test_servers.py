@@ -0,0 +1,156 @@
+""" test choosing the BIND server reads go to """
+import asyncio
+from unittest import mock
+import dns.exception
+from bind_rest_api.api.servers import Server, ServerMonitor, parse_servers
+from bind_rest_api.api.shared import ZoneGenerations
+
+PRIMARY = Server("10.0.0.1", 53)
+NEAR = Server("10.0.0.2", 53)
+FAR = Server("10.0.0.3", 53)
+
+
+def test_parse_servers():
+    """the first server is the primary, ports default to BIND_PORT"""
+    assert parse_servers("10.0.0.1, 10.0.0.2:5353,[::1]:54,::2", 5300) == [
+        Server("10.0.0.1", 5300),
+        Server("10.0.0.2", 5353),
+        Server("::1", 54),
+        Server("::2", 5300),
+    ]
+
+
+def fake_soa(serials, delays=None, down=()):
+    """a soa_query stand-in answering from serials, keyed by server"""
+
+    async def soa_query(server, zone_name, timeout):
+        if server in down:
+            raise dns.exception.Timeout
+        await asyncio.sleep((delays or {}).get(server, 0))
+        serial = serials[server]
+        if isinstance(serial, dict):
+            # serials by zone, a zone the server lacks has no SOA
+            return serial[zone_name]
+        return serial
+
+    return soa_query
+
+
+def check(monitor, soa_query):
+    """run one round of checks"""
+    with mock.patch("bind_rest_api.api.servers.soa_query", soa_query):
+        asyncio.run(monitor.check())
+
+
+def test_reads_go_to_the_fastest_current_secondary():
+    """a secondary is only chosen when it holds the primary's serial"""
+    monitor = ServerMonitor(PRIMARY, [NEAR, FAR], ["example.org."])
+    delays = {NEAR: 0, FAR: 0.02}
+    # the zone is only checked once it has been read
+    assert monitor.choose("example.org.") == PRIMARY
+    check(monitor, fake_soa({PRIMARY: 2, NEAR: 2, FAR: 2}, delays))
+    assert monitor.choose("example.org.") == NEAR
+    check(monitor, fake_soa({PRIMARY: 3, NEAR: 2, FAR: 3}, delays))
+    assert monitor.choose("example.org.") == FAR
+    # a transfer at a known serial can use a secondary holding it
+    assert monitor.choose("example.org.", serial=2) == NEAR
+    check(monitor, fake_soa({PRIMARY: 3, NEAR: 3, FAR: 3}, delays, down=[NEAR]))
+    assert monitor.choose("example.org.") == FAR
+    assert monitor.healthy[NEAR] is False
+
+
+def test_writes_send_reads_to_the_primary():
+    """after a write the primary is read until the secondaries catch up"""
+    generations = ZoneGenerations(["example.org."])
+    monitor = ServerMonitor(PRIMARY, [NEAR], ["example.org."], generations=generations)
+    monitor.choose("example.org.")
+    check(monitor, fake_soa({PRIMARY: 2, NEAR: 2}))
+    assert monitor.choose("example.org.") == NEAR
+    generations.bump("example.org.")
+    assert monitor.choose("example.org.") == PRIMARY
+    check(monitor, fake_soa({PRIMARY: 3, NEAR: 2}))
+    assert monitor.choose("example.org.") == PRIMARY
+    check(monitor, fake_soa({PRIMARY: 3, NEAR: 3}))
+    assert monitor.choose("example.org.") == NEAR
+
+
+def test_no_secondaries_reads_from_the_primary():
+    """with only a primary nothing is checked"""
+    monitor = ServerMonitor(PRIMARY, [], ["example.org."])
+    with mock.patch("bind_rest_api.api.servers.soa_query") as soa_query:
+        asyncio.run(monitor.start())
+    assert not soa_query.called
+    assert monitor.choose("example.org.") == PRIMARY
+
+
+def test_health_is_per_zone():
+    """a secondary lacking one zone still serves the others"""
+    zones = ["example.org.", "example.com."]
+    monitor = ServerMonitor(PRIMARY, [NEAR], zones)
+    for zone in zones:
+        monitor.choose(zone)
+    check(
+        monitor,
+        fake_soa(
+            {PRIMARY: {"example.org.": 2, "example.com.": 5}, NEAR: {"example.com.": 5}}
+        ),
+    )
+    assert monitor.healthy[NEAR] is True
+    assert monitor.choose("example.com.") == NEAR
+    assert monitor.choose("example.org.") == PRIMARY
+
+
+def test_only_recently_read_zones_are_checked():
+    """zones nobody read are not queried, and are read from the primary"""
+    zones = ["example.org.", "example.com."]
+    monitor = ServerMonitor(PRIMARY, [NEAR], zones, interval=1)
+    queried = []
+
+    async def soa_query(server, zone_name, timeout):
+        queried.append(zone_name)
+        return 2
+
+    monitor.choose("example.com.")
+    check(monitor, soa_query)
+    assert set(queried) == {"example.com."}
+    # a read long ago no longer counts
+    monitor.reads.set("example.com.", 1)
+    check(monitor, soa_query)
+    assert monitor.choose("example.com.") == PRIMARY
+
+
+def test_one_worker_checks_for_all(tmp_path):
+    """workers sharing a directory load the checks of the one holding the
+    lock, and see each other's reads and writes
+    """
+    zones = ["example.org."]
+    (leader, follower) = (
+        ServerMonitor(
+            PRIMARY,
+            [NEAR],
+            zones,
+            generations=ZoneGenerations(zones, str(tmp_path)),
+            directory=str(tmp_path),
+        )
+        for _ in range(2)
+    )
+    queried = []
+
+    async def soa_query(server, zone_name, timeout):
+        queried.append(server)
+        return 2
+
+    async def run():
+        with mock.patch("bind_rest_api.api.servers.soa_query", soa_query):
+            await leader.update()
+            follower.choose("example.org.")
+            await leader.update()
+            await follower.update()
+
+    asyncio.run(run())
+    assert queried == [PRIMARY, NEAR]
+    assert follower.choose("example.org.") == NEAR
+    leader.generations.bump("example.org.")
+    assert follower.choose("example.org.") == PRIMARY
+    for monitor in (leader, follower):
+        asyncio.run(monitor.close())
@@ -0,0 +1,24 @@
+""" test the state shared between workers """
+from bind_rest_api.api.shared import ZoneGenerations
+
+ZONES = ["example.org.", "example.com."]
+
+
+def test_generations_are_seen_by_every_worker(tmp_path):
+    """a write counted through one worker's map is read through another's"""
+    (one, other) = (ZoneGenerations(ZONES, str(tmp_path)) for _ in range(2))
+    one.bump("example.com.")
+    one.bump("example.com.")
+    assert other.get("example.com.") == 2
+    assert other.get("example.org.") == 0
+    one.close()
+    other.close()
+
+
+def test_generations_without_a_directory():
+    """without a directory the counts are kept in the process"""
+    generations = ZoneGenerations(ZONES)
+    generations.bump("example.org.")
+    generations.bump("other.org.")
+    assert generations.get("example.org.") == 1
+    assert generations.get("other.org.") == 0
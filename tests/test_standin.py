@@ -0,0 +1,64 @@
+""" test the benchmark BIND stand-in against the api's own DNS clients """
+import asyncio
+import dns.asyncresolver
+import dns.rcode
+import dns.tsigkeyring
+import dns.update
+from benchmarks.standin import StandIn, make_zone
+from bind_rest_api.api.pool import ConnectionPool
+from bind_rest_api.api.zonecache import ZoneCache, zone_serial
+from bind_rest_api.api.zonestream import iterate_axfr
+
+KEYRING = dns.tsigkeyring.from_text({"local-ddns": "YWJjMTIz"})
+
+
+def run(coroutine):
+    """run a test coroutine"""
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_update_query_and_transfers():
+    """signed updates are applied and seen by queries, AXFR and IXFR"""
+
+    async def scenario():
+        standin = StandIn(KEYRING, [make_zone("example.org.", records=500)])
+        port = await standin.start()
+        pool = ConnectionPool("127.0.0.1", port=port)
+        cache = ZoneCache("127.0.0.1", port=port, max_age=0, query=pool.query)
+        zone = await cache.get("example.org.")
+        assert zone_serial(zone) == 1
+        assert len(zone.nodes) == 502
+
+        update = dns.update.Update("example.org.", keyring=KEYRING)
+        update.add("new", 60, "A", "10.9.9.9")
+        update.delete("host1", "A")
+        assert (await pool.query(update)).rcode() == dns.rcode.NOERROR
+        unsigned = dns.update.Update("example.org.")
+        unsigned.add("other", 60, "A", "10.9.9.8")
+        assert (await pool.query(unsigned)).rcode() == dns.rcode.REFUSED
+        guarded = dns.update.Update("example.org.", keyring=KEYRING)
+        guarded.absent("new", "A")
+        guarded.add("new", 60, "A", "10.9.9.8")
+        assert (await pool.query(guarded)).rcode() == dns.rcode.YXRRSET
+
+        resolver = dns.asyncresolver.Resolver(configure=False)
+        resolver.nameservers = ["127.0.0.1"]
+        resolver.port = port
+        answer = await resolver.resolve("new.example.org.", "A")
+        assert [str(r) for r in answer.rrset] == ["10.9.9.9"]
+
+        zone = await cache.get("example.org.")
+        streamed = [
+            record
+            async for record in iterate_axfr("127.0.0.1", "example.org.", port=port)
+        ]
+        await pool.close()
+        standin.close()
+        return (zone, streamed, standin.counts)
+
+    zone, streamed, counts = run(scenario())
+    assert zone_serial(zone) == 2
+    assert zone.get_node("new") is not None
+    assert zone.get_node("host1") is None
+    assert counts["ixfr"] == 1
+    assert len(streamed) == 503
@@ -0,0 +1,62 @@
+""" test the cached zone response bodies """
+import os
+import gzip
+from unittest import mock
+from bind_rest_api.api import zonebody
+from bind_rest_api.api.zonebody import ZoneBodies, choose_encoding, etag_matches
+
+
+def test_choose_encoding():
+    """zstd only when installed, then gzip, and q=0 refuses a coding"""
+    with mock.patch.object(zonebody, "zstandard", None):
+        assert choose_encoding("gzip, deflate, br, zstd") == "gzip"
+    with mock.patch.object(zonebody, "zstandard", object()):
+        assert choose_encoding("gzip;q=0.5, zstd") == "zstd"
+    assert choose_encoding("gzip;q=0") == "identity"
+    assert choose_encoding(None) == "identity"
+
+
+def test_etag_matches():
+    """weak comparison against each tag in the header"""
+    assert etag_matches('W/"5"', 5)
+    assert etag_matches('"4", "5"', 5)
+    assert etag_matches("*", 5)
+    assert not etag_matches('"4"', 5)
+    assert not etag_matches(None, 5)
+
+
+def test_gzip_is_repeatable():
+    """gzip bodies carry no timestamp, so each compresses to the same bytes"""
+    body = b'{"records":{}}' * 100
+    compressed = zonebody.compress(body, "gzip")
+    assert compressed[4:8] == b"\0\0\0\0"
+    assert zonebody.compress(body, "gzip") == compressed
+    assert gzip.decompress(compressed) == body
+
+
+def test_bodies_are_rendered_once_per_serial():
+    """a body is rendered and compressed once until the serial moves on"""
+    bodies = ZoneBodies()
+    render = mock.Mock(return_value=b'{"records":{}}')
+    first = bodies.get("example.org.", 1, render, "gzip")
+    assert bodies.get("example.org.", 1, render, "gzip") is first
+    assert bodies.get("example.org.", 1, render) == b'{"records":{}}'
+    assert gzip.decompress(first) == b'{"records":{}}'
+    assert render.call_count == 1
+    bodies.get("example.org.", 2, render)
+    assert render.call_count == 2
+
+
+def test_bodies_are_shared_through_a_directory(tmp_path):
+    """workers sharing a directory render each body once and keep only the
+    latest serial
+    """
+    workers = (ZoneBodies(str(tmp_path)), ZoneBodies(str(tmp_path)))
+    render = mock.Mock(return_value=b'{"records":{}}')
+    first = workers[0].get("example.org.", 1, render, "gzip")
+    assert workers[1].get("example.org.", 1, render, "gzip") == first
+    assert workers[1].get("example.org.", 1, render) == b'{"records":{}}'
+    assert render.call_count == 1
+    workers[1].get("example.org.", 2, render)
+    assert render.call_count == 2
+    assert os.listdir(tmp_path / "example.org.") == ["2.json.identity"]
@@ -0,0 +1,187 @@
+""" test the zone cache refresh logic """
+import asyncio
+from unittest import mock
+import dns.asyncquery
+import dns.rdataset
+import dns.tsigkeyring
+import dns.update
+import dns.xfr
+from benchmarks.standin import StandIn, make_zone
+from bind_rest_api.api.servers import Server
+from bind_rest_api.api.zonecache import ZoneCache, zone_serial
+
+KEYRING = dns.tsigkeyring.from_text({"local-ddns": "YWJjMTIz"})
+
+
+def fake_transfer(serial, calls):
+    """build an inbound_xfr stand-in that loads a zone at serial"""
+
+    async def inbound_xfr(where, zone, **kwargs):
+        calls.append(zone_serial(zone) if zone.nodes else None)
+        with zone.writer() as txn:
+            txn.replace(
+                "@",
+                dns.rdataset.from_text(
+                    "IN", "SOA", 300, f"ns1 hostmaster {serial} 1 1 1 1"
+                ),
+            )
+            txn.replace("www", dns.rdataset.from_text("IN", "A", 300, "10.0.0.1"))
+
+    return inbound_xfr
+
+
+def serial(value):
+    """build a soa_serial stand-in returning value"""
+
+    async def soa_serial(zone_name):
+        soa_serial.call_count += 1
+        return value
+
+    soa_serial.call_count = 0
+    return soa_serial
+
+
+def test_first_get_uses_axfr_then_serves_from_memory():
+    """the first read transfers the zone, the next one is served from memory"""
+    cache = ZoneCache("127.0.0.1", max_age=60)
+    calls = []
+    with mock.patch.object(cache, "soa_serial", serial(1)) as soa, mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(1, calls)
+    ):
+        zone = asyncio.run(cache.get("example.org."))
+        assert zone_serial(zone) == 1
+        assert asyncio.run(cache.get("example.org.")) is zone
+    # one AXFR (no serial yet) and a single SOA check
+    assert calls == [None]
+    assert soa.call_count == 1
+
+
+def test_invalidate_uses_ixfr_from_cached_serial():
+    """after invalidation a newer serial is fetched with IXFR"""
+    cache = ZoneCache("127.0.0.1", max_age=60)
+    calls = []
+    with mock.patch.object(cache, "soa_serial", serial(1)), mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(1, calls)
+    ):
+        asyncio.run(cache.get("example.org."))
+    cache.invalidate("example.org.")
+    with mock.patch.object(cache, "soa_serial", serial(2)), mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(2, calls)
+    ):
+        zone = asyncio.run(cache.get("example.org."))
+    assert zone_serial(zone) == 2
+    assert calls == [None, 1]
+
+
+def test_unchanged_serial_skips_transfer():
+    """an invalidated zone with the same serial is not transferred again"""
+    cache = ZoneCache("127.0.0.1", max_age=0)
+    calls = []
+    with mock.patch.object(cache, "soa_serial", serial(1)), mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(1, calls)
+    ):
+        asyncio.run(cache.get("example.org."))
+        asyncio.run(cache.get("example.org."))
+    assert calls == [None]
+
+
+def test_ixfr_failure_falls_back_to_axfr():
+    """a failed IXFR reloads the zone with AXFR"""
+    cache = ZoneCache("127.0.0.1", max_age=0)
+    calls = []
+    with mock.patch.object(cache, "soa_serial", serial(1)), mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(1, calls)
+    ):
+        asyncio.run(cache.get("example.org."))
+
+    async def refuse_ixfr(where, zone, **kwargs):
+        if zone.nodes:
+            raise dns.xfr.TransferError(5)
+        await fake_transfer(2, calls)(where, zone, **kwargs)
+
+    with mock.patch.object(cache, "soa_serial", serial(2)), mock.patch(
+        "dns.asyncquery.inbound_xfr", refuse_ixfr
+    ):
+        zone = asyncio.run(cache.get("example.org."))
+    assert zone_serial(zone) == 2
+    assert calls == [None, None]
+
+
+def test_transfer_from_selected_server_falls_back_to_primary():
+    """a zone is transferred from the selected server, or the primary if
+    that fails
+    """
+    secondary = Server("10.0.0.2", 53)
+    cache = ZoneCache("127.0.0.1", max_age=0, select=lambda zone, serial: secondary)
+    sources = []
+
+    async def secondary_down(where, zone, **kwargs):
+        sources.append(where)
+        if where == secondary.host:
+            raise ConnectionRefusedError
+        await fake_transfer(1, [])(where, zone, **kwargs)
+
+    with mock.patch.object(cache, "soa_serial", serial(1)), mock.patch(
+        "dns.asyncquery.inbound_xfr", secondary_down
+    ):
+        zone = asyncio.run(cache.get("example.org."))
+    assert zone_serial(zone) == 1
+    assert sources == ["10.0.0.2", "127.0.0.1"]
+
+
+def test_listeners_get_the_ixfr_changes():
+    """the records an IXFR deletes and adds are passed on as they are"""
+
+    async def scenario():
+        standin = StandIn(KEYRING, [make_zone("example.org.", records=50)])
+        port = await standin.start()
+        cache = ZoneCache("127.0.0.1", port=port, max_age=0)
+        changes = []
+        cache.listen("example.org.", lambda *change: changes.append(change))
+        await cache.get("example.org.")
+        update = dns.update.Update("example.org.", keyring=KEYRING)
+        update.add("new", 60, "A", "10.9.9.9")
+        update.delete("host1", "A")
+        await dns.asyncquery.tcp(update, "127.0.0.1", port=port)
+        await cache.get("example.org.")
+        standin.close()
+        return (changes, standin.counts)
+
+    (changes, counts) = asyncio.run(asyncio.wait_for(scenario(), 10))
+    assert counts["ixfr"] == 1
+    ((start, end, deletes, adds),) = changes
+    assert (start, end) == (1, 2)
+    assert [(str(name), ttl, str(rdata)) for (name, ttl, rdata) in adds] == [
+        ("new", 60, "10.9.9.9")
+    ]
+    assert [str(name) for (name, _, _) in deletes] == ["host1"]
+
+
+def test_listeners_get_the_difference_after_axfr():
+    """a zone reloaded by AXFR is compared with the one it replaces"""
+    cache = ZoneCache("127.0.0.1", max_age=0)
+    with mock.patch.object(cache, "soa_serial", serial(1)), mock.patch(
+        "dns.asyncquery.inbound_xfr", fake_transfer(1, [])
+    ):
+        asyncio.run(cache.get("example.org."))
+    changes = []
+    cache.listen("example.org.", lambda *change: changes.append(change))
+
+    async def axfr_only(where, zone, **kwargs):
+        if zone.nodes:
+            raise dns.xfr.TransferError(5)
+        with zone.writer() as txn:
+            txn.replace(
+                "@",
+                dns.rdataset.from_text("IN", "SOA", 300, "ns1 hostmaster 2 1 1 1 1"),
+            )
+            txn.replace("mail", dns.rdataset.from_text("IN", "A", 300, "10.0.0.2"))
+
+    with mock.patch.object(cache, "soa_serial", serial(2)), mock.patch(
+        "dns.asyncquery.inbound_xfr", axfr_only
+    ):
+        asyncio.run(cache.get("example.org."))
+    ((start, end, deletes, adds),) = changes
+    assert (start, end) == (1, 2)
+    assert [str(name) for (name, _, _) in deletes] == ["www"]
+    assert [str(name) for (name, _, _) in adds] == ["mail"]
@@ -0,0 +1,32 @@
+""" test the allowed zone index """
+from bind_rest_api.api.zoneindex import ZoneIndex
+
+zones = ZoneIndex(["example.org.", "customer.example.org.", "example.com."])
+
+
+def test_most_specific_zone_wins():
+    """a name in a delegated child zone maps to the child, not the parent"""
+    assert zones.find("host.customer.example.org.") == "customer.example.org."
+    assert zones.find("host.example.org.") == "example.org."
+    assert zones.find("example.org.") == "example.org."
+
+
+def test_matching_is_by_label():
+    """a zone only matches whole labels, and ignores case"""
+    assert zones.find("badexample.org.") is None
+    assert zones.find("Host.EXAMPLE.com.") == "example.com."
+    assert zones.find("host.example.net.") is None
+
+
+def test_exact_zone_lookup():
+    """get and in only accept the zone itself"""
+    assert zones.get("Example.ORG.") == "example.org."
+    assert zones.get("host.example.org.") is None
+    assert "customer.example.org." in zones
+    assert "org." not in zones
+    assert list(zones) == ["example.org.", "customer.example.org.", "example.com."]
+
+
+def test_invalid_names_are_not_permitted():
+    """names that cannot be parsed match no zone"""
+    assert zones.find("a" * 64 + ".example.org.") is None
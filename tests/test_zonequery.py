@@ -0,0 +1,75 @@
+""" test filtered and paginated zone queries """
+import dns.name
+import dns.rdatatype
+import dns.zone
+import pytest
+from bind_rest_api.api.zonequery import (
+    CursorError,
+    CursorExpired,
+    ZoneView,
+    ZoneViews,
+)
+
+
+def make_zone(serial=1):
+    """a zone with names in and out of a k8s subtree"""
+    return dns.zone.from_text(
+        f"""
+@ 3600 IN SOA ns1 hostmaster {serial} 3600 600 86400 300
+@ 3600 IN NS ns1
+@ 300 IN TXT "v=spf1 -all"
+_acme-challenge 60 IN TXT "token"
+ns1 300 IN A 10.0.0.1
+k8s 300 IN A 10.1.0.1
+app.k8s 300 IN A 10.1.0.2
+db.k8s 300 IN AAAA ::1
+web.app.k8s 300 IN CNAME app.k8s
+k8sx 300 IN A 10.2.0.1
+""",
+        origin="example.org.",
+    )
+
+
+def names(records):
+    """the relative names of query results"""
+    return [str(name) for (name, _, _) in records]
+
+
+def test_suffix_and_type_filters():
+    """a suffix finds the names at and below it, optionally of one type"""
+    view = ZoneView(1, make_zone().iterate_rdatas())
+    suffix = dns.name.from_text("k8s", None)
+    (records, cursor) = view.page(100, suffix=suffix)
+    assert names(records) == ["k8s", "app.k8s", "web.app.k8s", "db.k8s"]
+    assert cursor is None
+    (records, _) = view.page(100, suffix=suffix, rdtype=dns.rdatatype.A)
+    assert names(records) == ["k8s", "app.k8s"]
+
+
+def test_prefix_and_rdata_filters():
+    """name and rdata prefixes, alone and combined with other filters"""
+    view = ZoneView(1, make_zone().iterate_rdatas())
+    (records, _) = view.page(100, prefix="_ACME")
+    assert names(records) == ["_acme-challenge"]
+    (records, _) = view.page(100, rdtype=dns.rdatatype.TXT, rdata="v=spf1")
+    assert names(records) == ["@"]
+    (records, _) = view.page(100, rdata="10.1.", prefix="app")
+    assert names(records) == ["app.k8s"]
+
+
+def test_pages_follow_the_cursor():
+    """pages carry on where the last stopped, on the same zone version"""
+    views = ZoneViews(keep=1)
+    view = views.get("example.org.", 1, make_zone().iterate_rdatas)
+    (first, cursor) = view.page(3)
+    (second, cursor) = views.find("example.org.", cursor).page(3, cursor)
+    (third, cursor) = views.find("example.org.", cursor).page(3, cursor)
+    assert cursor is None
+    assert len(first + second + third) == len(view.records) == 9
+    assert len(set(names(first + second + third))) == 8
+    views.get("example.org.", 2, make_zone(serial=2).iterate_rdatas)
+    (_, cursor) = view.page(3)
+    with pytest.raises(CursorExpired):
+        views.find("example.org.", cursor)
+    with pytest.raises(CursorError):
+        views.find("example.org.", "not a cursor")
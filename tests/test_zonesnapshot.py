@@ -0,0 +1,173 @@
+""" test the zone snapshots shared between workers """
+import json
+import asyncio
+import dns.name
+import dns.rdata
+import dns.zone
+import pytest
+from bind_rest_api.api.serialize import render_snapshot, render_zone
+from bind_rest_api.api.zonesnapshot import (
+    SharedZones,
+    SnapshotError,
+    ZoneSnapshot,
+    write_snapshot,
+)
+
+
+def example_zone(serial=7, extra=""):
+    """a small example.org zone at serial, with any extra records"""
+    return dns.zone.from_text(
+        f"@ 3600 IN SOA ns1 hostmaster {serial} 3600 600 86400 300\n"
+        "@ 3600 IN NS ns1\n"
+        "ns1 300 IN A 10.0.0.1\n"
+        "www 300 IN A 10.0.0.2\n"
+        "www 300 IN A 10.0.0.3\n"
+        'b.www 60 IN TXT "hi there"\n' + extra,
+        origin="example.org.",
+    )
+
+
+class FakeZoneCache:
+    """a zone cache stand-in serving example_zone at the current serial"""
+
+    def __init__(self):
+        self.serial = 7
+        self.extra = ""
+        self.transfers = 0
+
+    async def get(self, zone_name):
+        self.transfers += 1
+        return example_zone(self.serial, self.extra)
+
+    async def soa_serial(self, zone_name):
+        return self.serial
+
+    def invalidate(self, zone_name):
+        pass
+
+
+def test_snapshot_renders_like_the_zone(tmp_path):
+    """a snapshot renders the records of the zone it was written from"""
+    zone = example_zone()
+    write_snapshot(tmp_path / "example.org.snap", zone)
+    snapshot = ZoneSnapshot(tmp_path / "example.org.snap")
+    assert (snapshot.serial, snapshot.origin) == (7, "example.org.")
+    assert (snapshot.name_count, snapshot.record_count) == (4, 6)
+    for output_format in ("json", "columnar"):
+        rendered = json.loads(render_snapshot(snapshot, output_format))
+        expected = json.loads(render_zone(zone, 7, output_format))
+        if output_format == "columnar":
+            # the snapshot is in canonical order
+            rendered = sorted(zip(*(rendered[key] for key in ("name", "response"))))
+            expected = sorted(zip(*(expected[key] for key in ("name", "response"))))
+        assert rendered == expected
+    text = render_snapshot(snapshot, "text").decode()
+    assert dns.zone.from_text(text) == zone
+
+
+def test_snapshot_name_index(tmp_path):
+    """names are found with the name index"""
+    write_snapshot(tmp_path / "example.org.snap", example_zone())
+    snapshot = ZoneSnapshot(tmp_path / "example.org.snap")
+    assert [snapshot.name(position)[0] for position in range(4)] == [
+        "@",
+        "ns1",
+        "www",
+        "b.www",
+    ]
+    assert snapshot.find(dns.name.from_text("www", None)) == [
+        (1, 300, "10.0.0.2"),
+        (1, 300, "10.0.0.3"),
+    ]
+    assert snapshot.find(dns.name.from_text("WWW", None))[0][2] == "10.0.0.2"
+    assert snapshot.find(dns.name.from_text("mail", None)) == []
+
+
+def test_snapshot_records_parse_like_the_zone(tmp_path):
+    """the records and SOA read from a snapshot equal the zone's"""
+    zone = example_zone(extra="mail 60 IN MX 10 @\nalias 60 IN CNAME www.other.\n")
+    write_snapshot(tmp_path / "example.org.snap", zone)
+    snapshot = ZoneSnapshot(tmp_path / "example.org.snap")
+    assert set(snapshot.iterate_rdatas()) == set(zone.iterate_rdatas())
+    assert snapshot.soa() == zone.find_rdataset("@", "SOA")[0]
+
+
+def test_not_a_snapshot(tmp_path):
+    """other files are refused"""
+    (tmp_path / "other").write_bytes(b"$ORIGIN example.org.\n" * 4)
+    with pytest.raises(SnapshotError):
+        ZoneSnapshot(tmp_path / "other")
+
+
+def test_one_worker_transfers_for_all(tmp_path):
+    """only the owner transfers, the other worker maps its snapshots"""
+    (owner_cache, reader_cache) = (FakeZoneCache(), FakeZoneCache())
+    owner = SharedZones(str(tmp_path), owner_cache, max_age=60)
+    reader = SharedZones(str(tmp_path), reader_cache, max_age=60)
+
+    async def workers():
+        try:
+            first = await owner.get("example.org.")
+            mapped = await reader.get("example.org.")
+            assert (first.serial, mapped.serial) == (7, 7)
+            # a write made through the reader moves the zone on
+            (owner_cache.serial, reader_cache.serial) = (8, 8)
+            reader.invalidate("example.org.")
+            mapped = await reader.get("example.org.")
+            assert mapped.serial == 8
+            assert json.loads(render_snapshot(mapped, "json"))["SOA"]["serial"] == 8
+        finally:
+            await owner.close()
+            await reader.close()
+
+    asyncio.run(workers())
+    assert owner_cache.transfers == 2
+    assert reader_cache.transfers == 0
+
+
+def test_next_worker_takes_over(tmp_path):
+    """when the owner stops another worker publishes"""
+    cache = FakeZoneCache()
+    owner = SharedZones(str(tmp_path), cache)
+    reader = SharedZones(str(tmp_path), cache)
+
+    async def workers():
+        await owner.get("example.org.")
+        await owner.close()
+        cache.serial = 8
+        try:
+            assert (await reader.get("example.org.")).serial == 8
+        finally:
+            await reader.close()
+
+    asyncio.run(workers())
+    assert cache.transfers == 2
+
+
+def test_listeners_get_the_changes_between_snapshots(tmp_path):
+    """a worker mapping a new snapshot tells its listeners what changed"""
+    (owner_cache, reader_cache) = (FakeZoneCache(), FakeZoneCache())
+    owner = SharedZones(str(tmp_path), owner_cache, max_age=60)
+    reader = SharedZones(str(tmp_path), reader_cache, max_age=60)
+    changes = []
+
+    async def workers():
+        try:
+            await owner.get("example.org.")
+            reader.listen("example.org.", lambda *change: changes.append(change))
+            assert await reader.current_serial("example.org.") == 7
+            (owner_cache.serial, reader_cache.serial) = (8, 8)
+            owner_cache.extra = "mail 300 IN A 10.0.0.4\n"
+            reader.invalidate("example.org.")
+            assert await reader.current_serial("example.org.") == 8
+        finally:
+            await owner.close()
+            await reader.close()
+
+    asyncio.run(workers())
+    mail = (
+        dns.name.from_text("mail", None),
+        300,
+        dns.rdata.from_text("IN", "A", "10.0.0.4"),
+    )
+    assert changes == [(7, 8, set(), {mail})]
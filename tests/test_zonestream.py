@@ -0,0 +1,118 @@
+""" test the streaming axfr """
+import asyncio
+import struct
+import dns.message
+import dns.rcode
+import dns.rrset
+import dns.xfr
+from bind_rest_api.api.api import stream_zone
+from bind_rest_api.api.zonestream import ClosingStreamingResponse, iterate_axfr
+
+SOA = dns.rrset.from_text(
+    "example.org.", 300, "IN", "SOA", "ns1.example.org. hostmaster.example.org. 7 1 1 1 1"
+)
+
+
+async def transfer(messages, rcode=dns.rcode.NOERROR):
+    """serve one axfr split over messages and collect what iterate_axfr yields"""
+
+    async def handle(reader, writer):
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+        query = dns.message.from_wire(await reader.readexactly(length))
+        for answer in messages:
+            response = dns.message.make_response(query)
+            response.set_rcode(rcode)
+            response.answer = answer
+            wire = response.to_wire()
+            writer.write(struct.pack("!H", len(wire)) + wire)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        return [
+            (str(name), ttl, rdata.rdtype.name, str(rdata))
+            async for (name, ttl, rdata) in iterate_axfr(
+                "127.0.0.1", "example.org.", port=port, timeout=5
+            )
+        ]
+    finally:
+        server.close()
+
+
+def test_records_are_relativized_and_closing_soa_dropped():
+    """records come back in transfer order relative to the origin"""
+    records = asyncio.run(
+        transfer(
+            [
+                [
+                    SOA,
+                    dns.rrset.from_text("www.example.org.", 60, "IN", "A", "10.0.0.1"),
+                ],
+                [
+                    dns.rrset.from_text(
+                        "mail.example.org.", 60, "IN", "CNAME", "www.example.org."
+                    ),
+                    SOA,
+                ],
+            ]
+        )
+    )
+    assert records == [
+        ("@", 300, "SOA", "ns1 hostmaster 7 1 1 1 1"),
+        ("www", 60, "A", "10.0.0.1"),
+        ("mail", 60, "CNAME", "www"),
+    ]
+
+
+def test_refused_transfer_raises():
+    """a refused transfer raises before any record is yielded"""
+    try:
+        asyncio.run(transfer([[]], rcode=dns.rcode.REFUSED))
+    except dns.xfr.TransferError:
+        pass
+    else:
+        assert False, "expected a TransferError"
+
+
+def test_client_going_away_closes_the_transfer():
+    """the transfer's connection is closed as soon as the response fails"""
+
+    async def scenario():
+        closed = asyncio.Event()
+
+        async def handle(reader, writer):
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+            query = dns.message.from_wire(await reader.readexactly(length))
+            response = dns.message.make_response(query)
+            response.answer = [SOA]
+            wire = response.to_wire()
+            # the transfer never finishes, only the client can end it
+            writer.write(struct.pack("!H", len(wire)) + wire)
+            await reader.read()
+            closed.set()
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def receive():
+            await asyncio.sleep(60)
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                raise OSError("client went away")
+
+        response = ClosingStreamingResponse(
+            stream_zone(iterate_axfr("127.0.0.1", "example.org.", port=port))
+        )
+        try:
+            await response({"type": "http"}, receive, send)
+        except OSError:
+            pass
+        try:
+            await asyncio.wait_for(closed.wait(), 2)
+        finally:
+            server.close()
+
+    asyncio.run(scenario())
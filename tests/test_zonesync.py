@@ -0,0 +1,87 @@
+""" test working out zone sync changes """
+from types import SimpleNamespace
+import dns.name
+import dns.rdatatype
+import dns.zone
+import pytest
+from bind_rest_api.api.zonesync import (
+    build_update,
+    current_rrsets,
+    desired_rrsets,
+    diff_rrsets,
+)
+
+ORIGIN = dns.name.from_text("example.org.")
+TYPES = {dns.rdatatype.A, dns.rdatatype.CNAME, dns.rdatatype.NS, dns.rdatatype.TXT}
+ZONE = dns.zone.from_text(
+    """
+@ 3600 IN SOA ns1 hostmaster 7 3600 600 86400 300
+@ 3600 IN NS ns1
+ns1 300 IN A 10.0.0.1
+www 300 IN A 10.0.0.2
+www 300 IN A 10.0.0.3
+old 300 IN TXT "gone soon"
+web 300 IN CNAME www
+app.k8s 60 IN A 10.1.0.1
+""",
+    origin=ORIGIN,
+)
+
+
+def record(response, rrtype="A", ttl=300):
+    """a Record-like object"""
+    return SimpleNamespace(response=response, rrtype=rrtype, ttl=ttl)
+
+
+def test_diff_is_minimal():
+    """only the records that differ are deleted or added"""
+    desired = desired_rrsets(
+        ORIGIN,
+        {
+            "ns1": [record("10.0.0.1")],
+            "www": [record("10.0.0.2"), record("10.0.0.4")],
+            "web.example.org.": [record("www.example.org.", "CNAME")],
+            "app.k8s": [record("10.1.0.1", ttl=120)],
+        },
+        TYPES,
+    )
+    changes = diff_rrsets(current_rrsets(ZONE.iterate_rdatas(), TYPES), desired)
+    summary = [(c.action, str(c.name), str(c.rdata), c.ttl) for c in changes]
+    assert summary == [
+        ("delete", "app.k8s", "10.1.0.1", 60),
+        ("delete", "old", '"gone soon"', 300),
+        ("delete", "www", "10.0.0.3", 300),
+        ("add", "app.k8s", "10.1.0.1", 120),
+        ("add", "www", "10.0.0.4", 300),
+    ]
+
+
+def test_subtree_limits_the_diff():
+    """names outside the subtree are left alone and may not be given"""
+    scope = dns.name.from_text("k8s", None)
+    desired = desired_rrsets(ORIGIN, {"api.k8s": [record("10.1.0.2")]}, TYPES, scope)
+    changes = diff_rrsets(current_rrsets(ZONE.iterate_rdatas(), TYPES, scope), desired)
+    assert [(c.action, str(c.name)) for c in changes] == [
+        ("delete", "app.k8s"),
+        ("add", "api.k8s"),
+    ]
+    with pytest.raises(ValueError):
+        desired_rrsets(ORIGIN, {"www": [record("10.0.0.2")]}, TYPES, scope)
+
+
+def test_unmanaged_records_are_rejected():
+    """the zone's own NS records and other zones cannot be synced"""
+    with pytest.raises(ValueError):
+        desired_rrsets(ORIGIN, {"@": [record("ns2", "NS")]}, TYPES)
+    with pytest.raises(ValueError):
+        desired_rrsets(ORIGIN, {"www.example.com.": [record("10.0.0.2")]}, TYPES)
+
+
+def test_update_requires_the_current_soa():
+    """the update carries the SOA it was worked out from as a prerequisite"""
+    changes = diff_rrsets(current_rrsets(ZONE.iterate_rdatas(), TYPES), {})
+    update = build_update(ZONE.origin, ZONE.find_rdataset("@", "SOA")[0], changes, None)
+    (prerequisite,) = update.prerequisite
+    assert prerequisite.rdtype == dns.rdatatype.SOA
+    assert prerequisite[0].serial == 7
+    assert len(update.update) == len(changes)